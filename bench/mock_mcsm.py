@@ -0,0 +1,112 @@
+import json
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+# --- 本地 MCSManager 模拟服务器（仅供基准测试） ---
+# 模拟实例状态切换（停止中 -> 停止，启动中 -> 运行中）、控制台命令与 save-all 存盘提示，
+# 并记录 save-off 与停服的实际时长，供基准报告使用。
+STATUS_STOPPED, STATUS_STOPPING, STATUS_STARTING, STATUS_RUNNING = 0, 1, 2, 3
+
+class MockMCSManager:
+    def __init__(self, stop_delay=2.0, start_delay=3.0, save_delay=0.5, players=0):
+        self.stop_delay = stop_delay
+        self.start_delay = start_delay
+        self.save_delay = save_delay
+        self.players = players
+        self.status = STATUS_RUNNING
+        self.log = "[Server thread/INFO]: Done!\n"
+        self.commands = []
+        self.events = []
+        self.lock = threading.Lock()
+        self.server = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        mock = self
+
+        class Handler(_Handler):
+            mcsm = mock
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def _later(self, delay, fn):
+        t = threading.Timer(delay, fn)
+        t.daemon = True
+        t.start()
+
+    def _event(self, name):
+        with self.lock:
+            self.events.append((name, time.time()))
+
+    def _append_log(self, line):
+        with self.lock:
+            self.log += line + "\n"
+
+    def _set_status(self, status, event=None):
+        self.status = status
+        if event:
+            self._event(event)
+
+    def handle(self, path, q):
+        if path == "/api/instance":
+            return {"status": 200, "data": {"status": self.status, "info": {"currentPlayers": self.players}}}
+        if path == "/api/protected_instance/outputlog":
+            return {"status": 200, "data": self.log}
+        if path == "/api/protected_instance/stop":
+            self._set_status(STATUS_STOPPING, "stop")
+            self._later(self.stop_delay, lambda: self._set_status(STATUS_STOPPED, "stopped"))
+            return {"status": 200, "data": True}
+        if path == "/api/protected_instance/open":
+            self._set_status(STATUS_STARTING, "open")
+            self._later(self.start_delay, lambda: self._set_status(STATUS_RUNNING, "running"))
+            return {"status": 200, "data": True}
+        if path == "/api/protected_instance/command":
+            cmd = q.get("command", "")
+            with self.lock:
+                self.commands.append(cmd)
+            self._event(cmd)
+            if cmd == "save-all":
+                self._later(self.save_delay, lambda: self._append_log("[Server thread/INFO]: Saved the game"))
+            return {"status": 200, "data": True}
+        return None
+
+    def window(self, begin, end):
+        """返回第一次 begin 事件到其后第一次 end 事件之间的秒数"""
+        with self.lock:
+            events = list(self.events)
+        started = next((t for name, t in events if name == begin), None)
+        if started is None:
+            return None
+        finished = next((t for name, t in events if name == end and t >= started), None)
+        return None if finished is None else finished - started
+
+class _Handler(BaseHTTPRequestHandler):
+    mcsm = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        u = urlparse(self.path)
+        q = {k: v[0] for k, v in parse_qs(u.query).items()}
+        resp = self.mcsm.handle(u.path, q)
+        status = 200 if resp is not None else 404
+        body = json.dumps(resp if resp is not None else {"status": 404}).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
@@ -0,0 +1,296 @@
+import datetime
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+from urllib.parse import urlparse, parse_qs
+
+# --- 本地 123pan 开放平台模拟服务器（仅供基准测试） ---
+# 支持 token、目录列表（翻页）、mkdir、create（秒传）、分片上传、upload_complete、回收站、
+# 文件详情与下载（支持 Range）。可配置每个请求的延迟、总带宽与错误注入概率。
+# 上传的数据按分片写入 data_dir 下的文件，内存占用与文件大小无关。
+READ_CHUNK = 64 * 1024
+
+class Throttle:
+    """所有连接共用的令牌桶，bandwidth 为 0 时不限速"""
+    def __init__(self, bandwidth):
+        self.bandwidth = bandwidth
+        self._lock = threading.Lock()
+        self._tokens = 0.0
+        self._last = time.monotonic()
+
+    def consume(self, n):
+        if not self.bandwidth:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.bandwidth, self._tokens + (now - self._last) * self.bandwidth) - n
+            self._last = now
+            wait = -self._tokens / self.bandwidth if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+def parse_multipart(body: bytes, content_type: str) -> dict:
+    boundary = re.search(r"boundary=([^;]+)", content_type).group(1).strip('"').encode()
+    fields = {}
+    for part in body.split(b"--" + boundary):
+        if b"\r\n\r\n" not in part:
+            continue
+        head, value = part.split(b"\r\n\r\n", 1)
+        name = re.search(rb'name="([^"]+)"', head)
+        if name:
+            fields[name.group(1).decode()] = value[:-2] if value.endswith(b"\r\n") else value
+    return fields
+
+class MockPan:
+    def __init__(self, data_dir, latency=0.0, bandwidth=0, fail_rate=0.0, slice_size=4 * 1024 * 1024,
+                 check_auth=True, servers=2):
+        self.data_dir = Path(data_dir)
+        self.data_dir.mkdir(parents=True, exist_ok=True)
+        self.latency = latency
+        self.throttle = Throttle(bandwidth)
+        self.fail_rate = fail_rate
+        self.slice_size = slice_size
+        self.check_auth = check_auth
+        self.servers = servers
+        self.lock = threading.RLock()
+        self.files = {}
+        self.uploads = {}
+        self.tokens = set()
+        self.next_id = 100
+        self.stats = {"requests": 0, "slices": 0, "slice_bytes": 0, "injected_errors": 0, "reused": 0}
+        self.server = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def upload_servers(self):
+        port = self.server.server_address[1]
+        hosts = ["127.0.0.1", "localhost"][:max(1, self.servers)]
+        return [f"http://{h}:{port}" for h in hosts]
+
+    def start(self):
+        pan = self
+
+        class Handler(_Handler):
+            mock = pan
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def _new_id(self):
+        with self.lock:
+            self.next_id += 1
+            return self.next_id
+
+class _Handler(BaseHTTPRequestHandler):
+    mock = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, obj, status=200):
+        body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _ok(self, data=None):
+        self._send({"code": 0, "message": "ok", "data": data})
+
+    def _error(self, code, message, status=200):
+        self._send({"code": code, "message": message, "data": None}, status)
+
+    def _body(self, throttled=False):
+        left = int(self.headers.get("Content-Length") or 0)
+        chunks = []
+        while left > 0:
+            chunk = self.rfile.read(min(READ_CHUNK, left))
+            if not chunk:
+                break
+            if throttled:
+                self.mock.throttle.consume(len(chunk))
+            chunks.append(chunk)
+            left -= len(chunk)
+        return b"".join(chunks)
+
+    def _authorized(self):
+        if not self.mock.check_auth:
+            return True
+        auth = self.headers.get("Authorization", "")
+        return auth.startswith("Bearer ") and auth[7:] in self.mock.tokens
+
+    def _begin(self):
+        m = self.mock
+        with m.lock:
+            m.stats["requests"] += 1
+        if m.latency:
+            time.sleep(m.latency)
+        u = urlparse(self.path)
+        return u.path, {k: v[0] for k, v in parse_qs(u.query).items()}
+
+    def do_GET(self):
+        path, q = self._begin()
+        m = self.mock
+        if path.startswith("/dl/"):
+            return self._download(int(path[4:]))
+        if not self._authorized():
+            return self._error(401, "access_token 无效")
+        if path == "/api/v2/file/list":
+            pid = int(q.get("parentFileId", 0))
+            limit = int(q.get("limit", 100))
+            last = int(q.get("lastFileId", 0))
+            with m.lock:
+                items = sorted((f for f in m.files.values() if f["parentFileId"] == pid and f["fileId"] > last),
+                               key=lambda f: f["fileId"])
+            page = [_public(f) for f in items[:limit]]
+            return self._ok({"fileList": page, "lastFileId": page[-1]["fileId"] if len(items) > limit else -1})
+        if path == "/api/v1/file/detail":
+            f = m.files.get(int(q.get("fileID", 0)))
+            return self._ok(_public(f)) if f else self._error(1, "文件不存在")
+        if path == "/api/v1/file/download_info":
+            f = m.files.get(int(q.get("fileId", 0)))
+            if not f or f["type"] != 0:
+                return self._error(1, "文件不存在")
+            return self._ok({"downloadUrl": f"{m.base_url}/dl/{f['fileId']}"})
+        self._error(404, "not found", 404)
+
+    def do_POST(self):
+        path, q = self._begin()
+        m = self.mock
+        if path == "/upload/v2/file/slice":
+            return self._slice()
+        body = self._body()
+        if path == "/api/v1/access_token":
+            token = uuid.uuid4().hex
+            m.tokens.add(token)
+            expired = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=1)
+            return self._ok({"accessToken": token, "expiredAt": expired.isoformat()})
+        if not self._authorized():
+            return self._error(401, "access_token 无效")
+        j = json.loads(body or b"{}")
+        if path == "/upload/v1/file/mkdir":
+            parent = int(j["parentID"])
+            with m.lock:
+                if any(f["parentFileId"] == parent and f["filename"] == j["name"] and not f["trashed"]
+                       for f in m.files.values()):
+                    return self._error(1, "该目录下已经有同名文件夹")
+                fid = m._new_id()
+                m.files[fid] = {"fileId": fid, "filename": j["name"], "type": 1, "parentFileId": parent,
+                                "size": 0, "etag": "", "trashed": 0}
+            return self._ok({"dirID": fid})
+        if path == "/upload/v2/file/create":
+            with m.lock:
+                same = next((f for f in m.files.values() if f["type"] == 0 and f["etag"] == j["etag"]
+                             and f["size"] == j["size"]), None)
+            if same:
+                fid = m._new_id()
+                m.files[fid] = dict(same, fileId=fid, filename=j["filename"], parentFileId=int(j["parentFileID"]), trashed=0)
+                m.stats["reused"] += 1
+                return self._ok({"reuse": True, "fileID": fid})
+            pre = uuid.uuid4().hex
+            m.uploads[pre] = {"meta": j, "slices": set(), "path": m.data_dir / pre}
+            m.uploads[pre]["path"].touch()
+            return self._ok({"reuse": False, "preuploadID": pre, "sliceSize": m.slice_size,
+                             "servers": m.upload_servers()})
+        if path == "/upload/v2/file/upload_complete":
+            up = m.uploads.get(j["preuploadID"])
+            if up is None:
+                return self._error(1, "preuploadID 不存在")
+            total = -(-up["meta"]["size"] // m.slice_size) or 1
+            if len(up["slices"]) < total:
+                return self._error(1, f"分片不完整: {len(up['slices'])}/{total}")
+            md5 = hashlib.md5()
+            with open(up["path"], "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    md5.update(chunk)
+            if md5.hexdigest() != up["meta"]["etag"]:
+                return self._error(1, "etag 校验失败")
+            del m.uploads[j["preuploadID"]]
+            fid = m._new_id()
+            data_path = m.data_dir / str(fid)
+            up["path"].rename(data_path)
+            m.files[fid] = {"fileId": fid, "filename": up["meta"]["filename"], "type": 0,
+                            "parentFileId": int(up["meta"]["parentFileID"]), "size": up["meta"]["size"],
+                            "etag": up["meta"]["etag"], "trashed": 0, "path": str(data_path)}
+            return self._ok({"completed": True, "fileID": fid})
+        if path == "/api/v1/file/trash":
+            with m.lock:
+                for i in j.get("fileIDs", []):
+                    if int(i) in m.files:
+                        m.files[int(i)]["trashed"] = 1
+            return self._ok()
+        self._error(404, "not found", 404)
+
+    def _slice(self):
+        m = self.mock
+        if not self._authorized():
+            self._body()
+            return self._error(401, "access_token 无效")
+        body = self._body(throttled=True)
+        if random.random() < m.fail_rate:
+            m.stats["injected_errors"] += 1
+            return self._error(500, "injected error", 500)
+        fields = parse_multipart(body, self.headers["Content-Type"])
+        up = m.uploads.get(fields["preuploadID"].decode())
+        if up is None:
+            return self._error(1, "preuploadID 不存在")
+        data = fields["slice"]
+        if hashlib.md5(data).hexdigest() != fields["sliceMD5"].decode():
+            return self._error(1, "分片 MD5 校验失败")
+        slice_no = int(fields["sliceNo"])
+        with open(up["path"], "r+b") as f:
+            f.seek((slice_no - 1) * m.slice_size)
+            f.write(data)
+        with m.lock:
+            up["slices"].add(slice_no)
+            m.stats["slices"] += 1
+            m.stats["slice_bytes"] += len(data)
+        self._ok()
+
+    def _download(self, fid):
+        m = self.mock
+        f = m.files.get(fid)
+        if not f or f["type"] != 0:
+            return self._error(1, "文件不存在", 404)
+        size = f["size"]
+        start, end = 0, size - 1
+        rng = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if rng:
+            start = int(rng.group(1))
+            end = int(rng.group(2)) if rng.group(2) else size - 1
+        self.send_response(206 if rng else 200)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        if rng:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+        with open(f["path"], "rb") as src:
+            src.seek(start)
+            left = end - start + 1
+            while left > 0:
+                chunk = src.read(min(READ_CHUNK, left))
+                if not chunk:
+                    break
+                m.throttle.consume(len(chunk))
+                self.wfile.write(chunk)
+                left -= len(chunk)
+
+def _public(f):
+    return {k: v for k, v in f.items() if k != "path"} if f else None
@@ -0,0 +1,183 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+from mock_mcsm import MockMCSManager
+from mock_pan import MockPan
+from worldgen import make_world, touch_regions
+
+# --- 端到端基准测试：本地模拟 MCSManager 与 123pan，运行真实的 do_backup ---
+# 每一轮以子进程执行 `main.py run_once`（等待后台上传队列结束），
+# 从 .mcbackup/runs.json 读取阶段耗时，并统计吞吐、停机时长与该轮子进程（含其压缩子进程）的峰值内存。
+SRC = Path(__file__).resolve().parent.parent / "src"
+
+def build_config(args, work: Path, mcsm: MockMCSManager, pan: MockPan) -> dict:
+    return {
+        "mcsmanager": {
+            "base_url": mcsm.base_url,
+            "apikey": "bench",
+            "daemonId": "bench-daemon",
+            "instance_uuid": "bench-instance",
+            "poll_interval": 0.2
+        },
+        "server": {
+            "server_dir": str(work / "server"),
+            "backup_dir": str(work / "backups"),
+            "compress_cmd": args.compress_cmd,
+            "compress_args": ["a", f"-mx={args.level}"],
+            "compress_engine": args.compress_engine,
+            "zstd_level": args.level,
+            "volume_size": args.volume_size,
+            "world_folders": ["world"]
+        },
+        "123pan_http": {
+            "api_base_url": pan.base_url,
+            "client_id": "bench",
+            "client_secret": "bench",
+            "parent_folder_id": 0,
+            "upload_concurrency": args.concurrency,
+            "client": args.client
+        },
+        "schedule": {"times": ["03:00"], "timezone": "Asia/Shanghai"},
+        "logging": {"log_file": str(work / "mc_backup.log"), "max_bytes": 104857600, "backup_count": 1},
+        "backup": {
+            "mode": args.mode,
+            "keep_days": 7,
+            "keep_count": 100,
+            "storage": "both",
+            "engine": args.engine,
+            "incremental": args.incremental,
+            "snapshot": args.snapshot,
+            "retention": False
+        }
+    }
+
+def run_once(config_path: Path, work: Path):
+    env = dict(os.environ, MCBACKUP_CONFIG=str(config_path))
+    started = time.time()
+    proc = subprocess.Popen([sys.executable, str(SRC / "main.py"), "run_once"], cwd=str(work), env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    stderr = proc.stderr.read()
+    proc.stderr.close()
+    # 用 wait4 取得这一轮子进程自身的资源统计：ru_maxrss 为该进程及其已回收的子进程（7z 等）中的
+    # 最大值（Linux 下单位 KiB）。RUSAGE_CHILDREN 是整个基准会话的累计最大值，后面的轮次无法变小。
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    elapsed = time.time() - started
+    if proc.returncode != 0:
+        sys.stderr.write(stderr.decode("utf-8", "replace"))
+        raise RuntimeError(f"run_once 退出码 {proc.returncode}")
+    return elapsed, usage.ru_maxrss
+
+def summarize(run, elapsed, peak_kib, mcsm: MockMCSManager, wire_bytes: int):
+    phases = run.get("phases", {})
+    values = run.get("values", {})
+    uploads = run.get("uploads", [])
+    # 快照模式的上传任务只记录快照清单本身的大小，实际传输量以模拟服务器收到的分片字节数为准
+    up_bytes = wire_bytes
+    up_seconds = sum(u.get("upload_seconds", 0) for u in uploads)
+    compress = phases.get("compress", 0)
+    return {
+        "ok": run.get("ok") and all(u.get("ok") for u in uploads),
+        "total_seconds": round(elapsed, 2),
+        "backup_seconds": run.get("seconds"),
+        "phases": phases,
+        "bytes_in": values.get("bytes_in", 0),
+        "bytes_out": values.get("bytes_out", 0),
+        "compression_ratio": values.get("compression_ratio"),
+        "compress_mib_s": round(values.get("bytes_in", 0) / 1048576 / compress, 1) if compress else None,
+        "downtime_seconds": values.get("downtime_seconds"),
+        "panel_downtime_seconds": _round(mcsm.window("stop", "running")),
+        "save_off_seconds": values.get("save_off_seconds"),
+        "upload_bytes": up_bytes,
+        "upload_mib_s": round(up_bytes / 1048576 / up_seconds, 1) if up_seconds else None,
+        "slice_latency": uploads[-1].get("slice_latency") if uploads else None,
+        "peak_rss_mib": round(peak_kib / 1024, 1)
+    }
+
+def _round(v):
+    return None if v is None else round(v, 2)
+
+def print_report(i, s):
+    print(f"--- 第 {i} 轮 {'成功' if s['ok'] else '失败'} ---")
+    print(f"  总耗时 {s['total_seconds']}s（备份流程 {s['backup_seconds']}s，其余为等待后台上传）")
+    print("  阶段: " + ", ".join(f"{k}={v}s" for k, v in s["phases"].items()))
+    print(f"  输入 {s['bytes_in'] / 1048576:.1f} MiB -> 输出 {s['bytes_out'] / 1048576:.1f} MiB，"
+          f"压缩比 {s['compression_ratio']}，压缩 {s['compress_mib_s']} MiB/s")
+    if s["downtime_seconds"] is not None:
+        print(f"  停机 {s['downtime_seconds']}s（面板侧 {s['panel_downtime_seconds']}s）")
+    if s["save_off_seconds"] is not None:
+        print(f"  save-off 窗口 {s['save_off_seconds']}s")
+    print(f"  上传 {s['upload_bytes'] / 1048576:.1f} MiB，{s['upload_mib_s']} MiB/s，分片延迟 {s['slice_latency']}")
+    print(f"  子进程峰值内存 {s['peak_rss_mib']} MiB")
+
+def main():
+    parser = argparse.ArgumentParser(description="mcbackup 端到端基准测试（本地模拟 MCSManager 与 123pan）")
+    parser.add_argument("--workdir", help="工作目录（默认临时目录，结束后删除）")
+    parser.add_argument("--runs", type=int, default=1, help="连续备份的轮数，轮次之间会改写部分区域文件")
+    parser.add_argument("--regions", type=int, default=16)
+    parser.add_argument("--region-kib", type=int, default=4096)
+    parser.add_argument("--entropy", type=float, default=0.3, help="区块数据中随机字节的比例 0~1")
+    parser.add_argument("--mode", choices=["cold", "hot"], default="hot")
+    parser.add_argument("--engine", choices=["7z", "chunk"], default="7z")
+    parser.add_argument("--compress-engine", choices=["7z", "zstd"], default="7z")
+    parser.add_argument("--compress-cmd", default="7z")
+    parser.add_argument("--level", type=int, default=3)
+    parser.add_argument("--volume-size", default="64m")
+    parser.add_argument("--incremental", action="store_true")
+    parser.add_argument("--snapshot", action="store_true")
+    parser.add_argument("--client", choices=["requests", "aiohttp"], default="requests")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--slice-kib", type=int, default=4096, help="模拟服务器返回的 sliceSize")
+    parser.add_argument("--latency-ms", type=float, default=0, help="模拟服务器每个请求的附加延迟")
+    parser.add_argument("--bandwidth-mib", type=float, default=0, help="模拟服务器总带宽（0 为不限）")
+    parser.add_argument("--fail-rate", type=float, default=0, help="分片请求返回 500 的概率")
+    parser.add_argument("--stop-delay", type=float, default=2.0)
+    parser.add_argument("--start-delay", type=float, default=3.0)
+    parser.add_argument("--json", help="把结果写入 JSON 文件")
+    args = parser.parse_args()
+
+    work = Path(args.workdir or tempfile.mkdtemp(prefix="mcbackup-bench-"))
+    work.mkdir(parents=True, exist_ok=True)
+    world_bytes = make_world(work / "server", args.regions, args.region_kib, args.entropy)
+    print(f"合成世界: {args.regions} 个区域文件，{world_bytes / 1048576:.1f} MiB，entropy={args.entropy}")
+
+    mcsm = MockMCSManager(stop_delay=args.stop_delay, start_delay=args.start_delay).start()
+    pan = MockPan(work / "pan", latency=args.latency_ms / 1000, bandwidth=int(args.bandwidth_mib * 1048576),
+                  fail_rate=args.fail_rate, slice_size=args.slice_kib * 1024).start()
+    config_path = work / "config.json"
+    config_path.write_text(json.dumps(build_config(args, work, mcsm, pan), ensure_ascii=False, indent=2), encoding="utf-8")
+
+    results = []
+    try:
+        for i in range(1, args.runs + 1):
+            if i > 1:
+                touch_regions(work / "server", seed=i)
+            mcsm.events.clear()
+            wire_before = pan.stats["slice_bytes"]
+            elapsed, peak_kib = run_once(config_path, work)
+            runs = json.loads((work / "backups" / ".mcbackup" / "runs.json").read_text(encoding="utf-8"))
+            summary = summarize(runs[-1], elapsed, peak_kib, mcsm, pan.stats["slice_bytes"] - wire_before)
+            summary["mock_pan"] = dict(pan.stats)
+            results.append(summary)
+            print_report(i, summary)
+    finally:
+        mcsm.stop()
+        pan.stop()
+        if not args.workdir:
+            shutil.rmtree(work, ignore_errors=True)
+
+    if args.json:
+        Path(args.json).write_text(json.dumps({"args": vars(args), "runs": results}, ensure_ascii=False, indent=2),
+                                   encoding="utf-8")
+    return 0 if all(r["ok"] for r in results) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
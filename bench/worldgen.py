@@ -0,0 +1,88 @@
+import argparse
+import os
+import random
+import struct
+import time
+import zlib
+from pathlib import Path
+
+# --- 合成世界生成器（仅供基准测试） ---
+# 生成带合法 Anvil 文件头（位置表 + 时间戳表）的区域文件。entropy 控制区块数据中随机字节的比例：
+# 0 为全部可压缩（重复的 NBT 风格内容），1 为完全随机（不可压缩）。
+SECTOR = 4096
+CHUNKS_PER_REGION = 1024
+
+def _random_bytes(rng, n):
+    # Random.randbytes 需要 Python 3.9+
+    if hasattr(rng, "randbytes"):
+        return rng.randbytes(n)
+    return rng.getrandbits(8 * n).to_bytes(n, "little") if n else b""
+
+def _chunk_payload(rng, size, entropy):
+    random_len = int(size * entropy)
+    pattern = b"minecraft:stone\x00minecraft:dirt\x00minecraft:air\x00" * (size // 48 + 1)
+    return _random_bytes(rng, random_len) + pattern[:size - random_len]
+
+def make_region(path: Path, size: int, entropy: float, rng, timestamp=None):
+    """写出约 size 字节的区域文件，区块按扇区对齐并写入头部位置表与时间戳"""
+    timestamp = int(timestamp or time.time())
+    sectors_total = max(3, size // SECTOR)
+    chunks = min(CHUNKS_PER_REGION, sectors_total - 2)
+    sectors_per_chunk = max(1, (sectors_total - 2) // chunks)
+    locations = bytearray(SECTOR)
+    timestamps = bytearray(SECTOR)
+    with open(path, "wb") as f:
+        f.seek(2 * SECTOR)
+        offset = 2
+        for i in range(chunks):
+            length = sectors_per_chunk * SECTOR - 5
+            data = _chunk_payload(rng, length, entropy)
+            f.write(struct.pack(">IB", length + 1, 2) + data)
+            struct.pack_into(">I", locations, 4 * i, (offset << 8) | sectors_per_chunk)
+            struct.pack_into(">I", timestamps, 4 * i, timestamp)
+            offset += sectors_per_chunk
+        f.seek(0)
+        f.write(locations)
+        f.write(timestamps)
+
+def make_world(root, regions=16, region_kib=4096, entropy=0.3, seed=1, name="world"):
+    """在 root/name 下生成世界，返回写入的总字节数"""
+    rng = random.Random(seed)
+    world = Path(root) / name
+    (world / "region").mkdir(parents=True, exist_ok=True)
+    (world / "playerdata").mkdir(exist_ok=True)
+    side = max(1, int(regions ** 0.5))
+    total = 0
+    for i in range(regions):
+        path = world / "region" / f"r.{i % side}.{i // side}.mca"
+        make_region(path, region_kib * 1024, entropy, rng)
+        total += path.stat().st_size
+    level = zlib.compress(b"\x0a\x00\x00" + b"Data" * 256)
+    (world / "level.dat").write_bytes(level)
+    (world / "playerdata" / "00000000-0000-0000-0000-000000000000.dat").write_bytes(level)
+    return total + 2 * len(level)
+
+def touch_regions(root, fraction=0.1, seed=2, name="world"):
+    """改写部分区域文件的一部分区块，模拟两次备份之间的游戏进度"""
+    rng = random.Random(seed)
+    regions = sorted((Path(root) / name / "region").glob("*.mca"))
+    changed = rng.sample(regions, max(1, int(len(regions) * fraction))) if regions else []
+    now = int(time.time())
+    for path in changed:
+        with open(path, "r+b") as f:
+            f.seek(4096 + 4 * rng.randrange(CHUNKS_PER_REGION))
+            f.write(struct.pack(">I", now))
+            f.seek(2 * SECTOR + 5)
+            f.write(os.urandom(SECTOR - 5))
+    return [str(p) for p in changed]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="生成用于基准测试的合成 Minecraft 世界")
+    parser.add_argument("root")
+    parser.add_argument("--regions", type=int, default=16)
+    parser.add_argument("--region-kib", type=int, default=4096)
+    parser.add_argument("--entropy", type=float, default=0.3)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    size = make_world(args.root, args.regions, args.region_kib, args.entropy, args.seed)
+    print(f"已生成 {args.regions} 个区域文件，共 {size / 1048576:.1f} MiB")
@@ -0,0 +1,136 @@
+import datetime
+import socket
+import threading
+import time
+from urllib.parse import urlparse
+import pytz
+from config import cfg
+from log_api import logger
+
+# --- 上传限速：令牌桶 + 分时段限速 + 按 RTT 自适应（AIMD） ---
+# 所有分片的请求体在发送时调用 throttle()，requests 与 aiohttp 客户端共用同一个桶。
+PROFILE_CHECK_INTERVAL = 30
+IDLE_STOP = 60
+DECREASE = 0.7
+
+def _conf():
+    return cfg.get("bandwidth", {})
+
+def _parse_hhmm(text):
+    hh, mm = str(text).split(":")
+    return int(hh) * 60 + int(mm)
+
+def profile_limit(now=None):
+    """返回当前时段的限速（字节/秒），0 为不限速。profiles 中后面的条目优先"""
+    conf = _conf()
+    limit = int(conf.get("limit_kib", 0)) * 1024
+    if now is None:
+        now = datetime.datetime.now(pytz.timezone(cfg["schedule"]["timezone"]))
+    minute = now.hour * 60 + now.minute
+    for p in conf.get("profiles", []):
+        start, end = _parse_hhmm(p["start"]), _parse_hhmm(p["end"])
+        # end 小于 start 表示跨越午夜，例如 22:00-06:00
+        inside = start <= minute < end if start <= end else (minute >= start or minute < end)
+        if inside:
+            limit = int(p.get("limit_kib", 0)) * 1024
+    return limit
+
+def probe_rtt(host, port, timeout=5.0):
+    """以 TCP 建连耗时估算到上传服务器的 RTT（秒），失败返回 None"""
+    started = time.monotonic()
+    try:
+        with socket.create_connection((host, port), timeout=timeout):
+            return time.monotonic() - started
+    except OSError:
+        return None
+
+class BandwidthShaper:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tokens = 0.0
+        self._last = time.monotonic()
+        self._profile = None
+        self._profile_checked = 0
+        self._adaptive_rate = None
+        self._server = None
+        self._sent = 0
+        self._last_used = 0
+        self._prober = None
+
+    def note_server(self, url):
+        """记录当前使用的上传服务器，作为 RTT 探测目标"""
+        u = urlparse(url)
+        port = u.port or (443 if u.scheme == "https" else 80)
+        self._server = (u.hostname, port)
+
+    def rate(self):
+        """当前生效的限速（字节/秒），0 为不限速"""
+        now = time.monotonic()
+        if now - self._profile_checked >= PROFILE_CHECK_INTERVAL:
+            self._profile_checked = now
+            limit = profile_limit()
+            if limit != self._profile:
+                logger.info("上传限速时段切换: %s", f"{limit // 1024} KiB/s" if limit else "不限速")
+                self._profile = limit
+        limits = [r for r in (self._profile, self._adaptive_rate) if r]
+        return min(limits) if limits else 0
+
+    def throttle(self, n):
+        """发送 n 字节之前调用，超出限速时阻塞当前线程"""
+        with self._lock:
+            now = time.monotonic()
+            self._sent += n
+            self._last_used = now
+            if _conf().get("adaptive", False) and self._prober is None:
+                self._prober = threading.Thread(target=self._probe_loop, name="rtt-probe", daemon=True)
+                self._prober.start()
+            rate = self.rate()
+            if not rate:
+                self._tokens = 0.0
+                self._last = now
+                return
+            # 令牌桶：最多积累 1 秒的额度，不足时记为欠账，由调用者睡眠偿还
+            self._tokens = min(rate, self._tokens + (now - self._last) * rate) - n
+            self._last = now
+            wait = -self._tokens / rate if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+    def _probe_loop(self):
+        conf = _conf()
+        interval = float(conf.get("probe_interval", 5))
+        factor = float(conf.get("rtt_factor", 2.0))
+        min_rate = int(conf.get("min_kib", 256)) * 1024
+        step = int(conf.get("increase_kib", 256)) * 1024
+        baseline = None
+        sent_before = self._sent
+        while time.monotonic() - self._last_used < IDLE_STOP:
+            time.sleep(interval)
+            if self._server is None:
+                continue
+            rtt = probe_rtt(*self._server)
+            throughput = (self._sent - sent_before) / interval
+            sent_before = self._sent
+            if rtt is None:
+                continue
+            baseline = rtt if baseline is None else min(baseline, rtt)
+            cap = self._profile or 0
+            if rtt > baseline * factor:
+                # 乘性减：以实际吞吐为准，避免从"不限速"直接降到无意义的数值
+                current = self._adaptive_rate or cap or throughput
+                new_rate = max(min_rate, int(min(current, throughput or current) * DECREASE))
+                if new_rate != self._adaptive_rate:
+                    logger.info("上传 RTT %.0fms 高于基线 %.0fms，限速降至 %d KiB/s",
+                                rtt * 1000, baseline * 1000, new_rate // 1024)
+                self._adaptive_rate = new_rate
+            elif self._adaptive_rate:
+                # 加性增；超过时段上限，或实际吞吐远低于限速（限速已不起作用）时取消自适应限制
+                self._adaptive_rate += step
+                if (cap and self._adaptive_rate >= cap) or (not cap and throughput < self._adaptive_rate / 2):
+                    logger.info("上传 RTT 恢复正常，取消自适应限速")
+                    self._adaptive_rate = None
+        with self._lock:
+            self._prober = None
+            self._adaptive_rate = None
+
+shaper = BandwidthShaper()
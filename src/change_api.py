@@ -0,0 +1,263 @@
+import os
+import time
+import fnmatch
+import hashlib
+import threading
+from pathlib import Path
+from config import cfg
+from log_api import logger
+from state_api import load_state, save_state
+from mcsm_api import mcs_players, mcs_status, mcs_save_all, STATUS_RUNNING
+from metrics_api import record
+
+# --- 备份前检查：变化检测与玩家在线推迟 ---
+# 每次备份上传成功（或因无变化跳过）后，把备份范围内文件的 大小 / mtime / 可选哈希 缓存到
+# .mcbackup/change_manifest.json。下次备份前只做一遍 stat 比较：大小与 mtime 都相同视为未变；
+# 大小相同但 mtime 不同（存盘重写了未改动的文件）时计算 sha256 与缓存比较。
+# 冷备份的范围为整个 server_dir，热备份为 world_folders；change_ignore 中的路径不计入变化。
+# 备份入队时清单先暂存在 change_pending.json（以运行 ID 为键），上传任务成功结束后才写入 change_manifest.json，
+# 上传失败或校验未通过时丢弃，下次备份仍会检测到这些变化。
+# 服务器运行中时先执行 save-all，把尚未写盘的世界变化落盘后再比较，否则会把有变化的世界判为未变。
+MANIFEST = "change_manifest.json"
+PENDING = "change_pending.json"
+HASH_BUFFER = 4 * 1024 * 1024
+_manifest_lock = threading.Lock()
+DEFAULT_IGNORE = ["logs", "crash-reports", "cache", "*.lock", "*.log", "*.log.gz", "level.dat", "level.dat_old"]
+
+def _conf():
+    return cfg.get("backup", {})
+
+def ignored(rel, patterns):
+    """patterns 中的路径、目录前缀或通配符；不含 / 的通配符也匹配文件名"""
+    name = rel.rsplit("/", 1)[-1]
+    for p in patterns:
+        p = p.strip("/")
+        if rel == p or rel.startswith(p + "/") or fnmatch.fnmatchcase(rel, p):
+            return True
+        if "/" not in p and (fnmatch.fnmatchcase(name, p) or f"/{p}/" in f"/{rel}"):
+            return True
+    return False
+
+def scope_inputs(mode):
+    """(范围名, 根目录, 输入)；与 compress_full / compress_worlds 的备份范围一致"""
+    server_dir = Path(cfg["server"]["server_dir"])
+    if mode == "cold":
+        return "full", server_dir, None
+    world_folders = cfg["server"].get("world_folders", ["world"])
+    return "world", server_dir, [w for w in world_folders if (server_dir / w).exists()]
+
+def scan_tree(root: Path, inputs=None) -> dict:
+    """返回 相对路径 -> (大小, mtime_ns)，跳过符号链接"""
+    result = {}
+
+    def walk(path, rel):
+        try:
+            entries = list(os.scandir(path))
+        except OSError as e:
+            logger.warning("无法读取目录 %s: %s", path, e)
+            return
+        for entry in entries:
+            r = f"{rel}/{entry.name}" if rel else entry.name
+            if entry.is_symlink():
+                continue
+            if entry.is_dir():
+                walk(entry.path, r)
+            elif entry.is_file():
+                st = entry.stat()
+                result[r] = (st.st_size, st.st_mtime_ns)
+
+    for base in inputs if inputs is not None else [""]:
+        path = root / base if base else root
+        if path.is_file():
+            st = path.stat()
+            result[base] = (st.st_size, st.st_mtime_ns)
+        elif path.is_dir():
+            walk(str(path), base)
+    return result
+
+def file_hash(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BUFFER), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def compare(root: Path, current: dict, previous: dict, ignore, hash_max):
+    """
+    与上次的清单比较，返回 (新清单, 变化的路径列表, 变化的字节数)。
+    新清单沿用未变文件的哈希；mtime 变化而大小不变且不超过 hash_max 的文件重新计算哈希。
+    """
+    manifest = {}
+    changed = []
+    changed_bytes = 0
+    for rel, (size, mtime) in current.items():
+        prev = previous.get(rel)
+        digest = None
+        if prev and prev[0] == size and prev[1] == mtime:
+            manifest[rel] = prev
+            continue
+        if prev and prev[0] == size and size <= hash_max:
+            try:
+                digest = file_hash(root / rel)
+            except OSError:
+                digest = None
+        manifest[rel] = [size, mtime, digest]
+        if digest is not None and digest == prev[2]:
+            continue
+        if not ignored(rel, ignore):
+            changed.append(rel)
+            changed_bytes += size
+    changed.extend(rel for rel in previous if rel not in current and not ignored(rel, ignore))
+    return manifest, changed, changed_bytes
+
+class BackupPlan:
+    """备份前检查的结论；mode 为 None 表示本次跳过"""
+    def __init__(self, mode):
+        self.mode = mode
+        self.scope = None
+        self.manifest = None
+        self.previous = None
+        self.changed = None
+        self.changed_bytes = 0
+        self.check_seconds = 0.0
+        self.deferred_seconds = 0.0
+        self.downgraded = False
+
+    def record(self):
+        if self.changed is not None:
+            record("changed_files", len(self.changed))
+            record("changed_bytes", self.changed_bytes)
+            record("change_check_seconds", round(self.check_seconds, 2))
+        if self.deferred_seconds >= 1:
+            record("deferred_seconds", round(self.deferred_seconds, 1))
+        if self.downgraded:
+            record("downgraded", 1)
+        if self.mode is None:
+            record("skipped", 1)
+
+    def commit(self):
+        """跳过备份或没有需要上传的文件时立即保存本次的文件清单"""
+        if self.manifest is not None:
+            _save_manifest(self.scope, self.manifest)
+
+    def stage(self, run_id):
+        """备份即将入队：暂存本次的文件清单，由上传任务结束时的 settle_manifest 决定是否生效"""
+        if self.manifest is None:
+            return
+        with _manifest_lock:
+            pending = load_state(PENDING, {})
+            pending[run_id] = {"scope": self.scope, "manifest": self.manifest}
+            save_state(PENDING, pending)
+
+def _save_manifest(scope, manifest):
+    with _manifest_lock:
+        manifests = load_state(MANIFEST, {})
+        manifests[scope] = manifest
+        save_state(MANIFEST, manifests)
+
+def settle_manifest(run_id, ok):
+    """运行 run_id 的上传结束：成功时保存暂存的清单，失败时丢弃"""
+    with _manifest_lock:
+        pending = load_state(PENDING, {})
+        entry = pending.pop(run_id, None) if run_id is not None else None
+        if entry is None:
+            return
+        save_state(PENDING, pending)
+    if ok:
+        _save_manifest(entry["scope"], entry["manifest"])
+    else:
+        logger.info("备份未能完成上传，不更新变化检测清单")
+
+def check_changes(plan: BackupPlan):
+    conf = _conf()
+    started = time.time()
+    scope, root, inputs = scope_inputs(plan.mode)
+    previous = load_state(MANIFEST, {}).get(scope)
+    current = scan_tree(root, inputs)
+    manifest, changed, changed_bytes = compare(root, current, previous or {}, conf.get("change_ignore", DEFAULT_IGNORE),
+                                               conf.get("hash_max_mib", 256) * 1048576)
+    plan.scope, plan.manifest, plan.previous = scope, manifest, previous
+    plan.check_seconds = time.time() - started
+    if previous is None:
+        logger.info("变化检测: 没有上次的文件清单，执行完整备份（扫描 %d 个文件，%.1fs）", len(current), plan.check_seconds)
+        return
+    plan.changed, plan.changed_bytes = changed, changed_bytes
+    logger.info("变化检测: %d 个文件有变化（%.1f MiB），扫描 %d 个文件，耗时 %.1fs", len(changed),
+                changed_bytes / 1048576, len(current), plan.check_seconds)
+
+def flush_world():
+    """服务器运行中时执行 save-all 并等待完成；无法确认存盘完成时抛出异常（调用方照常备份）"""
+    try:
+        running = mcs_status() == STATUS_RUNNING
+    except Exception as e:
+        logger.warning("查询实例状态失败，仍尝试 save-all: %s", e)
+        running = True
+    if running:
+        mcs_save_all()
+
+def wait_for_players(plan: BackupPlan):
+    """冷备份前等待玩家下线；返回 False 表示等待超时仍有玩家在线"""
+    conf = _conf()
+    limit = conf.get("defer_max_minutes", 60) * 60
+    poll = conf.get("defer_poll_seconds", 60)
+    started = time.time()
+    while True:
+        try:
+            players = mcs_players()
+        except Exception as e:
+            logger.warning("无法获取在线玩家数，不推迟备份: %s", e)
+            return True
+        waited = time.time() - started
+        plan.deferred_seconds = waited
+        if not players:
+            if waited >= 1:
+                logger.info("玩家已下线，冷备份推迟了 %.0f 分钟", waited / 60)
+            return True
+        if waited >= limit:
+            return False
+        logger.info("%d 名玩家在线，推迟冷备份（已等待 %.0f 分钟）", players, waited / 60)
+        time.sleep(min(poll, limit - waited))
+
+def _world_only(changed):
+    worlds = cfg["server"].get("world_folders", ["world"])
+    return all(any(rel == w or rel.startswith(w + "/") for w in worlds) for rel in changed)
+
+def _keep_previous(plan, rels):
+    for rel in rels:
+        if rel in plan.previous:
+            plan.manifest[rel] = plan.previous[rel]
+        else:
+            plan.manifest.pop(rel, None)
+
+def plan_backup(mode) -> BackupPlan:
+    """
+    备份前检查（先让运行中的服务器存盘）：无有效变化时跳过；冷备份在变化只涉及世界文件夹且不超过 downgrade_mib、
+    或推迟到 defer_max_minutes 仍有玩家在线时改为热备份。检查出错时照常备份。
+    """
+    conf = _conf()
+    plan = BackupPlan(mode)
+    if conf.get("skip_unchanged", True) or conf.get("downgrade_mib", 0):
+        try:
+            flush_world()
+            check_changes(plan)
+        except Exception as e:
+            logger.warning("变化检测失败，照常备份: %s", e)
+            plan.manifest = plan.changed = None
+    if plan.changed is not None and not plan.changed and conf.get("skip_unchanged", True):
+        logger.info("=== 自上次备份以来没有变化，跳过本次备份 ===")
+        plan.mode = None
+        return plan
+    if mode != "cold":
+        return plan
+    limit = conf.get("downgrade_mib", 0) * 1048576
+    if limit and plan.changed is not None and plan.changed_bytes <= limit and _world_only(plan.changed):
+        logger.info("变化只涉及世界文件夹且不超过 %d MiB，本次改为热备份", conf["downgrade_mib"])
+        plan.mode, plan.downgraded = "hot", True
+        return plan
+    if conf.get("defer_on_players", False) and not wait_for_players(plan):
+        logger.info("推迟 %d 分钟后仍有玩家在线，本次改为热备份", conf.get("defer_max_minutes", 60))
+        plan.mode, plan.downgraded = "hot", True
+        if plan.changed and not _world_only(plan.changed):
+            # 热备份不包含世界以外的文件，这些变化留到下次冷备份
+            _keep_previous(plan, [rel for rel in plan.changed if not _world_only([rel])])
+    return plan
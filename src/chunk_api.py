@@ -0,0 +1,280 @@
+import os
+import json
+import time
+import zlib
+import hashlib
+import datetime
+import threading
+from pathlib import Path
+from log_api import logger
+from config import cfg
+from metrics_api import timed, add
+
+# --- 内容寻址去重块存储（可替代 7z 分卷的备份引擎） ---
+# 布局: <store>/packs/pack-*.pack   压缩后的块顺序拼接
+#       <store>/index.json          块 ID -> [pack, 偏移, 长度, 是否压缩]
+#       <store>/snapshots/*.json    每次备份的快照清单（文件 -> 块 ID 列表，以及所用块在 pack 中的位置，
+#                                   使快照脱离本地 index.json 也能从云端按区间恢复）
+SECTOR = 4096
+READ_BUFFER = 4 * 1024 * 1024
+_locks_guard = threading.Lock()
+_store_locks = {}
+
+def store_conf():
+    conf = {
+        "dir": str(Path(cfg["server"]["backup_dir"]) / "chunkstore"),
+        "avg_chunk_kib": 1024,
+        "min_chunk_kib": 256,
+        "max_chunk_kib": 8192,
+        "pack_mib": 64,
+        "level": 6
+    }
+    conf.update(cfg.get("chunk_store", {}))
+    return conf
+
+def store_dir() -> Path:
+    d = Path(store_conf()["dir"])
+    (d / "packs").mkdir(parents=True, exist_ok=True)
+    (d / "snapshots").mkdir(parents=True, exist_ok=True)
+    return d
+
+def _store_lock():
+    """每个块存储目录一把锁，多实例各自的块存储可以并行写入"""
+    key = str(store_dir())
+    with _locks_guard:
+        return _store_locks.setdefault(key, threading.Lock())
+
+def _load_json(path: Path, default):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+def _save_json(path: Path, data):
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def iter_chunks(f, avg, min_size, max_size):
+    """
+    以 4 KiB 扇区为粒度的内容定义分块：扇区 CRC32 的低位全为 0 时切分。
+    Anvil 区域文件按扇区对齐存放区块，区块在文件内移动后切分点仍能对齐，
+    而逐字节滚动哈希在纯 Python 中太慢。
+    """
+    mask = max(1, avg // SECTOR) - 1
+    chunk = bytearray()
+    while True:
+        buf = f.read(READ_BUFFER)
+        if not buf:
+            break
+        view = memoryview(buf)
+        for pos in range(0, len(buf), SECTOR):
+            sector = view[pos:pos + SECTOR]
+            chunk += sector
+            if len(chunk) >= max_size or (len(chunk) >= min_size and zlib.crc32(sector) & mask == 0):
+                yield bytes(chunk)
+                chunk = bytearray()
+    if chunk:
+        yield bytes(chunk)
+
+class PackWriter:
+    """把新块压缩后追加到 pack 文件，达到 pack_mib 后封包并以内容哈希命名"""
+    def __init__(self, root: Path, index: dict, level: int, pack_size: int):
+        self.root = root
+        self.index = index
+        self.level = level
+        self.pack_size = pack_size
+        self.new_packs = []
+        self.new_bytes = 0
+        self._f = None
+        self._hash = None
+        self._entries = {}
+
+    def add(self, chunk_id: str, data: bytes):
+        if chunk_id in self.index or chunk_id in self._entries:
+            return
+        packed = zlib.compress(data, self.level)
+        compressed = len(packed) < len(data)
+        if not compressed:
+            packed = data
+        if self._f is None:
+            self._tmp = self.root / "packs" / f"tmp-{os.getpid()}-{time.time_ns()}.pack"
+            self._f = open(self._tmp, "wb")
+            self._hash = hashlib.sha256()
+        offset = self._f.tell()
+        self._f.write(packed)
+        self._hash.update(packed)
+        self._entries[chunk_id] = [offset, len(packed), compressed]
+        self.new_bytes += len(packed)
+        if self._f.tell() >= self.pack_size:
+            self.seal()
+
+    def seal(self):
+        if self._f is None:
+            return
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._f.close()
+        name = f"pack-{self._hash.hexdigest()[:32]}.pack"
+        os.replace(self._tmp, self.root / "packs" / name)
+        for chunk_id, (offset, length, compressed) in self._entries.items():
+            self.index[chunk_id] = [name, offset, length, compressed]
+        self.new_packs.append(name)
+        self._f = None
+        self._entries = {}
+
+def _walk(root: Path, inputs):
+    for base in inputs:
+        base = root / base
+        if base.is_file():
+            yield base
+            continue
+        for dirpath, dirnames, filenames in os.walk(base):
+            dirnames.sort()
+            for name in sorted(filenames):
+                yield Path(dirpath) / name
+
+def create_snapshot(kind: str, root: Path, inputs) -> str:
+    """
+    把 root 下的 inputs 切块入库，返回快照清单路径。
+    大小与 mtime 未变的文件直接沿用上一份快照的块列表，不再读取。
+    """
+    conf = store_conf()
+    sroot = store_dir()
+    avg = conf["avg_chunk_kib"] * 1024
+    min_size = conf["min_chunk_kib"] * 1024
+    max_size = conf["max_chunk_kib"] * 1024
+    started = time.time()
+    with _store_lock():
+        index = _load_json(sroot / "index.json", {})
+        last = _load_json(sroot / "last_files.json", {})
+        previous = dict(last)
+        writer = PackWriter(sroot, index, conf["level"], conf["pack_mib"] * 1024 * 1024)
+        files = []
+        bytes_in = 0
+        for p in _walk(root, inputs):
+            if p.is_symlink() or not p.is_file():
+                logger.debug("跳过非普通文件: %s", p)
+                continue
+            st = p.stat()
+            rel = p.relative_to(root).as_posix()
+            prev = last.get(rel)
+            if prev and prev["size"] == st.st_size and prev["mtime"] == st.st_mtime_ns \
+                    and all(c in index for c in prev["chunks"]):
+                chunks = prev["chunks"]
+            else:
+                chunks = []
+                with p.open("rb") as f:
+                    for data in iter_chunks(f, avg, min_size, max_size):
+                        chunk_id = hashlib.sha256(data).hexdigest()
+                        writer.add(chunk_id, data)
+                        chunks.append(chunk_id)
+                bytes_in += st.st_size
+            entry = {"path": rel, "size": st.st_size, "mtime": st.st_mtime_ns, "mode": st.st_mode & 0o7777, "chunks": chunks}
+            files.append(entry)
+            previous[rel] = entry
+        writer.seal()
+        _save_json(sroot / "index.json", index)
+        _save_json(sroot / "last_files.json", previous)
+
+        name = f"mc_{kind}_snapshot_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+        packs = sorted({index[c][0] for e in files for c in e["chunks"]})
+        snapshot = {
+            "name": name,
+            "created": time.time(),
+            "kind": kind,
+            "root": str(root),
+            "inputs": list(inputs),
+            "files": files,
+            "packs": packs,
+            "locations": {c: index[c] for e in files for c in e["chunks"]}
+        }
+        path = sroot / "snapshots" / name
+        _save_json(path, snapshot)
+    logger.info("块存储快照完成: %s，文件 %d 个，读取 %.1f MiB，新增 pack %d 个 (%.1f MiB)，耗时 %.1fs",
+                name, len(files), bytes_in / 1048576, len(writer.new_packs), writer.new_bytes / 1048576,
+                time.time() - started)
+    add("bytes_in", bytes_in)
+    add("bytes_out", writer.new_bytes)
+    return str(path)
+
+@timed("compress")
+def snapshot_full() -> str:
+    server_dir = Path(cfg["server"]["server_dir"])
+    return create_snapshot("full", server_dir.parent, [server_dir.name])
+
+@timed("compress")
+def snapshot_worlds(root=None) -> str:
+    server_dir = Path(root or cfg["server"]["server_dir"])
+    world_folders = cfg["server"].get("world_folders", ["world"])
+    inputs = [w for w in world_folders if (server_dir / w).exists()]
+    if not inputs:
+        raise FileNotFoundError("未找到世界文件夹，请检查 config.json 中的设置")
+    return create_snapshot("world", server_dir, inputs)
+
+def read_chunk(chunk_id: str, index=None) -> bytes:
+    sroot = store_dir()
+    index = index if index is not None else _load_json(sroot / "index.json", {})
+    pack, offset, length, compressed = index[chunk_id]
+    with open(sroot / "packs" / pack, "rb") as f:
+        f.seek(offset)
+        data = f.read(length)
+    return zlib.decompress(data) if compressed else data
+
+def remote_packs() -> dict:
+    """已上传到云端的 pack（回收时随 pack 一起移除，同名 pack 再次生成时会重新上传）"""
+    return _load_json(store_dir() / "remote_packs.json", {})
+
+def mark_remote_pack(name: str):
+    with _store_lock():
+        remote = remote_packs()
+        remote[name] = int(time.time())
+        _save_json(store_dir() / "remote_packs.json", remote)
+
+def list_snapshots():
+    return sorted(p.name for p in (store_dir() / "snapshots").glob("mc_*_snapshot_*.json"))
+
+def delete_snapshot(name: str):
+    path = store_dir() / "snapshots" / name
+    if path.exists():
+        path.unlink()
+        logger.info("删除块存储快照: %s", name)
+
+def gc(dry_run=False):
+    """
+    删除不再被任何快照引用的块。仅当一个 pack 内的块全部失效时才删除该 pack，
+    部分失效的 pack 保留原样（不做重新打包）。返回被删除的 pack 名列表。
+    """
+    sroot = store_dir()
+    with _store_lock():
+        index = _load_json(sroot / "index.json", {})
+        live = set()
+        for name in list_snapshots():
+            snap = _load_json(sroot / "snapshots" / name, {})
+            for e in snap.get("files", []):
+                live.update(e["chunks"])
+        live_packs = {index[c][0] for c in live if c in index}
+        dead_packs = sorted({v[0] for v in index.values()} - live_packs)
+        if dry_run:
+            return dead_packs
+        for pack in dead_packs:
+            try:
+                (sroot / "packs" / pack).unlink()
+            except FileNotFoundError:
+                pass
+        # pack 以内容哈希命名，之后的快照可能生成同名 pack；云端副本随后会被移入回收站，不能再视为已上传
+        remote = _load_json(sroot / "remote_packs.json", {})
+        if remote.keys() & set(dead_packs):
+            _save_json(sroot / "remote_packs.json", {k: v for k, v in remote.items() if k not in dead_packs})
+        index = {c: v for c, v in index.items() if v[0] in live_packs}
+        _save_json(sroot / "index.json", index)
+        last = _load_json(sroot / "last_files.json", {})
+        last = {k: v for k, v in last.items() if all(c in index for c in v["chunks"])}
+        _save_json(sroot / "last_files.json", last)
+    if dead_packs:
+        logger.info("块存储回收: 删除 pack %d 个", len(dead_packs))
+    return dead_packs
@@ -1,36 +1,162 @@
+import os
 import subprocess
+import json
 import datetime
+import time
+from glob import glob
 from pathlib import Path
 from log_api import logger
 from config import cfg
+from state_api import state_dir
+from incr_api import plan_incremental, commit_plan
+from zstd_api import compress_tar_zstd
+from metrics_api import timed, add
 
 # --- 压缩模块 ---
+def compress_engine():
+    """server.compress_engine: 7z（外部命令）或 zstd（进程内 tar+zstd）"""
+    return cfg["server"].get("compress_engine", "7z")
+
 def make_filename(prefix="mc_backup"):
-    return f"{prefix}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.7z"
+    ext = ".tar.zst" if compress_engine() == "zstd" else ".7z"
+    return f"{prefix}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}{ext}"
+
+def volume_switch():
+    return f"-v{cfg['server'].get('volume_size', '8g')}"
+
+def volume_parts(dest):
+    """按分卷序号排序返回 dest.001、dest.002 ..."""
+    parts = [p for p in glob(str(dest) + ".*") if p.rsplit(".", 1)[-1].isdigit()]
+    return sorted(parts, key=lambda p: int(p.rsplit(".", 1)[-1]))
+
+def _tree_size(paths) -> int:
+    total = 0
+    for p in paths:
+        p = Path(p)
+        if p.is_file():
+            total += p.stat().st_size
+            continue
+        for dirpath, _, filenames in os.walk(p):
+            for name in filenames:
+                try:
+                    total += os.lstat(os.path.join(dirpath, name)).st_size
+                except OSError:
+                    pass
+    return total
 
-def compress_full():
+def record_sizes(dest, inputs):
+    """记录 7z 压缩的输入与输出字节数（zstd 引擎在压缩过程中自行统计）"""
+    add("bytes_in", _tree_size(inputs))
+    add("bytes_out", sum(Path(p).stat().st_size for p in volume_parts(dest) if Path(p).exists()))
+
+def run_compress(cmd, dest, on_volume=None, cwd=None):
+    """
+    执行压缩命令。提供 on_volume 时，每个分卷一旦写完就立即回调，
+    使上传与后续分卷的压缩重叠进行。
+    7z 会在结束时回写第一个分卷开头的签名头，所以 .001 总是最后交付。
+    （zstd 引擎由 VolumeWriter 在分卷写完时直接回调，不经过这里。）
+    """
+    if on_volume is None:
+        subprocess.check_call(cmd, cwd=cwd)
+        return
+    handed = set()
+    proc = subprocess.Popen(cmd, cwd=cwd)
+    while proc.poll() is None:
+        # 最后一个分卷仍在写入；中间的分卷在下一个分卷出现后即已定稿
+        for p in volume_parts(dest)[1:-1]:
+            if p not in handed:
+                handed.add(p)
+                on_volume(p)
+        time.sleep(2)
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+    parts = volume_parts(dest)
+    for p in parts[1:] + parts[:1]:
+        if p not in handed:
+            handed.add(p)
+            on_volume(p)
+
+@timed("compress")
+def compress_full(on_volume=None):
     out = Path(cfg["server"]["backup_dir"])
     out.mkdir(parents=True, exist_ok=True)
     fname = make_filename("mc_full_backup")
     dest = out / fname
-    cmd = [cfg["server"]["compress_cmd"]] + cfg["server"]["compress_args"] + ["-v8g", str(dest), cfg["server"]["server_dir"]]
-    logger.info("执行冷备份压缩: %s", " ".join(cmd))
-    subprocess.check_call(cmd)
+    if compress_engine() == "zstd":
+        server_dir = Path(cfg["server"]["server_dir"])
+        compress_tar_zstd(dest, server_dir.parent, [server_dir.name], on_volume)
+    else:
+        cmd = [cfg["server"]["compress_cmd"]] + cfg["server"]["compress_args"] + [volume_switch(), str(dest), cfg["server"]["server_dir"]]
+        logger.info("执行冷备份压缩: %s", " ".join(cmd))
+        run_compress(cmd, dest, on_volume)
+        record_sizes(dest, [cfg["server"]["server_dir"]])
     logger.info("压缩完成: %s", dest)
     return str(dest)
 
-def compress_worlds():
+@timed("compress")
+def compress_worlds(on_volume=None, root=None):
+    """root 可指向暂存快照目录，默认为服务器目录"""
     out = Path(cfg["server"]["backup_dir"])
     out.mkdir(parents=True, exist_ok=True)
     fname = make_filename("mc_world_backup")
     dest = out / fname
-    server_dir = Path(cfg["server"]["server_dir"])
+    server_dir = Path(root or cfg["server"]["server_dir"])
     world_folders = cfg["server"].get("world_folders", ["world"])
-    inputs = [str(server_dir / w) for w in world_folders if (server_dir / w).exists()]
+    inputs = [w for w in world_folders if (server_dir / w).exists()]
     if not inputs:
         raise FileNotFoundError("未找到世界文件夹，请检查 config.json 中的设置")
-    cmd = [cfg["server"]["compress_cmd"]] + cfg["server"]["compress_args"] + ["-v8g", str(dest)] + inputs
-    logger.info("执行热备份压缩: %s", " ".join(cmd))
-    subprocess.check_call(cmd)
+    if compress_engine() == "zstd":
+        compress_tar_zstd(dest, server_dir, inputs, on_volume)
+    else:
+        cmd = [cfg["server"]["compress_cmd"]] + cfg["server"]["compress_args"] + [volume_switch(), str(dest)] + [str(server_dir / w) for w in inputs]
+        logger.info("执行热备份压缩: %s", " ".join(cmd))
+        run_compress(cmd, dest, on_volume)
+        record_sizes(dest, [server_dir / w for w in inputs])
     logger.info("世界文件夹压缩完成: %s", dest)
-    return str(dest)
\ No newline at end of file
+    return str(dest)
+
+@timed("compress")
+def compress_worlds_incremental(on_volume=None, root=None):
+    """
+    增量热备份：定期做一次全量，其余时间只压缩自上次备份以来变化的文件。
+    增量包旁边附带 .manifest.json，记录基准、上一次备份与被删除的文件。
+    无任何变化时返回 None。
+    """
+    server_dir = Path(root or cfg["server"]["server_dir"])
+    world_folders = cfg["server"].get("world_folders", ["world"])
+    plan = plan_incremental(server_dir, world_folders)
+    if plan["kind"] == "full":
+        logger.info("执行增量链的全量基准备份")
+        dest = compress_worlds(on_volume, root)
+        commit_plan(plan, Path(dest).name)
+        return dest
+    if not plan["changed"] and not plan["deleted"]:
+        logger.info("世界文件自上次备份以来没有变化，跳过本次增量备份")
+        return None
+
+    out = Path(cfg["server"]["backup_dir"])
+    out.mkdir(parents=True, exist_ok=True)
+    dest = out / make_filename("mc_incr_backup")
+    manifest = Path(str(dest) + ".manifest.json")
+    manifest.write_text(json.dumps({
+        "type": "incremental",
+        "base": plan["base"],
+        "parent": plan["parent"],
+        "changed": plan["changed"],
+        "deleted": plan["deleted"],
+        "chunks": plan["chunks"]
+    }, ensure_ascii=False, indent=2), encoding="utf-8")
+    if plan["changed"] and compress_engine() == "zstd":
+        compress_tar_zstd(dest, server_dir, plan["changed"], on_volume)
+    elif plan["changed"]:
+        list_file = state_dir() / "incr_list.txt"
+        list_file.write_text("\n".join(plan["changed"]) + "\n", encoding="utf-8")
+        cmd = [cfg["server"]["compress_cmd"]] + cfg["server"]["compress_args"] + ["-scsUTF-8", volume_switch(), str(dest), f"@{list_file}"]
+        logger.info("执行增量压缩 (%d 个文件): %s", len(plan["changed"]), " ".join(cmd))
+        run_compress(cmd, dest, on_volume, cwd=str(server_dir))
+        record_sizes(dest, [server_dir / p for p in plan["changed"]])
+    if on_volume:
+        on_volume(str(manifest))
+    commit_plan(plan, dest.name)
+    logger.info("增量压缩完成: %s", dest)
+    return str(dest)
@@ -1,34 +1,60 @@
+import os
 import json
+import threading
+from contextlib import contextmanager
 from pathlib import Path
 import sys
 
 # --- 配置部分 ---
 VERSION = "2.1.1"
 
-CONFIG_PATH = Path(__file__).parent / "config.json"
+# 可用环境变量 MCBACKUP_CONFIG 指定其他配置文件（如基准测试）
+CONFIG_PATH = Path(os.environ.get("MCBACKUP_CONFIG") or Path(__file__).parent / "config.json")
 DEFAULT_CONFIG = {
     "mcsmanager": {
         "base_url": "http://panel.example.com",
         "apikey": "YOUR_MCSM_APIKEY",
         "daemonId": "",
-        "instance_uuid": ""
+        "instance_uuid": "",
+        "stop_timeout": 120,
+        "start_timeout": 300,
+        "save_timeout": 60,
+        "poll_interval": 1
     },
     "server": {
         "server_dir": "/home/mc/server",
         "backup_dir": "/home/mc/backups",
         "compress_cmd": "7z",
         "compress_args": ["a", "-mx=6", "-mmt=on"],
-        "world_folders": ["world", "world_nether", "world_the_end"]
+        "compress_engine": "7z",
+        "compress_threads": 0,
+        "zstd_level": 3,
+        "volume_size": "8g",
+        "world_folders": ["world", "world_nether", "world_the_end"],
+        "snapshot_dir": "",
+        "snapshot_workers": 8
     },
     "123pan_http": {
         "api_base_url": "https://open-api.123pan.com",
         "client_id": "YOUR_CLIENT_ID",
         "client_secret": "YOUR_CLIENT_SECRET",
-        "parent_folder_id": 0
+        "parent_folder_id": 0,
+        "upload_concurrency": 4,
+        "slice_retries": 3,
+        "token_refresh_margin": 3600,
+        "queue_workers": 1,
+        "queue_order": "newest_first",
+        "client": "requests",
+        "pool_size": 32,
+        "download_workers": 4,
+        "download_block_mib": 8
     },
     "schedule": {
         "times": ["03:00"],
-        "timezone": "Asia/Shanghai"
+        "timezone": "Asia/Shanghai",
+        "verify_times": [],
+        "compress_per_disk": 1,
+        "max_compress": 2
     },
     "logging": {
         "log_file": "mc_backup.log",
@@ -39,8 +65,43 @@ DEFAULT_CONFIG = {
         "mode": "cold",
         "keep_days": 7,
         "keep_count": 10,
-        "storage": "both"
-    }
+        "storage": "both",
+        "pipeline": True,
+        "incremental": False,
+        "full_every_days": 7,
+        "engine": "7z",
+        "snapshot": False,
+        "retention": False,
+        "retention_dry_run": False,
+        "verify": True,
+        "skip_unchanged": True,
+        "change_ignore": ["logs", "crash-reports", "cache", "*.lock", "*.log", "*.log.gz", "level.dat", "level.dat_old"],
+        "hash_max_mib": 256,
+        "downgrade_mib": 0,
+        "defer_on_players": False,
+        "defer_max_minutes": 60,
+        "defer_poll_seconds": 60
+    },
+    "chunk_store": {
+        "avg_chunk_kib": 1024,
+        "min_chunk_kib": 256,
+        "max_chunk_kib": 8192,
+        "pack_mib": 64,
+        "level": 6
+    },
+    "bandwidth": {
+        "limit_kib": 0,
+        "profiles": [],
+        "adaptive": False,
+        "rtt_factor": 2.0,
+        "min_kib": 256,
+        "increase_kib": 256,
+        "probe_interval": 5
+    },
+    "metrics": {
+        "textfile": ""
+    },
+    "instances": []
 }
 
 def ensure_config():
@@ -52,4 +113,64 @@ def ensure_config():
 
 ensure_config()
 
-cfg = json.load(open(CONFIG_PATH, "r", encoding="utf-8"))
\ No newline at end of file
+# --- 多实例 ---
+# instances 中每一项包含 name、可选的 disk，以及要覆盖的配置段（mcsmanager / server / backup 等）。
+# 线程通过 use_instance() 选中实例后，cfg 中对应的配置段返回合并后的结果。
+# 未单独指定时，backup_dir / snapshot_dir / chunk_store.dir 取全局值下以实例名命名的子目录。
+PER_INSTANCE_DIRS = (("server", "backup_dir"), ("server", "snapshot_dir"), ("chunk_store", "dir"))
+_local = threading.local()
+
+class Config(dict):
+    def _overlay(self, key, value):
+        sections = getattr(_local, "sections", None)
+        if sections and key in sections and isinstance(value, dict):
+            merged = dict(value)
+            merged.update(sections[key])
+            return merged
+        return value
+
+    def __getitem__(self, key):
+        return self._overlay(key, dict.__getitem__(self, key))
+
+    def get(self, key, default=None):
+        return self._overlay(key, dict.get(self, key, default))
+
+    def base(self, key, default=None):
+        """不受当前实例影响的全局配置段"""
+        return dict.get(self, key, default)
+
+def instance_list():
+    return [i for i in cfg.base("instances", []) if i.get("name")]
+
+def find_instance(name):
+    for inst in instance_list():
+        if inst["name"] == name:
+            return inst
+    raise KeyError(f"未配置的实例: {name}")
+
+def _instance_sections(inst):
+    sections = {k: dict(v) for k, v in inst.items() if isinstance(v, dict)}
+    for section, key in PER_INSTANCE_DIRS:
+        value = (cfg.base(section) or {}).get(key)
+        if value and key not in sections.get(section, {}):
+            sections.setdefault(section, {})[key] = str(Path(value) / inst["name"])
+    return sections
+
+def current_instance():
+    """当前线程选中的实例名，未选中时为 None"""
+    return getattr(_local, "name", None)
+
+@contextmanager
+def use_instance(name):
+    """在当前线程内以实例 name 的配置运行；name 为 None 时使用全局配置"""
+    previous = (getattr(_local, "name", None), getattr(_local, "sections", None))
+    if name is None:
+        _local.name, _local.sections = None, None
+    else:
+        _local.name, _local.sections = name, _instance_sections(find_instance(name))
+    try:
+        yield
+    finally:
+        _local.name, _local.sections = previous
+
+cfg = Config(json.load(open(CONFIG_PATH, "r", encoding="utf-8")))
\ No newline at end of file
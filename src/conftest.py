@@ -0,0 +1,20 @@
+import os
+import json
+import tempfile
+from pathlib import Path
+
+# --- 测试配置 ---
+# config 在导入时读取配置文件，这里在任何模块导入之前指向临时目录中的最小配置，
+# 测试不会读写 src/config.json 或真实的备份目录。
+_work = Path(tempfile.mkdtemp(prefix="mcbackup-test-"))
+_config = _work / "config.json"
+_config.write_text(json.dumps({
+    "mcsmanager": {"base_url": "http://127.0.0.1:1", "apikey": "test", "instance_uuid": "test"},
+    "server": {"server_dir": str(_work / "server"), "backup_dir": str(_work / "backups"),
+               "compress_cmd": "7z", "compress_args": ["a"], "world_folders": ["world"]},
+    "123pan_http": {"api_base_url": "http://127.0.0.1:1", "client_id": "test", "client_secret": "test"},
+    "schedule": {"times": [], "timezone": "Asia/Shanghai"},
+    "logging": {"log_file": str(_work / "mc_backup.log"), "max_bytes": 1000000, "backup_count": 1},
+    "backup": {"keep_days": 7, "keep_count": 10, "verify": False}
+}), encoding="utf-8")
+os.environ["MCBACKUP_CONFIG"] = str(_config)
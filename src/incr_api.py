@@ -0,0 +1,120 @@
+import os
+import time
+import struct
+import hashlib
+from pathlib import Path
+from log_api import logger
+from config import cfg
+from state_api import load_state, save_state
+
+# --- 增量备份索引 ---
+INDEX_FILE = "world_index.json"
+HASH_BUFFER = 4 * 1024 * 1024
+# Anvil 区域文件头：4 KiB 区块位置表 + 4 KiB 区块时间戳表（1024 个大端 int32）
+MCA_HEADER_SIZE = 8192
+
+def hash_file(path: Path) -> str:
+    h = hashlib.md5()
+    buf = bytearray(HASH_BUFFER)
+    view = memoryview(buf)
+    with path.open("rb") as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            h.update(view[:n])
+    return h.hexdigest()
+
+def read_mca_timestamps(path: Path):
+    """读取区域文件头中的 1024 个区块时间戳，文件不完整时返回 None"""
+    with path.open("rb") as f:
+        header = f.read(MCA_HEADER_SIZE)
+    if len(header) < MCA_HEADER_SIZE:
+        return None
+    return list(struct.unpack(">1024I", header[4096:]))
+
+def iter_world_files(root: Path, world_folders):
+    for w in world_folders:
+        base = root / w
+        if not base.exists():
+            continue
+        for dirpath, _, filenames in os.walk(base):
+            for name in filenames:
+                p = Path(dirpath) / name
+                yield p.relative_to(root).as_posix(), p
+
+def scan_worlds(root: Path, world_folders, prev_files: dict):
+    """
+    对比上次索引，返回 (新索引, 变化文件列表, 删除文件列表, 区块变化详情)。
+    先比较大小和 mtime；.mca 再比较区块时间戳表；仍无法判断时才计算内容哈希。
+    """
+    files = {}
+    changed = []
+    chunk_changes = {}
+    for rel, p in iter_world_files(root, world_folders):
+        try:
+            st = p.stat()
+        except FileNotFoundError:
+            continue
+        entry = {"size": st.st_size, "mtime": st.st_mtime_ns, "hash": None}
+        prev = prev_files.get(rel)
+        if prev and prev["size"] == st.st_size and prev["mtime"] == st.st_mtime_ns:
+            files[rel] = prev
+            continue
+
+        is_changed = True
+        if rel.endswith(".mca"):
+            entry["chunks"] = read_mca_timestamps(p)
+            old_ts = prev.get("chunks") if prev else None
+            if entry["chunks"] and old_ts and len(old_ts) == len(entry["chunks"]):
+                diff = [i for i, (a, b) in enumerate(zip(old_ts, entry["chunks"])) if a != b]
+                if diff:
+                    chunk_changes[rel] = diff
+                elif prev["size"] == st.st_size:
+                    # 没有区块被重写，只有内容哈希能确认是否真的变化
+                    entry["hash"] = hash_file(p)
+                    is_changed = entry["hash"] != prev.get("hash")
+        else:
+            entry["hash"] = hash_file(p)
+            if prev and prev.get("hash"):
+                is_changed = entry["hash"] != prev["hash"]
+        files[rel] = entry
+        if is_changed:
+            changed.append(rel)
+    deleted = sorted(set(prev_files) - set(files))
+    return files, changed, deleted, chunk_changes
+
+def plan_incremental(root: Path, world_folders):
+    """
+    决定本次做全量还是增量：没有索引或距离上次全量超过 full_every_days 时做全量。
+    返回计划字典，备份成功后需调用 commit_plan 保存索引。
+    """
+    full_every = cfg.get("backup", {}).get("full_every_days", 7)
+    index = load_state(INDEX_FILE, {})
+    prev_files = index.get("files", {})
+    need_full = not index or time.time() - index.get("last_full", 0) >= full_every * 86400
+    files, changed, deleted, chunk_changes = scan_worlds(root, world_folders, {} if need_full else prev_files)
+    plan = {
+        "kind": "full" if need_full else "incremental",
+        "files": files,
+        "changed": sorted(changed),
+        "deleted": deleted,
+        "chunks": chunk_changes,
+        "base": index.get("base"),
+        "parent": index.get("last"),
+        "last_full": index.get("last_full", 0)
+    }
+    if plan["kind"] == "incremental":
+        logger.info("增量扫描: 变化文件 %d 个（其中区域文件 %d 个，共 %d 个区块），删除文件 %d 个",
+                    len(changed), len(chunk_changes), sum(len(v) for v in chunk_changes.values()), len(deleted))
+    return plan
+
+def commit_plan(plan, backup_name):
+    """备份成功后保存索引，使下一次增量以本次为基准"""
+    index = {
+        "files": plan["files"],
+        "last": backup_name,
+        "base": backup_name if plan["kind"] == "full" else plan["base"],
+        "last_full": time.time() if plan["kind"] == "full" else plan["last_full"]
+    }
+    save_state(INDEX_FILE, index)
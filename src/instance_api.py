@@ -0,0 +1,119 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from config import cfg, current_instance, find_instance, instance_list, use_instance
+from log_api import logger
+from state_api import load_state
+from metrics_api import record
+
+# --- 多实例编排：共享的压缩名额 ---
+# 同一磁盘上最多 schedule.compress_per_disk 个、全局最多 schedule.max_compress 个实例同时压缩。
+# 名额在停服 / save-off 之前取得、压缩结束后立即释放：服务器不会因排队而处于停止状态，
+# 等待服务器启动也不占用名额。等待中的实例按上次压缩耗时从短到长获得名额。
+# 上传由全局上传队列限流（123pan_http.queue_workers）。
+
+def disk_key():
+    """当前实例所在的磁盘：instances[].disk，未配置时取 server_dir 的设备号"""
+    name = current_instance()
+    disk = find_instance(name).get("disk") if name else None
+    if disk:
+        return str(disk)
+    try:
+        return f"dev:{os.stat(cfg['server']['server_dir']).st_dev}"
+    except OSError:
+        return cfg["server"]["server_dir"]
+
+def expected_seconds():
+    """上次成功备份的快照 + 压缩耗时，用作排队优先级；没有记录时为 0"""
+    for run in reversed(load_state("runs.json", [])):
+        if run.get("ok") and not run.get("values", {}).get("skipped"):
+            phases = run.get("phases", {})
+            return phases.get("snapshot", 0) + phases.get("compress", 0)
+    return 0
+
+class CompressBudget:
+    """按磁盘与全局两级计数的压缩名额；资源允许时优先级最高（耗时最短）的等待者先开始"""
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._busy = {}
+        self._total = 0
+        self._waiting = []
+        self._seq = 0
+
+    @staticmethod
+    def _limits():
+        conf = cfg.base("schedule", {})
+        return max(1, int(conf.get("compress_per_disk", 1))), max(1, int(conf.get("max_compress", 2)))
+
+    def _runnable_locked(self, disk):
+        per_disk, total = self._limits()
+        return self._total < total and self._busy.get(disk, 0) < per_disk
+
+    def acquire(self, disk, priority=0):
+        with self._cond:
+            self._seq += 1
+            ticket = (priority, self._seq, disk)
+            self._waiting.append(ticket)
+            while True:
+                runnable = [t for t in self._waiting if self._runnable_locked(t[2])]
+                if runnable and min(runnable) == ticket:
+                    break
+                self._cond.wait()
+            self._waiting.remove(ticket)
+            self._busy[disk] = self._busy.get(disk, 0) + 1
+            self._total += 1
+            # 其他磁盘上的等待者可能仍可开始
+            self._cond.notify_all()
+
+    def release(self, disk):
+        with self._cond:
+            self._busy[disk] -= 1
+            self._total -= 1
+            self._cond.notify_all()
+
+budget = CompressBudget()
+
+@contextmanager
+def compress_slot():
+    """在压缩名额内执行停服/save-off 到压缩结束的部分"""
+    disk = disk_key()
+    started = time.time()
+    budget.acquire(disk, expected_seconds())
+    waited = time.time() - started
+    if waited >= 1:
+        logger.info("等待压缩名额 %.1fs（磁盘 %s）", waited, disk)
+    record("slot_wait_seconds", round(waited, 2))
+    try:
+        yield
+    finally:
+        budget.release(disk)
+
+def schedule_groups():
+    """返回 {"HH:MM": [实例名, ...]}；实例可以在自己的 schedule.times 中覆盖全局时间"""
+    groups = {}
+    for inst in instance_list():
+        with use_instance(inst["name"]):
+            times = cfg["schedule"]["times"]
+        for t in times:
+            groups.setdefault(t, []).append(inst["name"])
+    return groups
+
+def run_instances(fn, names):
+    """每个实例一个线程，在该实例的配置下执行 fn 并等待全部结束；names 为空时直接执行 fn"""
+    if not names:
+        fn()
+        return
+
+    def worker(name):
+        with use_instance(name):
+            try:
+                fn()
+            except Exception as e:
+                logger.exception("实例 %s 执行失败: %s", name, e)
+
+    threads = [threading.Thread(target=worker, args=(n,), name=f"backup-{n}") for n in names]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
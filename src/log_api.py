@@ -1,4 +1,4 @@
-from config import cfg
+from config import cfg, current_instance
 import logging
 from logging.handlers import RotatingFileHandler
 
@@ -11,4 +11,13 @@ handler = RotatingFileHandler(
     backupCount=log_cfg["backup_count"],
     encoding="utf-8"
 )
-handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
\ No newline at end of file
+handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(instance)s%(message)s"))
+
+class InstanceFilter(logging.Filter):
+    """多实例并发备份时在每条日志前标出实例名"""
+    def filter(self, record):
+        name = current_instance()
+        record.instance = f"[{name}] " if name else ""
+        return True
+
+logger.addFilter(InstanceFilter())
\ No newline at end of file
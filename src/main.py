@@ -8,7 +8,17 @@ from log_api import *
 from config import *
 from mcsm_api import *
 from pan_api import *
+from queue_api import *
 from compress_api import *
+from chunk_api import *
+from snapshot_api import *
+from state_api import append_state
+from retention_api import apply_retention
+from metrics_api import begin_run, end_run, record
+from instance_api import compress_slot, schedule_groups, run_instances
+from change_api import plan_backup, settle_manifest
+from verify_api import verify_backups
+from restore_api import restore_main
 
 logger.addHandler(handler)
 logger.info("脚本启动")
@@ -16,52 +26,164 @@ logger.info("脚本启动")
 # --- 主流程 ---
 def do_backup():
     mode = cfg.get("backup", {}).get("mode", "cold")
+    engine = cfg.get("backup", {}).get("engine", "7z")
+    # 先开始记录，备份前检查中的 save-all 与扫描计入本次运行
+    run = begin_run(mode, engine)
+    try:
+        # 备份前检查：没有变化时跳过，冷备份可能改为热备份
+        plan = plan_backup(mode)
+    except Exception:
+        end_run(False)
+        raise
+    run.mode = plan.mode or mode
+    plan.record()
+    if plan.mode is None:
+        plan.commit()
+        end_run(True)
+        return
+    mode = plan.mode
+    # 清单在上传任务成功结束后才生效，上传失败时下次备份仍会检测到这些变化
+    plan.stage(run.id)
+    saving_off = None
+    # 上传全部成功后执行保留策略（需在配置中显式开启）
+    retention = cfg.get("backup", {}).get("retention", False)
+    # 流水线模式：每个分卷压缩完成后立即开始上传
+    session = UploadSession(retention) if engine == "7z" and cfg.get("backup", {}).get("pipeline", True) else None
+    on_volume = session.add if session else None
+    ok = False
     try:
         logger.info("=== 开始备份（模式 %s） ===", mode)
         if mode == "cold":
-            mcs_stop()
-            time.sleep(8)
-            backup_file = compress_full()
+            # 先取得压缩名额再停服，排队期间服务器保持运行；启动等待不占用名额
+            with compress_slot():
+                stopped_at = time.time()
+                mcs_stop()
+                mcs_wait_stopped()
+                if engine == "chunk":
+                    backup_file = snapshot_full()
+                else:
+                    backup_file = compress_full(on_volume)
             mcs_start()
+            running = mcs_wait_running()
+            downtime = time.time() - stopped_at
+            logger.info("冷备份停机时长: %.1fs%s", downtime, "" if running else "（未确认启动完成）")
+            record("downtime_seconds", round(downtime, 2))
+            append_state("downtime.json", {"time": int(stopped_at), "seconds": round(downtime, 1), "confirmed": running})
         elif mode == "hot":
-            mcs_command("save-off")
-            mcs_command("save-all")
-            time.sleep(3)
-            backup_file = compress_worlds()
-            mcs_command("save-on")
+            with compress_slot():
+                mcs_command("save-off")
+                saving_off = time.time()
+                mcs_save_all()
+                root = None
+                if cfg.get("backup", {}).get("snapshot", False):
+                    # 先做快速暂存复制并立即恢复存盘，压缩在 save-on 之后对快照进行
+                    root = take_snapshot()
+                    mcs_command("save-on")
+                    logger.info("save-off 窗口: %.1fs", time.time() - saving_off)
+                    record("save_off_seconds", round(time.time() - saving_off, 2))
+                    saving_off = None
+                try:
+                    if engine == "chunk":
+                        backup_file = snapshot_worlds(root)
+                    elif cfg.get("backup", {}).get("incremental", False):
+                        backup_file = compress_worlds_incremental(on_volume, root)
+                    else:
+                        backup_file = compress_worlds(on_volume, root)
+                finally:
+                    if root:
+                        remove_snapshot()
+                if saving_off:
+                    mcs_command("save-on")
+                    logger.info("save-off 窗口: %.1fs", time.time() - saving_off)
+                    record("save_off_seconds", round(time.time() - saving_off, 2))
+                    saving_off = None
         else:
             raise ValueError(f"未知备份模式: {mode}")
-        async_upload(backup_file)
-        logger.info("备份任务触发，上传在后台执行")
+        job_id = None
+        if session:
+            session.close()
+            job_id = session.job_id
+        elif engine == "chunk":
+            job_id = async_upload_snapshot(backup_file, retention)
+        elif backup_file:
+            job_id = async_upload(backup_file, retention)
+        if job_id is None:
+            # 没有需要上传的文件，清单立即生效
+            settle_manifest(run.id, True)
+        else:
+            logger.info("备份任务触发，上传已加入后台队列")
+        ok = True
     except Exception as e:
         logger.exception("备份流程失败: %s", e)
+        settle_manifest(run.id, False)
+        if session:
+            session.abort()
         if mode == "cold":
             try:
                 mcs_start()
             except Exception:
                 logger.error("重启服务器失败，请人工检查")
+        if saving_off:
+            try:
+                mcs_command("save-on")
+            except Exception:
+                logger.error("恢复自动存盘失败，请人工执行 save-on")
+    finally:
+        end_run(ok)
 
 # --- 定时任务注册 ---
 def register_jobs():
     tz = pytz.timezone(cfg["schedule"]["timezone"])
     sched = BlockingScheduler(timezone=tz)
-    for t in cfg["schedule"]["times"]:
+    groups = schedule_groups() or {t: [] for t in cfg["schedule"]["times"]}
+    for t, names in groups.items():
+        hh, mm = t.split(":")
+        trigger = CronTrigger(hour=int(hh), minute=int(mm), timezone=tz)
+        # 同一时间点的实例一起启动，通过共享的压缩名额排队
+        sched.add_job(run_instances, trigger, args=[do_backup, names])
+        logger.info("已注册每日 %s:%s 备份任务（时区 %s）%s", hh, mm, cfg["schedule"]["timezone"],
+                    f"，实例: {', '.join(names)}" if names else "")
+    for t in cfg["schedule"].get("verify_times", []):
         hh, mm = t.split(":")
         trigger = CronTrigger(hour=int(hh), minute=int(mm), timezone=tz)
-        sched.add_job(do_backup, trigger)
-        logger.info("已注册每日 %s:%s 备份任务（时区 %s）", hh, mm, cfg["schedule"]["timezone"])
+        sched.add_job(run_instances, trigger, args=[verify_backups, [i["name"] for i in instance_list()]])
+        logger.info("已注册每日 %s:%s 云端备份校验任务", hh, mm)
     return sched
 
+def selected_instances(args):
+    """命令行指定的实例名，未指定时为全部实例（未配置多实例时为空列表）"""
+    return args or [i["name"] for i in instance_list()]
+
 if __name__ == "__main__":
     if len(sys.argv) > 1 and sys.argv[1] == "run_once":
         # 调试
         logger.setLevel(logging.DEBUG)
-        do_backup()
+        run_instances(do_backup, selected_instances(sys.argv[2:]))
+        wait_uploads()
+    elif len(sys.argv) > 1 and sys.argv[1] == "prune":
+        # 手动执行保留策略，加 --dry-run 只列出将被删除的备份；可在其后指定实例名
+        logger.setLevel(logging.INFO)
+        logger.addHandler(logging.StreamHandler())
+        dry_run = "--dry-run" in sys.argv[2:]
+        names = selected_instances([a for a in sys.argv[2:] if a != "--dry-run"])
+        run_instances(lambda: apply_retention(dry_run=dry_run), names)
+    elif len(sys.argv) > 1 and sys.argv[1] == "verify":
+        # 只用元数据接口核对云端备份；可在其后指定实例名
+        logger.setLevel(logging.INFO)
+        logger.addHandler(logging.StreamHandler())
+        run_instances(verify_backups, selected_instances(sys.argv[2:]))
+    elif len(sys.argv) > 1 and sys.argv[1] == "restore":
+        # 从云端恢复备份，不带参数时列出可恢复的备份
+        logger.setLevel(logging.INFO)
+        logger.addHandler(logging.StreamHandler())
+        sys.exit(restore_main(sys.argv[2:]))
     else:
         # 正常运行
         logger.setLevel(logging.INFO)
         sched = register_jobs()
         print("mcbackup version",VERSION)
+        # 继续上次退出时未完成的上传
+        resume_uploads()
         logger.info("定时器启动")
         try:
             sched.start()
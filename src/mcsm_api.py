@@ -1,39 +1,143 @@
+import time
 from log_api import logger
 from config import cfg
 from tls_adapter import _http
+from metrics_api import timed
 
 # --- MCSManager API 配置 ---
-MCS_BASE = cfg["mcsmanager"]["base_url"].rstrip("/")
-MCS_APIKEY = cfg["mcsmanager"]["apikey"]
-DAEMON_ID = cfg["mcsmanager"].get("daemonId")
-INSTANCE_UUID = cfg["mcsmanager"]["instance_uuid"]
+# 面板地址与实例 ID 每次调用时从 cfg 读取，多实例时随当前线程选中的实例变化
 HEADERS = {"X-Requested-With": "XMLHttpRequest", "Content-Type": "application/json; charset=utf-8"}
 
+# 实例状态码（MCSManager）: -1 忙碌, 0 停止, 1 停止中, 2 启动中, 3 运行中
+STATUS_STOPPED = 0
+STATUS_RUNNING = 3
+
 def mcs_request(path, method="GET", params=None, json_body=None):
-    url = f"{MCS_BASE}{path}"
+    conf = cfg["mcsmanager"]
+    url = f"{conf['base_url'].rstrip('/')}{path}"
     params = params or {}
-    params["apikey"] = MCS_APIKEY
+    params["apikey"] = conf["apikey"]
     r = _http.request(method, url, params=params, json=json_body, headers=HEADERS, timeout=30)
     r.raise_for_status()
     return r.json()
 
+def _instance_params():
+    conf = cfg["mcsmanager"]
+    params = {"uuid": conf["instance_uuid"]}
+    if conf.get("daemonId"):
+        params["daemonId"] = conf["daemonId"]
+    return params
+
+@timed("stop")
 def mcs_stop():
     logger.info("停止 MC 服务器")
-    params = {"uuid": INSTANCE_UUID}
-    if DAEMON_ID:
-        params["daemonId"] = DAEMON_ID
-    return mcs_request("/api/protected_instance/stop", method="GET", params=params)
+    return mcs_request("/api/protected_instance/stop", method="GET", params=_instance_params())
 
+@timed("start")
 def mcs_start():
     logger.info("启动 MC 服务器")
-    params = {"uuid": INSTANCE_UUID}
-    if DAEMON_ID:
-        params["daemonId"] = DAEMON_ID
-    return mcs_request("/api/protected_instance/open", method="GET", params=params)
+    return mcs_request("/api/protected_instance/open", method="GET", params=_instance_params())
 
 def mcs_command(cmd):
     logger.info("发送命令到 MC 控制台: %s", cmd)
-    params = {"uuid": INSTANCE_UUID, "command": cmd}
-    if DAEMON_ID:
-        params["daemonId"] = DAEMON_ID
-    return mcs_request("/api/protected_instance/command", method="GET", params=params)
\ No newline at end of file
+    params = _instance_params()
+    params["command"] = cmd
+    return mcs_request("/api/protected_instance/command", method="GET", params=params)
+
+def mcs_instance_info():
+    return mcs_request("/api/instance", method="GET", params=_instance_params()).get("data") or {}
+
+def mcs_status() -> int:
+    return int(mcs_instance_info().get("status"))
+
+def mcs_players():
+    """当前在线玩家数；面板未提供（如 -1）时返回 None"""
+    info = mcs_instance_info().get("info") or {}
+    try:
+        players = int(info.get("currentPlayers"))
+    except (TypeError, ValueError):
+        return None
+    return players if players >= 0 else None
+
+def mcs_output_log() -> str:
+    return mcs_request("/api/protected_instance/outputlog", method="GET", params=_instance_params()).get("data") or ""
+
+def mcs_wait_status(target: int, timeout: float) -> float:
+    """轮询实例状态直到等于 target，返回等待的秒数；超时抛出 TimeoutError"""
+    interval = cfg["mcsmanager"].get("poll_interval", 1)
+    started = time.time()
+    while True:
+        status = mcs_status()
+        if status == target:
+            return time.time() - started
+        if time.time() - started > timeout:
+            raise TimeoutError(f"等待实例状态 {target} 超时 ({timeout}s)，当前状态 {status}")
+        time.sleep(interval)
+
+def _new_output(baseline: str, current: str):
+    """
+    返回 current 中 baseline 之后新增的日志；日志缓冲区滚动过时按 baseline 末尾定位，
+    定位不到时返回 None（无法区分新旧输出，不能把整个缓冲区当作新日志）
+    """
+    if current.startswith(baseline):
+        return current[len(baseline):]
+    anchor = baseline[-200:]
+    i = current.rfind(anchor) if anchor else -1
+    return current[i + len(anchor):] if i >= 0 else None
+
+@timed("stop")
+def mcs_wait_stopped():
+    """等待服务器真正停止；面板不支持状态查询时退回到固定等待"""
+    timeout = cfg["mcsmanager"].get("stop_timeout", 120)
+    try:
+        waited = mcs_wait_status(STATUS_STOPPED, timeout)
+        logger.info("服务器已停止，等待 %.1fs", waited)
+    except TimeoutError:
+        raise
+    except Exception as e:
+        logger.warning("查询实例状态失败，改为固定等待 8s: %s", e)
+        time.sleep(8)
+
+@timed("start")
+def mcs_wait_running():
+    timeout = cfg["mcsmanager"].get("start_timeout", 300)
+    try:
+        waited = mcs_wait_status(STATUS_RUNNING, timeout)
+        logger.info("服务器已启动，等待 %.1fs", waited)
+        return True
+    except Exception as e:
+        logger.warning("未能确认服务器已启动: %s", e)
+        return False
+
+@timed("save_all")
+def mcs_save_all():
+    """
+    发送 save-all 并等待控制台输出存盘完成的提示（如 "Saved the game"）；
+    无法读取控制台日志时退回到固定等待。
+    """
+    timeout = cfg["mcsmanager"].get("save_timeout", 60)
+    interval = cfg["mcsmanager"].get("poll_interval", 1)
+    markers = cfg["mcsmanager"].get("save_markers", ["Saved the game", "Save complete"])
+    try:
+        baseline = mcs_output_log()
+    except Exception as e:
+        logger.warning("读取控制台日志失败，改为固定等待 3s: %s", e)
+        mcs_command("save-all")
+        time.sleep(3)
+        return
+    mcs_command("save-all")
+    started = time.time()
+    while time.time() - started <= timeout:
+        time.sleep(interval)
+        current = mcs_output_log()
+        new = _new_output(baseline, current)
+        if new is None:
+            # 缓冲区里可能还留着以前的存盘提示；以当前日志为基线重新发送 save-all，等待它的完成提示
+            logger.info("控制台日志已滚动，无法定位 save-all 之后的输出，重新发送 save-all")
+            baseline = current
+            mcs_command("save-all")
+            continue
+        if any(m in new for m in markers):
+            logger.info("存盘完成，等待 %.1fs", time.time() - started)
+            return
+    raise TimeoutError(f"等待 save-all 完成超时 ({timeout}s)")
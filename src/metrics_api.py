@@ -0,0 +1,268 @@
+import os
+import re
+import threading
+import time
+import datetime
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+from pathlib import Path
+from config import cfg, current_instance, instance_list, use_instance
+from log_api import logger
+from state_api import state_dir, load_state, save_state
+
+# --- 运行指标：每次备份的阶段耗时、字节数、上传统计 ---
+# 备份结束时把运行摘要追加到 .mcbackup/runs.json，并重写 Prometheus textfile
+# （node_exporter 的 textfile collector 可直接读取）。多实例时每个实例的运行摘要写入各自的状态目录，
+# textfile 只有一个，以 instance 标签区分实例。
+LATENCY_WINDOW = 2000
+QUANTILES = (0.5, 0.9, 0.99)
+
+_lock = threading.Lock()
+_runs = {}
+_active = threading.local()
+
+class BackupRun:
+    def __init__(self, mode, engine):
+        self.id = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        self.instance = current_instance()
+        self.mode = mode
+        self.engine = engine
+        self.started = time.time()
+        self.phases = {}
+        self.values = {}
+        self.uploads = []
+
+def _current():
+    return getattr(_active, "run", None)
+
+def begin_run(mode, engine):
+    """开始记录当前线程（实例）的一次备份"""
+    run = BackupRun(mode, engine)
+    with _lock:
+        _runs[(run.instance, run.id)] = run
+    _active.run = run
+    return run
+
+def current_run_id():
+    run = _current()
+    return run.id if run else None
+
+@contextmanager
+def phase(name):
+    """累计当前备份中 name 阶段的耗时；同名阶段嵌套时只计外层"""
+    active = getattr(_active, "names", None)
+    if active is None:
+        active = _active.names = set()
+    if name in active:
+        yield
+        return
+    active.add(name)
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        active.discard(name)
+        elapsed = time.monotonic() - started
+        run = _current()
+        with _lock:
+            if run is not None:
+                run.phases[name] = run.phases.get(name, 0) + elapsed
+
+def timed(name):
+    """装饰器：函数执行时间计入阶段 name"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def record(name, value):
+    run = _current()
+    with _lock:
+        if run is not None:
+            run.values[name] = value
+
+def add(name, value):
+    run = _current()
+    with _lock:
+        if run is not None:
+            run.values[name] = run.values.get(name, 0) + value
+
+def end_run(ok):
+    """结束当前备份，写入运行摘要与 textfile，返回摘要"""
+    run = _current()
+    _active.run = None
+    if run is None:
+        return None
+    with _lock:
+        _runs.pop((run.instance, run.id), None)
+    values = dict(run.values)
+    if values.get("bytes_in") and "bytes_out" in values:
+        values["compression_ratio"] = round(values["bytes_out"] / values["bytes_in"], 4)
+    summary = {
+        "id": run.id,
+        "instance": run.instance,
+        "mode": run.mode,
+        "engine": run.engine,
+        "started": int(run.started),
+        "seconds": round(time.time() - run.started, 2),
+        "ok": bool(ok),
+        "phases": {k: round(v, 2) for k, v in run.phases.items()},
+        "values": values
+    }
+    if run.uploads:
+        summary["uploads"] = run.uploads
+    with _lock:
+        runs = load_state("runs.json", [])
+        runs.append(summary)
+        save_state("runs.json", runs[-200:])
+    logger.info("备份指标: 耗时 %.1fs，阶段 %s", summary["seconds"],
+                ", ".join(f"{k}={v:.1f}s" for k, v in summary["phases"].items()) or "无")
+    write_textfile()
+    return summary
+
+class UploadStats:
+    """进程内累计的上传计数器与最近 LATENCY_WINDOW 个分片的耗时"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {"bytes": 0, "files": 0, "reused": 0, "slices": 0, "slice_retries": 0, "failures": 0}
+        self.latency_sum = 0.0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.last_file = {}
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def slice_done(self, latency):
+        with self._lock:
+            self.counters["slices"] += 1
+            self.latency_sum += latency
+            self.latencies.append(latency)
+
+    def file_done(self, size, seconds, reused=False):
+        with self._lock:
+            self.counters["files"] += 1
+            if reused:
+                self.counters["reused"] += 1
+            else:
+                self.counters["bytes"] += size
+            self.last_file = {"bytes": size, "seconds": round(seconds, 3),
+                              "throughput": round(size / seconds, 1) if seconds > 0 and not reused else 0}
+        write_textfile()
+
+    def quantiles(self):
+        with self._lock:
+            samples = sorted(self.latencies)
+        if not samples:
+            return {}
+        return {q: samples[min(len(samples) - 1, int(q * len(samples)))] for q in QUANTILES}
+
+upload_stats = UploadStats()
+
+def record_upload(run_id, job_summary):
+    """上传任务完成后把上传统计补充到对应备份的运行摘要中"""
+    if run_id is None:
+        return
+    job_summary = dict(job_summary)
+    job_summary["slice_latency"] = {str(q): round(v, 3) for q, v in upload_stats.quantiles().items()}
+    with _lock:
+        # 上传可能在备份流程结束前就已完成
+        run = _runs.get((current_instance(), run_id))
+        if run is not None:
+            run.uploads.append(job_summary)
+            return
+        runs = load_state("runs.json", [])
+        for entry in reversed(runs):
+            if entry.get("id") == run_id:
+                entry.setdefault("uploads", []).append(job_summary)
+                save_state("runs.json", runs)
+                break
+
+def _metric_name(name):
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+def textfile_path() -> Path:
+    path = cfg.base("metrics", {}).get("textfile", "")
+    return Path(path) if path else state_dir(shared=True) / "mcbackup.prom"
+
+def render_textfile():
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            label = ",".join(f'{k}="{v}"' for k, v in labels.items())
+            lines.append(f"{name}{{{label}}} {value}" if label else f"{name} {value}")
+
+    # 同名指标的各实例样本需要写在同一个 HELP/TYPE 之下
+    gauges = {}
+
+    def gauge(name, help_text, samples):
+        gauges.setdefault(name, (help_text, []))[1].extend(samples)
+
+    for name in [i["name"] for i in instance_list()] or [None]:
+        with use_instance(name):
+            runs = load_state("runs.json", [])
+            report = load_state("verify_report.json")
+        base = {"instance": name} if name else {}
+        if report:
+            gauge("mcbackup_verify_timestamp_seconds", "Time of the last cloud verification", [(base, report["time"])])
+            gauge("mcbackup_verify_checked", "Backups checked by the last cloud verification", [(base, report["checked"])])
+            gauge("mcbackup_verify_failed", "Backups that failed the last cloud verification",
+                  [(base, len(report["failed"]))])
+            gauge("mcbackup_verify_unverified", "Cloud backups without a verification manifest",
+                  [(base, len(report["unverified"]))])
+        if not runs:
+            continue
+        last = runs[-1]
+        labels = dict(base, mode=last["mode"], engine=last["engine"])
+        gauge("mcbackup_last_run_timestamp_seconds", "Start time of the last backup run", [(labels, last["started"])])
+        gauge("mcbackup_last_run_success", "1 if the last backup run succeeded", [(labels, int(last["ok"]))])
+        gauge("mcbackup_last_run_duration_seconds", "Wall time of the last backup run", [(labels, last["seconds"])])
+        gauge("mcbackup_last_run_phase_seconds", "Duration of each phase of the last backup run",
+              [(dict(labels, phase=k), v) for k, v in sorted(last["phases"].items())])
+        for k, v in sorted(last["values"].items()):
+            if isinstance(v, (int, float)):
+                gauge(f"mcbackup_last_run_{_metric_name(k)}", f"{k} of the last backup run", [(labels, v)])
+        gauge("mcbackup_runs_failed_recent", "Failed runs among the runs kept in runs.json",
+              [(base, sum(1 for r in runs if not r.get("ok")))])
+    for name, (help_text, samples) in gauges.items():
+        metric(name, "gauge", help_text, samples)
+
+    with upload_stats._lock:
+        counters = dict(upload_stats.counters)
+        latency_sum = upload_stats.latency_sum
+        last_file = dict(upload_stats.last_file)
+    helps = {
+        "bytes": "Bytes uploaded", "files": "Files uploaded", "reused": "Files completed by instant reuse",
+        "slices": "Slices uploaded", "slice_retries": "Slice upload retries", "failures": "Failed file uploads"
+    }
+    for k, v in counters.items():
+        metric(f"mcbackup_upload_{k}_total", "counter", helps[k], [({}, v)])
+    lat = [({"quantile": str(q)}, round(v, 6)) for q, v in upload_stats.quantiles().items()]
+    lines.append("# HELP mcbackup_upload_slice_seconds Slice upload latency")
+    lines.append("# TYPE mcbackup_upload_slice_seconds summary")
+    lines.extend(f'mcbackup_upload_slice_seconds{{quantile="{l["quantile"]}"}} {v}' for l, v in lat)
+    lines.append(f"mcbackup_upload_slice_seconds_sum {round(latency_sum, 6)}")
+    lines.append(f"mcbackup_upload_slice_seconds_count {counters['slices']}")
+    if last_file:
+        metric("mcbackup_last_upload_throughput_bytes", "gauge", "Throughput of the last uploaded file in bytes/s",
+               [({}, last_file["throughput"])])
+    return "\n".join(lines) + "\n"
+
+def write_textfile():
+    """原子写入 textfile，避免 collector 读到半个文件"""
+    try:
+        path = textfile_path()
+        tmp = path.with_name(path.name + ".tmp")
+        text = render_textfile()
+        with _lock:
+            tmp.write_text(text, encoding="utf-8")
+            os.replace(tmp, path)
+    except Exception as e:
+        logger.warning("写入指标文件失败: %s", e)
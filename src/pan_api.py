@@ -1,17 +1,23 @@
 import datetime
+import json
 import threading
 import hashlib
 import math
-from config import cfg
+import uuid
+from config import cfg, current_instance
 from log_api import logger
-from glob import glob
 from tls_adapter import _http
+from state_api import load_state, save_state
+from chunk_api import store_dir, remote_packs, mark_remote_pack
+from bandwidth_api import shaper
+from metrics_api import upload_stats
 from pathlib import Path
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # --- 123pan HTTP API 上传实现 ---
-def get_access_token_http():
-    """正确使用 123pan 开放平台 API 获取 access_token"""
+def _fetch_access_token():
+    """正确使用 123pan 开放平台 API 获取 access_token，返回 (token, 过期时间戳)"""
     conf = cfg["123pan_http"]
     url = f"{conf['api_base_url'].rstrip('/')}/api/v1/access_token"
     body = {
@@ -26,35 +32,168 @@ def get_access_token_http():
     r = _http.post(url, headers=headers, json=body, timeout=30)
     if r.status_code != 200:
         raise RuntimeError(f"token 接口返回 {r.status_code}: {r.text}")
-    resp = r.json()
-    token = resp.get("data", {}).get("accessToken")
+    return parse_token_response(r.json())
+
+def parse_token_response(resp):
+    """从 access_token 接口的返回中取出 (token, 过期时间戳)"""
+    data = resp.get("data") or {}
+    token = data.get("accessToken")
     if not token:
         raise RuntimeError(f"返回中未找到 accessToken: {resp}")
-    return token
+    expires_at = time.time() + 86400
+    expired = data.get("expiredAt")
+    if expired:
+        try:
+            expires_at = datetime.datetime.fromisoformat(str(expired).replace("Z", "+00:00")).timestamp()
+        except ValueError:
+            logger.warning("无法解析 token 过期时间 %s，按 24 小时处理", expired)
+    return token, expires_at
+
+class TokenManager:
+    """
+    access_token 缓存：保存在内存与 .mcbackup/token.json（权限 0600）中，
+    跨备份与进程重启复用，临近过期时主动刷新，接口报告鉴权失败时立即刷新。
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._token = None
+        self._expires_at = 0
+        self._loaded = False
+        self._stale = set()
+
+    def _load(self):
+        self._loaded = True
+        data = load_state("token.json", None, shared=True)
+        if isinstance(data, dict) and data.get("client_id") == cfg["123pan_http"]["client_id"]:
+            self._token = data.get("token")
+            self._expires_at = data.get("expires_at", 0)
+
+    def _valid(self):
+        margin = int(cfg["123pan_http"].get("token_refresh_margin", 3600))
+        return self._token is not None and time.time() < self._expires_at - margin
+
+    def _refresh_locked(self):
+        return self._store_locked(*_fetch_access_token())
+
+    def _store_locked(self, token, expires_at):
+        if self._token and self._token != token:
+            self._stale.add(self._token)
+        self._token, self._expires_at = token, expires_at
+        save_state("token.json", {
+            "client_id": cfg["123pan_http"]["client_id"],
+            "token": token,
+            "expires_at": expires_at
+        }, mode=0o600, shared=True)
+        logger.info("access_token 已刷新，有效期至 %s",
+                    datetime.datetime.fromtimestamp(expires_at).strftime("%Y-%m-%d %H:%M:%S"))
+        return token
+
+    def get(self):
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            if self._valid():
+                return self._token
+            return self._refresh_locked()
+
+    def cached(self):
+        """返回仍在有效期内的缓存 token，没有则返回 None（不发起请求）"""
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            return self._token if self._valid() else None
+
+    def store(self, token, expires_at):
+        """保存由其他客户端（如异步客户端）取得的 token"""
+        with self._lock:
+            return self._store_locked(token, expires_at)
+
+    def refresh(self, stale=None):
+        """作废 stale 并换取新 token；若其他线程已经刷新过则直接返回新 token"""
+        with self._lock:
+            if stale is not None and stale != self._token and self._valid():
+                return self._token
+            return self._refresh_locked()
+
+    def known(self, token):
+        """token 是缓存中的当前 token 或已被替换的旧 token，有效性应由缓存判断"""
+        return token == self._token or token in self._stale
+
+    def resolve(self, token):
+        """调用方持有的 token 已被替换或即将过期时，返回当前有效的 token"""
+        if token is None or self.known(token):
+            return self.get()
+        return token
+
+_tokens = TokenManager()
+
+def get_access_token_http():
+    """返回可用的 access_token（优先使用缓存）"""
+    return _tokens.get()
+
+def _is_auth_failure(r):
+    if r.status_code == 401:
+        return True
+    if r.status_code != 200:
+        return False
+    try:
+        resp = r.json()
+    except ValueError:
+        return False
+    return isinstance(resp, dict) and resp.get("code") == 401
+
+def _authed(method, url, access_token, headers=None, **kwargs):
+    """带 Authorization 头发送请求；token 失效时刷新并重发一次，调用方无需感知"""
+    token = _tokens.resolve(access_token)
+    for attempt in (1, 2):
+        h = {"Authorization": f"Bearer {token}", "Platform": "open_platform"}
+        h.update(headers or {})
+        r = _http.request(method, url, headers=h, **kwargs)
+        if attempt == 1 and _is_auth_failure(r):
+            logger.warning("access_token 已失效，刷新后重试: %s", url)
+            token = _tokens.refresh(token)
+            continue
+        return r
 
 def list_folder_http(access_token, parent_id, limit=100):
-    """列出指定 parent_id 下的文件夹／文件，官方 v2 API"""
+    """列出指定 parent_id 下的全部文件夹／文件（按 lastFileId 翻页，跳过回收站中的项），官方 v2 API"""
+    aio = _aio_client()
+    if aio:
+        return aio.list_folder_aio(access_token, parent_id, limit)
     conf = cfg["123pan_http"]
     url = f"{conf['api_base_url'].rstrip('/')}/api/v2/file/list"
     headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Platform": "open_platform",
         "Content-Type": "application/json"
     }
     params = {"parentFileId": parent_id, "limit": limit}
-    r = _http.get(url, headers=headers, params=params, timeout=30)
-    if r.status_code != 200:
-        raise RuntimeError(f"列出父目录 {parent_id} 失败: {r.status_code}, {r.text}")
-    resp = r.json()
-    return resp.get("data", {}).get("fileList", [])
+    items = []
+    while True:
+        r = _authed("GET", url, access_token, headers=headers, params=params, timeout=30)
+        if r.status_code != 200:
+            raise RuntimeError(f"列出父目录 {parent_id} 失败: {r.status_code}, {r.text}")
+        resp = r.json()
+        data = resp.get("data") or {}
+        page = data.get("fileList") or []
+        items.extend(f for f in page if not (isinstance(f, dict) and f.get("trashed")))
+        last_id = data.get("lastFileId", -1)
+        if last_id in (-1, None) or not page:
+            return items
+        params["lastFileId"] = last_id
 
 def mkdir_http(access_token: str, name: str, parent_id: int) -> int:
+    """创建子目录并写入目录索引缓存"""
+    folder_id = _mkdir_request(access_token, name, parent_id)
+    remember_folder(parent_id, name, folder_id)
+    return folder_id
+
+def _mkdir_request(access_token: str, name: str, parent_id: int) -> int:
+    aio = _aio_client()
+    if aio:
+        return aio.mkdir_aio(access_token, name, parent_id)
     conf = cfg["123pan_http"]
     base = conf["api_base_url"].rstrip("/")
     url = f"{base}/upload/v1/file/mkdir"
     headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Platform": "open_platform",
         "Content-Type": "application/json"
     }
     body = {
@@ -62,7 +201,7 @@ def mkdir_http(access_token: str, name: str, parent_id: int) -> int:
         "parentID": parent_id
     }
     logger.info("创建子目录: 名称=%s, 父目录ID=%s", name, parent_id)
-    r = _http.post(url, headers=headers, json=body, timeout=30)
+    r = _authed("POST", url, access_token, headers=headers, json=body, timeout=30)
     if r.status_code != 200:
         raise RuntimeError(f"创建子目录失败: {r.status_code}, {r.text}")
     resp = r.json()
@@ -86,38 +225,130 @@ def mkdir_http(access_token: str, name: str, parent_id: int) -> int:
     raise RuntimeError(f"mkdir 接口返回 unexpected data type: {resp}")
 
 
+def trash_files_http(access_token: str, file_ids) -> int:
+    """把文件或目录移入回收站，每次请求最多 100 个 ID，返回处理的数量"""
+    conf = cfg["123pan_http"]
+    url = f"{conf['api_base_url'].rstrip('/')}/api/v1/file/trash"
+    headers = {
+        "Content-Type": "application/json"
+    }
+    file_ids = [int(x) for x in file_ids]
+    for i in range(0, len(file_ids), 100):
+        batch = file_ids[i:i + 100]
+        logger.info("移入回收站: %d 个文件/目录", len(batch))
+        r = _authed("POST", url, access_token, headers=headers, json={"fileIDs": batch}, timeout=30)
+        if r.status_code != 200:
+            raise RuntimeError(f"删除文件失败: {r.status_code}, {r.text}")
+        resp = r.json()
+        if resp.get("code") != 0:
+            raise RuntimeError(f"删除文件响应异常: {resp}")
+        forget_folder_ids(batch)
+    return len(file_ids)
+
+def download_url_http(access_token: str, file_id: int) -> str:
+    """获取文件的下载地址（官方 v1 API），地址有时效，过期后需重新获取"""
+    conf = cfg["123pan_http"]
+    url = f"{conf['api_base_url'].rstrip('/')}/api/v1/file/download_info"
+    r = _authed("GET", url, access_token, params={"fileId": int(file_id)}, timeout=30)
+    if r.status_code != 200:
+        raise RuntimeError(f"获取下载地址失败: {r.status_code}, {r.text}")
+    resp = r.json()
+    data = resp.get("data") or {}
+    if resp.get("code") != 0 or not data.get("downloadUrl"):
+        raise RuntimeError(f"获取下载地址响应异常: {resp}")
+    return data["downloadUrl"]
+
+def file_detail_http(access_token: str, file_id: int) -> dict:
+    """获取单个文件的详情（文件名、大小、etag 等），官方 v1 API"""
+    conf = cfg["123pan_http"]
+    url = f"{conf['api_base_url'].rstrip('/')}/api/v1/file/detail"
+    r = _authed("GET", url, access_token, params={"fileID": int(file_id)}, timeout=30)
+    if r.status_code != 200:
+        raise RuntimeError(f"获取文件详情失败: {r.status_code}, {r.text}")
+    resp = r.json()
+    if resp.get("code") != 0:
+        raise RuntimeError(f"获取文件详情响应异常: {resp}")
+    return resp.get("data") or {}
+
+# --- 云端目录索引：缓存 父目录ID -> {名称: 目录ID}，位于 .mcbackup/folders.json ---
+_folder_lock = threading.Lock()
+
+def _folder_entry(f):
+    """兼容 list 接口不同字段名，返回 (名称, ID, 类型)"""
+    name = f.get("filename") or f.get("name")
+    fid = f.get("fileId") or f.get("fileID") or f.get("id") or f.get("fid")
+    try:
+        ftype = int(f.get("type"))
+    except Exception:
+        ftype = None
+    return name, fid, ftype
+
+def cached_folder_id(parent_id: int, name: str):
+    with _folder_lock:
+        return load_state("folders.json", {}, shared=True).get(str(parent_id), {}).get(name)
+
+def remember_folder(parent_id: int, name: str, folder_id: int):
+    with _folder_lock:
+        index = load_state("folders.json", {}, shared=True)
+        index.setdefault(str(parent_id), {})[name] = int(folder_id)
+        save_state("folders.json", index, shared=True)
+
+def forget_folder_ids(ids):
+    """目录被删除（或发现缓存失效）时从索引中移除"""
+    ids = {int(i) for i in ids}
+    with _folder_lock:
+        index = load_state("folders.json", {}, shared=True)
+        changed = False
+        for parent in list(index):
+            if int(parent) in ids:
+                del index[parent]
+                changed = True
+                continue
+            for name, fid in list(index[parent].items()):
+                if fid in ids:
+                    del index[parent][name]
+                    changed = True
+        if changed:
+            save_state("folders.json", index, shared=True)
+
+def refresh_folder_index(access_token: str, parent_id: int) -> dict:
+    """完整翻页列出 parent_id，用其中的子目录重建该父目录的缓存"""
+    folders = {}
+    for f in list_folder_http(access_token, parent_id):
+        if not isinstance(f, dict):
+            logger.warning("跳过 list_folder 返回的非 dict 项: %r", f)
+            continue
+        name, fid, ftype = _folder_entry(f)
+        # type==1 表示文件夹
+        if ftype == 1 and name and fid is not None:
+            try:
+                folders[name] = int(fid)
+            except Exception:
+                logger.warning("找到子目录但其 ID 不能转换为 int: %s", fid)
+    with _folder_lock:
+        index = load_state("folders.json", {}, shared=True)
+        index[str(parent_id)] = folders
+        save_state("folders.json", index, shared=True)
+    logger.debug("父目录 %s 的子目录索引: %s", parent_id, folders)
+    return folders
+
 def get_or_create_date_folder(access_token: str, parent_id: int, date_str: str) -> int:
     """
     在 parent_id 下查找子目录名为 date_str 的目录；如果找到返回其 ID；
     否则创建一个新的目录并返回其 ID。
+    已知的目录直接从本地索引返回，不发起任何请求。
     """
-    # 先列出父目录
+    cached = cached_folder_id(parent_id, date_str)
+    if cached is not None:
+        logger.debug("目录索引命中: %s/%s -> %s", parent_id, date_str, cached)
+        return cached
     try:
-        folder_list = list_folder_http(access_token, parent_id, limit=100)
+        folders = refresh_folder_index(access_token, parent_id)
     except Exception as e:
         logger.warning("列出父目录 %s 失败: %s", parent_id, e)
-        folder_list = None
-
-    if folder_list:
-        logger.debug("父目录 %s 的子目录列表: %s", parent_id, folder_list)
-        for f in folder_list:
-            if not isinstance(f, dict):
-                logger.warning("跳过 list_folder 返回的非 dict 项: %r", f)
-                continue
-            name = f.get("filename") or f.get("name")
-            ftype = f.get("type")
-            try:
-                ftype = int(ftype)
-            except Exception:
-                ftype = None
-            # 如果是目录 (假设 type==1 表示文件夹)
-            if name == date_str and ftype == 1:
-                found_id = f.get("id") or f.get("fileId") or f.get("fid")
-                if found_id is not None:
-                    try:
-                        return int(found_id)
-                    except Exception:
-                        logger.warning("找到子目录但其 ID 不能转换为 int: %s", found_id)
+        folders = {}
+    if date_str in folders:
+        return folders[date_str]
     # 如果没找到，则创建
     try:
         new_folder_id = mkdir_http(access_token, date_str, parent_id)
@@ -127,184 +358,449 @@ def get_or_create_date_folder(access_token: str, parent_id: int, date_str: str)
         logger.error("创建子目录失败: %s", e)
         raise
 
+HASH_BUFFER = 4 * 1024 * 1024
+DEFAULT_SLICE_SIZE = 16 * 1024 * 1024
+_digest_lock = threading.Lock()
+
+def digest_file(file_path: Path, slice_size=None) -> dict:
+    """
+    单次读取同时计算整文件 MD5（etag）与按 slice_size 对齐的各分片 MD5。
+    结果缓存在 .mcbackup/digests.json 中，按路径、大小、mtime 校验，
+    重试和重新运行时不会重复计算同一份数据。
+    """
+    slice_size = slice_size or load_state("digests.json", {}, shared=True).get("slice_size") or DEFAULT_SLICE_SIZE
+    st = file_path.stat()
+    key = str(file_path.resolve())
+    with _digest_lock:
+        entry = load_state("digests.json", {}, shared=True).get("files", {}).get(key)
+    if not entry or entry["size"] != st.st_size or entry["mtime"] != st.st_mtime_ns:
+        entry = {"size": st.st_size, "mtime": st.st_mtime_ns, "etag": None, "slices": {}}
+    if entry["etag"] and str(slice_size) in entry["slices"]:
+        return entry
+
+    file_md5 = hashlib.md5() if not entry["etag"] else None
+    slices = []
+    slice_md5 = hashlib.md5()
+    slice_left = slice_size
+    buf = bytearray(HASH_BUFFER)
+    view = memoryview(buf)
+    with file_path.open("rb") as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            if file_md5:
+                file_md5.update(view[:n])
+            pos = 0
+            while pos < n:
+                take = min(slice_left, n - pos)
+                slice_md5.update(view[pos:pos + take])
+                pos += take
+                slice_left -= take
+                if slice_left == 0:
+                    slices.append(slice_md5.hexdigest())
+                    slice_md5 = hashlib.md5()
+                    slice_left = slice_size
+    if slice_left != slice_size:
+        slices.append(slice_md5.hexdigest())
+    if file_md5:
+        entry["etag"] = file_md5.hexdigest()
+    entry["slices"][str(slice_size)] = slices
+
+    with _digest_lock:
+        cache = load_state("digests.json", {}, shared=True)
+        files = {k: v for k, v in cache.get("files", {}).items() if Path(k).exists()}
+        files[key] = entry
+        cache["files"] = files
+        save_state("digests.json", cache, shared=True)
+    return entry
+
+def remember_slice_size(slice_size):
+    """记录服务器最近返回的 sliceSize，下次计算摘要时直接按它切分"""
+    with _digest_lock:
+        cache = load_state("digests.json", {}, shared=True)
+        if cache.get("slice_size") != slice_size:
+            cache["slice_size"] = slice_size
+            save_state("digests.json", cache, shared=True)
+
 def compute_etag_md5(filepath: Path) -> str:
     """计算文件的 MD5 值作为 etag（如果接口支持这种方式）"""
-    h = hashlib.md5()
-    with filepath.open("rb") as f:
-        for chunk in iter(lambda: f.read(8192), b""):
-            h.update(chunk)
-    return h.hexdigest()
+    return digest_file(filepath)["etag"]
+
+class UploadRejected(RuntimeError):
+    """服务器明确拒绝了本次分片上传任务（而非网络错误）"""
+
+# --- 上传日志：记录每个分卷的 preuploadID 与已确认分片，用于断点续传 ---
+_journal_lock = threading.Lock()
+
+def journal_get(file_path: Path, parent_id: int):
+    """返回与当前文件（路径、大小、mtime、目标目录均一致）匹配的未完成上传记录"""
+    st = file_path.stat()
+    with _journal_lock:
+        job = load_state("uploads.json", {}, shared=True).get(str(file_path.resolve()))
+    if not job or job["size"] != st.st_size or job["mtime"] != st.st_mtime_ns or job["parent_id"] != parent_id:
+        return None
+    return job
+
+def journal_put(file_path: Path, parent_id: int, preuploadID: str, sliceSize: int, servers: list) -> dict:
+    st = file_path.stat()
+    job = {
+        "size": st.st_size,
+        "mtime": st.st_mtime_ns,
+        "parent_id": parent_id,
+        "preuploadID": preuploadID,
+        "sliceSize": sliceSize,
+        "servers": servers,
+        "done": [],
+        "created": int(time.time())
+    }
+    with _journal_lock:
+        journal = {k: v for k, v in load_state("uploads.json", {}, shared=True).items() if Path(k).exists()}
+        journal[str(file_path.resolve())] = job
+        save_state("uploads.json", journal, shared=True)
+    return job
+
+def journal_ack(file_path: Path, slice_no: int):
+    with _journal_lock:
+        journal = load_state("uploads.json", {}, shared=True)
+        job = journal.get(str(file_path.resolve()))
+        if job is not None and slice_no not in job["done"]:
+            job["done"].append(slice_no)
+            save_state("uploads.json", journal, shared=True)
+
+def journal_drop(file_path: Path):
+    with _journal_lock:
+        journal = load_state("uploads.json", {}, shared=True)
+        if journal.pop(str(file_path.resolve()), None) is not None:
+            save_state("uploads.json", journal, shared=True)
+
+STREAM_BUFFER = 1024 * 1024
+
+class SliceBody:
+    """
+    单个分片的 multipart/form-data 请求体，按偏移和长度直接从文件流式读取，
+    每个在途分片只占用 STREAM_BUFFER 大小的内存，发送的每一块都经过上传限速。
+    可重复迭代，连接层重试时会从头重新发送。
+    """
+    def __init__(self, file_path: Path, offset: int, length: int, fields: dict):
+        boundary = uuid.uuid4().hex
+        head = "".join(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{k}"\r\n\r\n{v}\r\n'
+            for k, v in fields.items()
+        )
+        head += (f'--{boundary}\r\nContent-Disposition: form-data; name="slice"; filename="{file_path.name}"\r\n'
+                 f'Content-Type: application/octet-stream\r\n\r\n')
+        self.file_path = file_path
+        self.offset = offset
+        self.length = length
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+        self._head = head.encode("utf-8")
+        self._tail = f"\r\n--{boundary}--\r\n".encode("utf-8")
+
+    def __len__(self):
+        return len(self._head) + self.length + len(self._tail)
+
+    def __iter__(self):
+        yield self._head
+        with self.file_path.open("rb") as f:
+            f.seek(self.offset)
+            left = self.length
+            while left > 0:
+                chunk = f.read(min(STREAM_BUFFER, left))
+                if not chunk:
+                    raise IOError(f"文件在上传过程中被截断: {self.file_path}")
+                left -= len(chunk)
+                shaper.throttle(len(chunk))
+                yield chunk
+        yield self._tail
 
 def upload_file_http(access_token: str, parent_id: int, filepath: str):
     """
     创建上传任务并上传文件（支持秒传与分片上传）
     改进版：兼容 data 为 None 的情况，不每次重试都重建任务。
+    上传中断后根据 .mcbackup/uploads.json 中的记录从缺失的分片继续。
     """
     conf = cfg["123pan_http"]
     base = conf['api_base_url'].rstrip('/')
     file_path = Path(filepath)
     size = file_path.stat().st_size
-    etag = compute_etag_md5(file_path)
+    digest = digest_file(file_path)
+    etag = digest["etag"]
 
-    # 1. 建立任务
-    create_url = f"{base}/upload/v2/file/create"
     headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Platform": "open_platform",
         "Content-Type": "application/json"
     }
-    body = {
-        "parentFileID": parent_id,
-        "filename": file_path.name,
-        "size": size,
-        "etag": etag
-    }
-    logger.info("上传任务创建: %s (文件=%s, 大小=%d)", create_url, filepath, size)
-    r1 = _http.post(create_url, headers=headers, json=body, timeout=30)
-    if r1.status_code != 200:
-        raise RuntimeError(f"上传任务创建失败: {r1.status_code}, {r1.text}")
-    resp1 = r1.json()
-    logger.debug("upload create 返回: %s", resp1)
-
-    data1 = resp1.get("data") or {}
-    reuse = data1.get("reuse", False)
-    if reuse:
-        file_id = data1.get("fileID")
-        logger.info("文件 %s 秒传成功，fileID=%s", filepath, file_id)
-        return resp1
-
-    preuploadID = data1.get("preuploadID")
-    sliceSize = data1.get("sliceSize")
-    servers = data1.get("servers") or []
-    if not preuploadID or not servers or sliceSize is None:
-        raise RuntimeError(f"上传任务创建响应不完整: {resp1}")
-
-    upload_server = servers[0].rstrip('/')
-    slice_url = f"{upload_server}/upload/v2/file/slice"
-    logger.info("开始分片上传: %s, sliceSize=%s, server=%s", filepath, sliceSize, upload_server)
+    job = journal_get(file_path, parent_id)
+    if job:
+        preuploadID = job["preuploadID"]
+        sliceSize = job["sliceSize"]
+        servers = job["servers"]
+        logger.info("恢复未完成的上传: %s, preuploadID=%s, 已确认分片 %d 个",
+                    filepath, preuploadID, len(job["done"]))
+    else:
+        # 1. 建立任务
+        create_url = f"{base}/upload/v2/file/create"
+        body = {
+            "parentFileID": parent_id,
+            "filename": file_path.name,
+            "size": size,
+            "etag": etag
+        }
+        logger.info("上传任务创建: %s (文件=%s, 大小=%d)", create_url, filepath, size)
+        r1 = _authed("POST", create_url, access_token, headers=headers, json=body, timeout=30)
+        if r1.status_code != 200:
+            raise RuntimeError(f"上传任务创建失败: {r1.status_code}, {r1.text}")
+        resp1 = r1.json()
+        logger.debug("upload create 返回: %s", resp1)
+
+        data1 = resp1.get("data") or {}
+        reuse = data1.get("reuse", False)
+        if reuse:
+            file_id = data1.get("fileID")
+            logger.info("文件 %s 秒传成功，fileID=%s", filepath, file_id)
+            return resp1
 
+        preuploadID = data1.get("preuploadID")
+        sliceSize = data1.get("sliceSize")
+        servers = data1.get("servers") or []
+        if not preuploadID or not servers or sliceSize is None:
+            raise RuntimeError(f"上传任务创建响应不完整: {resp1}")
+        remember_slice_size(sliceSize)
+        job = journal_put(file_path, parent_id, preuploadID, sliceSize, servers)
+
+    try:
+        return _upload_slices_and_complete(access_token, base, headers, file_path, size, job)
+    except UploadRejected:
+        # 服务器已不认可该 preuploadID，丢弃日志，下次重试重新建立任务
+        journal_drop(file_path)
+        raise
+
+def _upload_slices_and_complete(access_token, base, headers, file_path, size, job):
+    conf = cfg["123pan_http"]
+    filepath = str(file_path)
+    preuploadID = job["preuploadID"]
+    sliceSize = job["sliceSize"]
+    servers = job["servers"]
+    done = set(job["done"])
+    # 服务器给出的 sliceSize 与预估不一致时才需要补算分片 MD5
+    slice_md5s = digest_file(file_path, sliceSize)["slices"][str(sliceSize)]
+    upload_servers = [s.rstrip('/') for s in servers]
     total_slices = math.ceil(size / sliceSize)
-    logger.info("预计分片数: %d", total_slices)
+    concurrency = max(1, int(conf.get("upload_concurrency", 4)))
+    slice_retries = max(1, int(conf.get("slice_retries", 3)))
+    pending = [idx for idx in range(total_slices) if idx + 1 not in done]
+    logger.info("开始分片上传: %s, sliceSize=%s, 分片数=%d (待传 %d), 并发=%d, servers=%s",
+                filepath, sliceSize, total_slices, len(pending), concurrency, upload_servers)
+    # 服务器在分片响应中报告 completed 后，其余分片不再上传
+    completed = threading.Event()
 
-    # 2. 分片上传循环
-    with file_path.open("rb") as f:
-        for idx in range(total_slices):
-            slice_no = idx + 1
-            chunk = f.read(sliceSize)
-            md5 = hashlib.md5(chunk).hexdigest()
-            files = {"slice": (file_path.name, chunk)}
-            data = {
-                "preuploadID": preuploadID,
-                "sliceNo": str(slice_no),
-                "sliceMD5": md5
-            }
-
-            logger.debug("上传分片 %d/%d md5=%s", slice_no, total_slices, md5)
-            r2 = _http.post(slice_url, headers={
-                "Authorization": f"Bearer {access_token}",
-                "Platform": "open_platform"
-            }, data=data, files=files, timeout=3600)
-            if r2.status_code not in (200, 201):
-                raise RuntimeError(f"分片上传失败: sliceNo={slice_no}, {r2.status_code}, {r2.text}")
+    def upload_slice(idx):
+        slice_no = idx + 1
+        offset = idx * sliceSize
+        md5 = slice_md5s[idx]
+        # 请求体从文件流式读取，内存占用与 sliceSize 无关
+        body = SliceBody(file_path, offset, min(sliceSize, size - offset), {
+            "preuploadID": preuploadID,
+            "sliceNo": str(slice_no),
+            "sliceMD5": md5
+        })
+        for attempt in range(1, slice_retries + 1):
+            if completed.is_set():
+                return None
+            # 轮换上传服务器，重试时换到下一个
+            upload_server = upload_servers[(idx + attempt - 1) % len(upload_servers)]
+            slice_url = f"{upload_server}/upload/v2/file/slice"
+            shaper.note_server(upload_server)
             try:
-                resp2 = r2.json()
-            except ValueError:
-                logger.error("分片上传返回不能解析为 JSON: %s", r2.text)
-                raise RuntimeError("分片上传返回非 JSON")
-
-            logger.debug("slice 返回: %s", resp2)
-            # 兼容 data 为 None 的情况
-            data2 = resp2.get("data")
-            if isinstance(data2, dict) and data2.get("completed"):
-                logger.info("服务器指示已完成全部切片上传，提前结束分片循环")
-                break
-            # 否则，继续上传下一片
+                logger.debug("上传分片 %d/%d md5=%s server=%s", slice_no, total_slices, md5, upload_server)
+                slice_started = time.monotonic()
+                r2 = _authed("POST", slice_url, access_token, headers={
+                    "Content-Type": body.content_type
+                }, data=body, timeout=3600)
+                if r2.status_code not in (200, 201):
+                    raise RuntimeError(f"分片上传失败: sliceNo={slice_no}, {r2.status_code}, {r2.text}")
+                try:
+                    resp2 = r2.json()
+                except ValueError:
+                    logger.error("分片上传返回不能解析为 JSON: %s", r2.text)
+                    raise RuntimeError("分片上传返回非 JSON")
+                if resp2.get("code", 0) != 0:
+                    raise UploadRejected(f"分片上传响应异常: sliceNo={slice_no}, {resp2}")
+                logger.debug("slice 返回: %s", resp2)
+                upload_stats.slice_done(time.monotonic() - slice_started)
+                journal_ack(file_path, slice_no)
+                data2 = resp2.get("data")
+                if isinstance(data2, dict) and data2.get("completed") and not completed.is_set():
+                    logger.info("服务器指示已完成全部切片上传，跳过其余分片")
+                    completed.set()
+                return resp2
+            except Exception as e:
+                # 接口层面的拒绝也先重试；重试用尽仍被拒绝才视为任务失效
+                if attempt >= slice_retries:
+                    raise
+                upload_stats.count("slice_retries")
+                logger.warning("分片 %d 上传失败 %d/%d: %s", slice_no, attempt, slice_retries, e)
+                time.sleep(min(30, 2**attempt))
+
+    # 2. 并发分片上传，单个分片失败只重试该分片
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    futures = [executor.submit(upload_slice, idx) for idx in pending]
+    try:
+        for fut in as_completed(futures):
+            fut.result()
+    except Exception:
+        for fut in futures:
+            fut.cancel()
+        raise
+    finally:
+        executor.shutdown(wait=True)
 
     # 3. 上传完成通知
     complete_url = f"{base}/upload/v2/file/upload_complete"
     body2 = {"preuploadID": preuploadID}
     logger.info("通知上传完成: %s", complete_url)
-    r3 = _http.post(complete_url, headers=headers, json=body2, timeout=30)
+    r3 = _authed("POST", complete_url, access_token, headers=headers, json=body2, timeout=30)
     if r3.status_code != 200:
         raise RuntimeError(f"上传完成通知失败: {r3.status_code}, {r3.text}")
     resp3 = r3.json()
     logger.debug("upload finish 返回: %s", resp3)
     if resp3.get("code") != 0 or resp3.get("data") is None:
-        raise RuntimeError(f"上传完成通知响应异常: {resp3}")
+        raise UploadRejected(f"上传完成通知响应异常: {resp3}")
+    journal_drop(file_path)
     file_id = resp3["data"].get("fileID")
     logger.info("文件上传完毕，fileID=%s", file_id)
     return resp3
 
-def async_upload(filepath):
-    part_files = sorted(glob(filepath + "*"))
+def instance_folder_id(access_token, parent_id):
+    """多实例时每个实例的备份位于父目录下以实例名命名的子目录中，避免同名备份互相覆盖"""
+    name = current_instance()
+    return int(get_or_create_date_folder(access_token, parent_id, name)) if name else parent_id
 
-    def task():
-        token = None
-        for attempt in range(1, 6):
-            try:
-                token = get_access_token_http()
-                break
-            except Exception as e:
-                logger.warning("获取 access_token 失败 %d/5: %s", attempt, e)
-                time.sleep(min(30, 2**attempt))
-        if not token:
-            logger.error("无法获取 access_token，上传取消")
-            return
-
-        parent_id = cfg["123pan_http"].get("parent_folder_id", 0) or 0
-        try_parents = [parent_id]
-        if parent_id != 0:
-            try_parents.append(0)
-        used_parent = None
-        folder_list = None
-        today_str = datetime.datetime.now().strftime("%Y-%m-%d")
-
-        for pid in try_parents:
-            try:
-                folder_list = list_folder_http(token, pid, limit=100)
-                used_parent = pid
-                break
-            except Exception as e:
-                logger.warning("列出父目录 %s 失败: %s", pid, e)
-                continue
+def _prepare_upload_target(date_str=None):
+    """获取 access_token 并解析日期目录（默认当天），返回 (token, 备份根目录ID, 日期目录ID)，失败时全为 None"""
+    token = None
+    for attempt in range(1, 6):
+        try:
+            token = get_access_token_http()
+            break
+        except Exception as e:
+            logger.warning("获取 access_token 失败 %d/5: %s", attempt, e)
+            time.sleep(min(30, 2**attempt))
+    if not token:
+        logger.error("无法获取 access_token，上传取消")
+        return None, None, None
 
-        if used_parent is None:
-            logger.error("无法列出任何父目录，上传取消")
-            return
+    parent_id = cfg["123pan_http"].get("parent_folder_id", 0) or 0
+    try_parents = [parent_id]
+    if parent_id != 0:
+        try_parents.append(0)
+    date_str = date_str or datetime.datetime.now().strftime("%Y-%m-%d")
 
-        # 使用封装好的函数来获取或创建日期子目录（它会返回 int ID 或 raise）
+    # 日期目录优先从本地目录索引解析，只有未命中时才会列目录/创建
+    for pid in try_parents:
         try:
-            date_folder_id = get_or_create_date_folder(token, used_parent, today_str)
-            date_folder_id = int(date_folder_id)
+            root_id = instance_folder_id(token, pid)
+            date_folder_id = int(get_or_create_date_folder(token, root_id, date_str))
+            return token, root_id, date_folder_id
         except Exception as e:
-            logger.error("获取/创建日期目录失败: %s", e)
-            return
+            logger.warning("在父目录 %s 下获取/创建日期目录失败: %s", pid, e)
+
+    logger.error("无法获取/创建日期目录，上传取消")
+    return None, None, None
+
+def _aio_client():
+    """123pan_http.client 为 aiohttp 且已安装 aiohttp 时返回 pan_async_api 模块，否则返回 None"""
+    if cfg["123pan_http"].get("client", "requests") != "aiohttp":
+        return None
+    # 延迟导入：pan_async_api 依赖本模块
+    import pan_async_api
+    return pan_async_api if pan_async_api.aio_available() else None
+
+def _upload_impl():
+    """按 123pan_http.client 选择上传实现：requests（默认）或 aiohttp"""
+    aio = _aio_client()
+    if aio:
+        return aio.upload_file_aio
+    if cfg["123pan_http"].get("client", "requests") == "aiohttp":
+        logger.warning("未安装 aiohttp，改用 requests 客户端上传")
+    return upload_file_http
 
-        # 上传各个分卷
-        for f in part_files:
-            uploaded = False
-            for attempt in range(1, 6):
+def _upload_part(token, date_folder_id, f, keep_local=False):
+    """上传单个分卷（含重试），返回是否成功"""
+    upload = _upload_impl()
+    for attempt in range(1, 6):
+        try:
+            logger.info("上传 %s 到 123pan (目录ID=%s) 尝试 %d/5", f, date_folder_id, attempt)
+            started = time.monotonic()
+            size = Path(f).stat().st_size
+            upload_resp = upload(token, date_folder_id, f)
+            logger.info("上传成功: %s", upload_resp)
+            reused = bool(((upload_resp or {}).get("data") or {}).get("reuse"))
+            upload_stats.file_done(size, time.monotonic() - started, reused)
+            if not keep_local and cfg.get("backup", {}).get("storage", "both") == "cloud":
                 try:
-                    logger.info("上传 %s 到 123pan (目录ID=%s) 尝试 %d/5", f, date_folder_id, attempt)
-                    upload_resp = upload_file_http(token, date_folder_id, f)
-                    logger.info("上传成功: %s", upload_resp)
-                    uploaded = True
-                    if cfg.get("backup", {}).get("storage", "both") == "cloud":
-                        try:
-                            Path(f).unlink()
-                            logger.info("删除本地备份，仅保留云端: %s", f)
-                        except Exception as e:
-                            logger.warning("本地删除失败: %s", e)
-                    break
+                    Path(f).unlink()
+                    logger.info("删除本地备份，仅保留云端: %s", f)
                 except Exception as e:
-                    logger.warning("上传 %s 失败 %d/5: %s", f, attempt, e)
-                    time.sleep(min(60, 2**attempt))
-                    continue
-            if not uploaded:
-                logger.error("文件 %s 上传失败，已跳过后续重试", f)
+                    logger.warning("本地删除失败: %s", e)
+            return True
+        except Exception as e:
+            logger.warning("上传 %s 失败 %d/5: %s", f, attempt, e)
+            time.sleep(min(60, 2**attempt))
+    logger.error("文件 %s 上传失败，已跳过后续重试", f)
+    upload_stats.count("failures")
+    return False
 
-        logger.info("所有分卷上传流程结束 (部分文件可能上传失败)")
+def upload_to_date_folder(f, date_str=None, keep_local=False):
+    """把单个文件上传到日期目录；失败时作废目录缓存重新解析，目录变化则重试一次"""
+    token, _, date_folder_id = _prepare_upload_target(date_str)
+    if token is None:
+        logger.error("上传目标不可用，跳过: %s", f)
+        return False
+    if _upload_part(token, date_folder_id, f, keep_local):
+        return True
+    # 日期目录可能已在云端被删除
+    forget_folder_ids([date_folder_id])
+    token, _, new_folder_id = _prepare_upload_target(date_str)
+    if token is None or new_folder_id == date_folder_id:
+        return False
+    logger.warning("日期目录已变化 (%s -> %s)，重试: %s", date_folder_id, new_folder_id, f)
+    return _upload_part(token, new_folder_id, f, keep_local)
+
+def upload_chunk_snapshot(snapshot_path, date_str=None):
+    """
+    块存储引擎的上传：只上传云端尚未拥有的 pack（记录在块存储的 remote_packs.json 中，
+    其余情况由 create 接口的秒传兜底），最后把快照清单上传到日期目录（默认当天）。
+    """
+    token, used_parent, date_folder_id = _prepare_upload_target(date_str)
+    if token is None:
+        return False
+    try:
+        packs_folder_id = int(get_or_create_date_folder(token, used_parent, "packs"))
+    except Exception as e:
+        logger.error("获取/创建 packs 目录失败: %s", e)
+        return False
 
-    t = threading.Thread(target=task, daemon=False)
-    t.start()
-    return t
\ No newline at end of file
+    with open(snapshot_path, "r", encoding="utf-8") as f:
+        snapshot = json.load(f)
+    remote = remote_packs()
+    missing = [p for p in snapshot["packs"] if p not in remote]
+    logger.info("快照 %s 引用 pack %d 个，需上传 %d 个", snapshot["name"], len(snapshot["packs"]), len(missing))
+    ok = True
+    for pack in missing:
+        pack_path = store_dir() / "packs" / pack
+        if not pack_path.exists():
+            logger.error("本地缺少 pack，无法上传: %s", pack_path)
+            ok = False
+            continue
+        if _upload_part(token, packs_folder_id, str(pack_path)):
+            mark_remote_pack(pack)
+        else:
+            ok = False
+    if not ok:
+        logger.error("部分 pack 上传失败，暂不上传快照清单: %s", snapshot_path)
+        return False
+    # 快照清单是本地回收与恢复的依据，始终保留本地副本
+    ok = _upload_part(token, date_folder_id, snapshot_path, keep_local=True)
+    logger.info("块存储快照上传流程结束: %s", snapshot["name"])
+    return ok
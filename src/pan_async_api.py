@@ -0,0 +1,311 @@
+import asyncio
+import atexit
+import functools
+import math
+import threading
+import time
+from pathlib import Path
+from config import cfg
+from log_api import logger
+from tls_adapter import make_ssl_context
+from bandwidth_api import shaper
+from metrics_api import upload_stats
+from pan_api import (_tokens, parse_token_response, digest_file, remember_slice_size,
+                     journal_get, journal_put, journal_ack, journal_drop, SliceBody, UploadRejected)
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# --- 基于 asyncio + aiohttp 的 123pan 客户端 ---
+# 进程内只有一个事件循环（后台线程 pan-aio）和一个 AsyncPanClient，所有上传、列目录与 mkdir 共用
+# 同一个连接池；上传队列的各个工作线程通过同步入口 upload_file_aio / list_folder_aio / mkdir_aio
+# 把协程提交到这个循环并等待结果。状态文件与摘要等阻塞操作放到线程池中执行，不占用事件循环。
+USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64; rv:140.0) Gecko/20100101 Firefox/140.0"
+
+def aio_available() -> bool:
+    return aiohttp is not None
+
+async def _io(func, *args):
+    """在默认线程池中执行阻塞调用（文件读写、状态文件、同步 token 接口）"""
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *args))
+
+class AsyncPanClient:
+    def __init__(self):
+        conf = cfg["123pan_http"]
+        self.base = conf["api_base_url"].rstrip("/")
+        self.pool_size = max(1, int(conf.get("pool_size", 32)))
+        self.session = None
+        self._refresh_lock = None
+
+    async def __aenter__(self):
+        if aiohttp is None:
+            raise RuntimeError("123pan_http.client 为 aiohttp 时需要安装 aiohttp: uv sync --extra aiohttp")
+        connector = aiohttp.TCPConnector(limit=self.pool_size, limit_per_host=self.pool_size,
+                                         ssl=make_ssl_context(), ttl_dns_cache=300)
+        self.session = aiohttp.ClientSession(connector=connector, headers={"User-Agent": USER_AGENT},
+                                             timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=300))
+        self._refresh_lock = asyncio.Lock()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.session.close()
+
+    # --- access_token：与同步客户端共用 .mcbackup/token.json ---
+    async def fetch_token(self):
+        conf = cfg["123pan_http"]
+        url = f"{self.base}/api/v1/access_token"
+        logger.info("获取 123pan access_token via aiohttp -> %s", url)
+        body = {"clientID": conf["client_id"], "clientSecret": conf["client_secret"]}
+        async with self.session.post(url, json=body, headers={"Platform": "open_platform"}) as r:
+            if r.status != 200:
+                raise RuntimeError(f"token 接口返回 {r.status}: {await r.text()}")
+            resp = await r.json(content_type=None)
+        return await _io(_tokens.store, *parse_token_response(resp))
+
+    async def token(self, hint=None):
+        """调用方传入的 token 未被缓存作废时直接使用，否则取缓存，缓存失效时经 aiohttp 刷新"""
+        if hint is not None and not _tokens.known(hint):
+            return hint
+        return await _io(_tokens.cached) or await self._refresh(None)
+
+    async def _refresh(self, stale):
+        async with self._refresh_lock:
+            current = await _io(_tokens.cached)
+            if current and current != stale:
+                return current
+            return await self.fetch_token()
+
+    async def request(self, method, url, token=None, **kwargs):
+        """
+        发送带鉴权的请求并返回 JSON；token 为调用方持有的 access_token，失效时刷新并重发一次。
+        流式请求体只能发送一次，需以 body_factory 传入，每次发送时重新生成。
+        """
+        headers = kwargs.pop("headers", {})
+        body_factory = kwargs.pop("body_factory", None)
+        for attempt in (1, 2):
+            token = await self.token(token if attempt == 1 else None)
+            h = {"Authorization": f"Bearer {token}", "Platform": "open_platform"}
+            h.update(headers)
+            if body_factory:
+                kwargs["data"] = body_factory()
+            async with self.session.request(method, url, headers=h, **kwargs) as r:
+                text = await r.text()
+                try:
+                    resp = await r.json(content_type=None)
+                except ValueError:
+                    resp = None
+            auth_failed = r.status == 401 or (isinstance(resp, dict) and resp.get("code") == 401)
+            if attempt == 1 and auth_failed:
+                logger.warning("access_token 已失效，刷新后重试: %s", url)
+                await self._refresh(token)
+                continue
+            if r.status not in (200, 201) or not isinstance(resp, dict):
+                raise RuntimeError(f"请求失败: {url}, {r.status}, {text[:500]}")
+            return resp
+
+    # --- 目录 ---
+    async def list_folder(self, parent_id, limit=100, token=None):
+        params = {"parentFileId": parent_id, "limit": limit}
+        items = []
+        while True:
+            resp = await self.request("GET", f"{self.base}/api/v2/file/list", token, params=params)
+            data = resp.get("data") or {}
+            page = data.get("fileList") or []
+            items.extend(f for f in page if not (isinstance(f, dict) and f.get("trashed")))
+            last_id = data.get("lastFileId", -1)
+            if last_id in (-1, None) or not page:
+                return items
+            params["lastFileId"] = last_id
+
+    async def mkdir(self, name, parent_id, token=None):
+        """创建子目录并返回其 ID（目录索引缓存由调用方 pan_api.mkdir_http 写入）"""
+        logger.info("创建子目录 (aiohttp): 名称=%s, 父目录ID=%s", name, parent_id)
+        resp = await self.request("POST", f"{self.base}/upload/v1/file/mkdir", token,
+                                  json={"name": name, "parentID": parent_id})
+        dir_id = (resp.get("data") or {}).get("dirID")
+        if dir_id is None:
+            raise RuntimeError(f"mkdir 接口返回 data 内无 dirID: {resp}")
+        return int(dir_id)
+
+    # --- 上传 ---
+    async def upload(self, parent_id, filepath, token=None, conf=None):
+        """
+        与 upload_file_http 相同的流程（秒传、断点续传日志），分片在同一个连接池上并发。
+        conf 为调用线程（可能选中了某个实例）读取的 123pan_http 配置段。
+        """
+        conf = conf or cfg["123pan_http"]
+        file_path = Path(filepath)
+        size = (await _io(file_path.stat)).st_size
+        digest = await _io(digest_file, file_path)
+
+        job = await _io(journal_get, file_path, parent_id)
+        if job:
+            logger.info("恢复未完成的上传: %s, preuploadID=%s, 已确认分片 %d 个",
+                        filepath, job["preuploadID"], len(job["done"]))
+        else:
+            body = {"parentFileID": parent_id, "filename": file_path.name, "size": size, "etag": digest["etag"]}
+            logger.info("上传任务创建 (aiohttp): 文件=%s, 大小=%d", filepath, size)
+            resp1 = await self.request("POST", f"{self.base}/upload/v2/file/create", token, json=body)
+            if resp1.get("code", 0) != 0:
+                raise RuntimeError(f"上传任务创建失败: {resp1}")
+            data1 = resp1.get("data") or {}
+            if data1.get("reuse", False):
+                logger.info("文件 %s 秒传成功，fileID=%s", filepath, data1.get("fileID"))
+                return resp1
+            if not data1.get("preuploadID") or not data1.get("servers") or data1.get("sliceSize") is None:
+                raise RuntimeError(f"上传任务创建响应不完整: {resp1}")
+            await _io(remember_slice_size, data1["sliceSize"])
+            job = await _io(journal_put, file_path, parent_id, data1["preuploadID"], data1["sliceSize"],
+                            data1["servers"])
+
+        try:
+            await self._upload_slices(file_path, size, job, token, conf)
+            resp3 = await self.request("POST", f"{self.base}/upload/v2/file/upload_complete", token,
+                                       json={"preuploadID": job["preuploadID"]})
+            if resp3.get("code") != 0 or resp3.get("data") is None:
+                raise UploadRejected(f"上传完成通知响应异常: {resp3}")
+        except UploadRejected:
+            await _io(journal_drop, file_path)
+            raise
+        await _io(journal_drop, file_path)
+        logger.info("文件上传完毕，fileID=%s", resp3["data"].get("fileID"))
+        return resp3
+
+    async def _upload_slices(self, file_path, size, job, token, conf):
+        slice_size = job["sliceSize"]
+        slice_md5s = (await _io(digest_file, file_path, slice_size))["slices"][str(slice_size)]
+        servers = [s.rstrip("/") for s in job["servers"]]
+        total = math.ceil(size / slice_size)
+        done = set(job["done"])
+        pending = [idx for idx in range(total) if idx + 1 not in done]
+        concurrency = max(1, int(conf.get("upload_concurrency", 4)))
+        retries = max(1, int(conf.get("slice_retries", 3)))
+        sem = asyncio.Semaphore(concurrency)
+        # 服务器在分片响应中报告 completed 后，其余分片不再上传
+        completed = asyncio.Event()
+        logger.info("开始分片上传 (aiohttp): %s, sliceSize=%s, 分片数=%d (待传 %d), 并发=%d, servers=%s",
+                    file_path, slice_size, total, len(pending), concurrency, servers)
+
+        async def body_stream(body):
+            # 分块读取文件，避免阻塞事件循环
+            it = iter(body)
+            while True:
+                chunk = await _io(next, it, None)
+                if chunk is None:
+                    return
+                yield chunk
+
+        async def upload_slice(idx):
+            slice_no = idx + 1
+            offset = idx * slice_size
+            async with sem:
+                for attempt in range(1, retries + 1):
+                    if completed.is_set():
+                        return
+                    server = servers[(idx + attempt - 1) % len(servers)]
+                    shaper.note_server(server)
+                    body = SliceBody(file_path, offset, min(slice_size, size - offset), {
+                        "preuploadID": job["preuploadID"],
+                        "sliceNo": str(slice_no),
+                        "sliceMD5": slice_md5s[idx]
+                    })
+                    try:
+                        slice_started = time.monotonic()
+                        resp = await self.request("POST", f"{server}/upload/v2/file/slice", token,
+                                                  body_factory=lambda: body_stream(body),
+                                                  headers={"Content-Type": body.content_type,
+                                                           "Content-Length": str(len(body))})
+                        if resp.get("code", 0) != 0:
+                            raise UploadRejected(f"分片上传响应异常: sliceNo={slice_no}, {resp}")
+                        upload_stats.slice_done(time.monotonic() - slice_started)
+                        await _io(journal_ack, file_path, slice_no)
+                        data = resp.get("data")
+                        if isinstance(data, dict) and data.get("completed") and not completed.is_set():
+                            logger.info("服务器指示已完成全部切片上传，跳过其余分片")
+                            completed.set()
+                        return
+                    except Exception as e:
+                        if attempt >= retries:
+                            raise
+                        upload_stats.count("slice_retries")
+                        logger.warning("分片 %d 上传失败 %d/%d: %s", slice_no, attempt, retries, e)
+                        await asyncio.sleep(min(30, 2**attempt))
+
+        tasks = [asyncio.ensure_future(upload_slice(idx)) for idx in pending]
+        try:
+            await asyncio.gather(*tasks)
+        except Exception:
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+class SharedClient:
+    """
+    在后台线程 pan-aio 中长期运行的事件循环与 AsyncPanClient，首次使用时启动，进程退出时关闭。
+    run() 可被任意线程并发调用，多个分卷的上传同时在一个连接池上进行。
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loop = None
+        self._thread = None
+        self._client = None
+
+    def _start_locked(self):
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever, name="pan-aio", daemon=True)
+        thread.start()
+        client = AsyncPanClient()
+        try:
+            asyncio.run_coroutine_threadsafe(client.__aenter__(), loop).result()
+        except Exception:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+            raise
+        self._loop, self._thread, self._client = loop, thread, client
+        logger.info("aiohttp 客户端已启动，连接池大小 %d", client.pool_size)
+
+    def run(self, method, *args, **kwargs):
+        """在共享事件循环中执行 client.<method>(*args, **kwargs) 并等待结果"""
+        with self._lock:
+            if self._loop is None:
+                self._start_locked()
+            loop, client = self._loop, self._client
+        if threading.current_thread() is self._thread:
+            raise RuntimeError("不能在 aiohttp 事件循环线程中调用同步入口")
+        return asyncio.run_coroutine_threadsafe(getattr(client, method)(*args, **kwargs), loop).result()
+
+    def close(self):
+        with self._lock:
+            loop, thread, client = self._loop, self._thread, self._client
+            self._loop = self._thread = self._client = None
+        if loop is None:
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(client.__aexit__(None, None, None), loop).result(timeout=10)
+        except Exception as e:
+            logger.warning("关闭 aiohttp 客户端失败: %s", e)
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(timeout=10)
+        loop.close()
+
+_shared = SharedClient()
+atexit.register(_shared.close)
+
+def upload_file_aio(access_token, parent_id, filepath):
+    """同步入口：与 upload_file_http 参数一致，在共享事件循环与连接池上完成整个上传"""
+    started = time.time()
+    resp = _shared.run("upload", parent_id, filepath, token=access_token, conf=cfg["123pan_http"])
+    logger.info("aiohttp 上传耗时 %.1fs: %s", time.time() - started, filepath)
+    return resp
+
+def list_folder_aio(access_token, parent_id, limit=100):
+    """同步入口：与 list_folder_http 参数一致"""
+    return _shared.run("list_folder", parent_id, limit, token=access_token)
+
+def mkdir_aio(access_token, name, parent_id):
+    """同步入口：创建子目录并返回其 ID"""
+    return _shared.run("mkdir", name, parent_id, token=access_token)
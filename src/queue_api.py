@@ -0,0 +1,380 @@
+import re
+import datetime
+import threading
+import time
+import uuid
+from glob import glob
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from config import cfg, current_instance, instance_list, use_instance
+from log_api import logger
+from state_api import load_state, save_state
+from pan_api import upload_to_date_folder, upload_chunk_snapshot
+from retention_api import parse_backup_name, apply_retention
+from metrics_api import current_run_id, record_upload
+from change_api import settle_manifest
+from verify_api import verify_enabled, test_archive, check_uploaded
+
+# --- 持久化上传队列：.mcbackup/upload_queue.json + 单一调度线程 ---
+# 每个任务对应一次备份（一组分卷或一个块存储快照），进程重启后从未完成的分卷继续。
+# 上传失败的分卷在下一次调度（新备份入队或程序重启）时重试，累计 MAX_ATTEMPTS 次后放弃。
+# 多实例共用这一个队列（即共用 queue_workers 个上传名额），任务记录所属实例，上传时切换到该实例的配置。
+# 开启 backup.verify 时，归档任务封口后在单独的线程中与上传同时做本地测试，全部分卷上传后核对云端元数据，
+# 任务的 verify 字段依次为 test -> check -> ok / failed；校验通过前不删除本地分卷。
+# 任务结束时按结果保存或丢弃该次运行暂存的变化检测清单（change_api.settle_manifest）。
+MAX_ATTEMPTS = 3
+VERIFY = "#verify"
+ORDERS = ("newest_first", "oldest_first", "full_first")
+
+def _queue_conf():
+    conf = cfg["123pan_http"]
+    order = conf.get("queue_order", "newest_first")
+    if order not in ORDERS:
+        logger.warning("未知的 queue_order: %s，使用 newest_first", order)
+        order = "newest_first"
+    return max(1, int(conf.get("queue_workers", 1))), order
+
+def _job_priority(job, order):
+    if order == "oldest_first":
+        return (job["created"],)
+    if order == "full_first":
+        # 先传全量基准，增量依赖它才能恢复
+        return (job["kind"] == "incr", job["created"])
+    return (-job["created"],)
+
+def backup_key(name):
+    """分卷或附属文件所属备份的键（retention_api 的分组方式），如 mc_incr_backup_xxx.7z"""
+    parsed = parse_backup_name(name)
+    return parsed[0] if parsed else re.sub(r"\.\d{3}$", "", name)
+
+def _job_instance(job):
+    """任务所属的实例；实例已从配置中移除时退回全局配置"""
+    name = job.get("instance")
+    if name is not None and not any(i["name"] == name for i in instance_list()):
+        logger.warning("实例 %s 已不在配置中，任务 %s 按全局配置处理", name, job["name"])
+        return None
+    return name
+
+class UploadQueue:
+    """
+    全局上传队列：任务持久化在状态文件中，由一个调度线程按 queue_order 选取分卷，
+    最多 queue_workers 个分卷同时上传。调度线程在队列清空后退出，有新任务时重新启动。
+    带 retention 标记的任务完成后，在队列清空时执行一次保留策略。
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._jobs = None
+        self._running = set()
+        self._thread = None
+        self._retention_due = set()
+
+    def _load(self):
+        if self._jobs is None:
+            self._jobs = load_state("upload_queue.json", {}, shared=True).get("jobs", [])
+
+    def _save(self):
+        save_state("upload_queue.json", {"jobs": self._jobs}, shared=True)
+
+    def _find(self, job_id):
+        for job in self._jobs:
+            if job["id"] == job_id:
+                return job
+        return None
+
+    def create_job(self, name, job_type="files", retention=False, closed=False):
+        now = time.time()
+        parsed = parse_backup_name(name)
+        job = {
+            "id": uuid.uuid4().hex,
+            "name": name,
+            "type": job_type,
+            "kind": parsed[1] if parsed else "full",
+            "created": now,
+            "date": datetime.datetime.fromtimestamp(now).strftime("%Y-%m-%d"),
+            "retention": retention,
+            "run_id": current_run_id(),
+            "instance": current_instance(),
+            "closed": closed,
+            "verify": "test" if job_type == "files" and verify_enabled() else None,
+            "parts": []
+        }
+        with self._cond:
+            self._load()
+            self._jobs.append(job)
+            self._save()
+        logger.info("上传任务入队: %s", name)
+        return job["id"]
+
+    def add_part(self, job_id, path):
+        with self._cond:
+            self._load()
+            job = self._find(job_id)
+            job["parts"].append({"path": str(path), "state": "pending", "attempts": 0})
+            self._save()
+            self._start_locked()
+            self._cond.notify_all()
+
+    def close_job(self, job_id):
+        with self._cond:
+            self._load()
+            job = self._find(job_id)
+            if job:
+                job["closed"] = True
+                self._save()
+                self._start_locked()
+                self._finish_if_done_locked(job)
+                self._cond.notify_all()
+
+    def abort_job(self, job_id):
+        """放弃尚未开始上传的分卷（正在上传的分卷会继续完成）"""
+        with self._cond:
+            self._load()
+            job = self._find(job_id)
+            if job:
+                for part in job["parts"]:
+                    if part["state"] == "pending" and (job_id, part["path"]) not in self._running:
+                        logger.warning("上传任务已中止，跳过分卷: %s", part["path"])
+                        part["state"] = "abandoned"
+                job["closed"] = True
+                job["retention"] = False
+                self._save()
+                self._finish_if_done_locked(job)
+                self._cond.notify_all()
+
+    def resume(self):
+        """启动时调用：丢弃未封口（压缩被中断）的任务，其余任务的失败分卷重新排队"""
+        with self._cond:
+            self._load()
+            for job in list(self._jobs):
+                if not job["closed"]:
+                    logger.warning("上次运行中断时备份尚未生成完毕，丢弃上传任务: %s", job["name"])
+                    self._jobs.remove(job)
+                    with use_instance(_job_instance(job)):
+                        settle_manifest(job.get("run_id"), False)
+            self._requeue_failed_locked()
+            self._save()
+            pending = sum(p["state"] == "pending" for job in self._jobs for p in job["parts"])
+            if pending:
+                logger.info("恢复上传队列: %d 个任务，%d 个分卷待上传", len(self._jobs), pending)
+            self._start_locked()
+
+    def _requeue_failed_locked(self):
+        for job in list(self._jobs):
+            for part in job["parts"]:
+                if part["state"] != "failed":
+                    continue
+                if part["attempts"] >= MAX_ATTEMPTS:
+                    logger.error("分卷已失败 %d 次，放弃上传（本地文件保留）: %s", part["attempts"], part["path"])
+                    part["state"] = "abandoned"
+                else:
+                    part["state"] = "pending"
+            self._finish_if_done_locked(job)
+
+    def _start_locked(self):
+        if self._thread is None:
+            self._requeue_failed_locked()
+            self._thread = threading.Thread(target=self._dispatch, name="upload-queue", daemon=False)
+            self._thread.start()
+
+    def _finish_if_done_locked(self, job):
+        if not job["closed"] or job not in self._jobs:
+            return
+        states = [p["state"] for p in job["parts"]]
+        if "pending" in states or any(r[0] == job["id"] for r in self._running):
+            return
+        if "failed" in states:
+            # 留在队列中，下次调度时重试
+            return
+        if job.get("verify") in ("test", "check") and states and all(s == "done" for s in states):
+            # 等待校验完成
+            return
+        self._jobs.remove(job)
+        summary = {
+            "name": job["name"],
+            "ok": bool(states) and all(s == "done" for s in states),
+            "bytes": sum(p.get("bytes", 0) for p in job["parts"]),
+            "upload_seconds": round(sum(p.get("seconds", 0) for p in job["parts"]), 2),
+            "queued_seconds": round(time.time() - job["created"], 2),
+            "attempts": sum(p["attempts"] for p in job["parts"])
+        }
+        if job.get("verify"):
+            summary["verified"] = job["verify"] == "ok"
+            summary["verify_seconds"] = round(job.get("verify_seconds", 0), 2)
+        with use_instance(_job_instance(job)):
+            record_upload(job.get("run_id"), summary)
+            settle_manifest(job.get("run_id"), summary["ok"] and job.get("verify") != "failed")
+        if states and all(s == "done" for s in states):
+            logger.info("上传任务完成: %s", job["name"])
+            if job["retention"] and job.get("verify") == "failed":
+                logger.error("备份校验未通过，不执行保留策略: %s", job["name"])
+            elif job["retention"]:
+                self._retention_due.add(_job_instance(job))
+        else:
+            logger.error("上传任务未能完成: %s", job["name"])
+        self._save()
+
+    def _verify_ready_locked(self, job):
+        if (job["id"], VERIFY) in self._running:
+            return False
+        if job.get("verify") == "test":
+            return job["closed"]
+        if job.get("verify") == "check":
+            return bool(job["parts"]) and all(p["state"] == "done" for p in job["parts"])
+        return False
+
+    def _next_part_locked(self, order):
+        for job in sorted(self._jobs, key=lambda j: _job_priority(j, order)):
+            for part in job["parts"]:
+                if part["state"] == "pending" and (job["id"], part["path"]) not in self._running:
+                    return job, part
+        return None, None
+
+    def _dispatch(self):
+        workers, order = _queue_conf()
+        executor = ThreadPoolExecutor(max_workers=workers)
+        # 校验不占用上传名额
+        verifier = ThreadPoolExecutor(max_workers=1)
+        try:
+            with self._cond:
+                while True:
+                    while sum(r[1] != VERIFY for r in self._running) < workers:
+                        job, part = self._next_part_locked(order)
+                        if job is None:
+                            break
+                        self._running.add((job["id"], part["path"]))
+                        executor.submit(self._run_part, job, part)
+                    for job in list(self._jobs):
+                        if self._verify_ready_locked(job):
+                            self._running.add((job["id"], VERIFY))
+                            verifier.submit(self._run_verify, job)
+                    waiting = any(not j["closed"] for j in self._jobs)
+                    if not self._running and not waiting:
+                        # 之后入队的任务会启动新的调度线程
+                        self._thread = None
+                        break
+                    self._cond.wait()
+        finally:
+            executor.shutdown(wait=True)
+            verifier.shutdown(wait=True)
+            with self._cond:
+                if self._thread is threading.current_thread():
+                    self._thread = None
+        logger.info("上传队列已清空")
+        with self._cond:
+            due, self._retention_due = self._retention_due, set()
+        for name in sorted(due, key=str):
+            with use_instance(name):
+                apply_retention()
+
+    def _run_part(self, job, part):
+        with use_instance(_job_instance(job)):
+            self._upload_part(job, part)
+
+    def _upload_part(self, job, part):
+        state = "failed"
+        started = time.time()
+        size = Path(part["path"]).stat().st_size if Path(part["path"]).exists() else 0
+        try:
+            if not Path(part["path"]).exists():
+                logger.error("待上传文件已不存在，放弃: %s", part["path"])
+                state = "abandoned"
+            elif job["type"] == "snapshot":
+                state = "done" if upload_chunk_snapshot(part["path"], job["date"]) else "failed"
+            elif upload_to_date_folder(part["path"], job["date"], keep_local=bool(job.get("verify"))):
+                state = "done"
+        except Exception as e:
+            logger.exception("上传 %s 出错: %s", part["path"], e)
+        with self._cond:
+            self._running.discard((job["id"], part["path"]))
+            part["attempts"] += 1
+            part["state"] = state
+            part["seconds"] = part.get("seconds", 0) + time.time() - started
+            if state == "done":
+                part["bytes"] = size
+            self._save()
+            self._finish_if_done_locked(job)
+            self._cond.notify_all()
+
+    def _run_verify(self, job):
+        with use_instance(_job_instance(job)):
+            self._verify(job)
+
+    def _verify(self, job):
+        started = time.time()
+        phase = job["verify"]
+        paths = [p["path"] for p in job["parts"]]
+        # 旧版本的任务可能以 .manifest.json 为任务名
+        key = backup_key(job["name"])
+        try:
+            if phase == "test":
+                result = "check" if test_archive(key, paths) else "failed"
+            else:
+                result = "ok" if check_uploaded(key, job["kind"], paths, job["date"]) else "failed"
+        except Exception as e:
+            logger.exception("校验 %s 出错: %s", job["name"], e)
+            job["verify_attempts"] = job.get("verify_attempts", 0) + 1
+            result = phase if job["verify_attempts"] < MAX_ATTEMPTS else "failed"
+        with self._cond:
+            self._running.discard((job["id"], VERIFY))
+            job["verify"] = result
+            job["verify_seconds"] = job.get("verify_seconds", 0) + time.time() - started
+            self._save()
+            self._finish_if_done_locked(job)
+            self._cond.notify_all()
+
+    def wait(self):
+        """阻塞直到调度线程退出，即队列中没有可执行的分卷"""
+        while True:
+            with self._cond:
+                thread = self._thread
+            if thread is None:
+                return
+            thread.join()
+
+upload_queue = UploadQueue()
+
+class UploadSession:
+    """
+    一次备份的上传任务：分卷可以在压缩进行中陆续通过 add() 加入，
+    close() 表示不会再有新分卷，abort() 放弃尚未开始的分卷。
+    retention 为 True 时，全部分卷上传成功后执行保留策略。
+    """
+    def __init__(self, retention=False):
+        self.retention = retention
+        self.job_id = None
+
+    def add(self, filepath):
+        if self.job_id is None:
+            # 以备份键作为任务名，如 mc_world_backup_xxx.7z；只有删除的增量备份首个文件就是 .manifest.json
+            name = backup_key(Path(filepath).name)
+            self.job_id = upload_queue.create_job(name, retention=self.retention)
+        logger.info("分卷加入上传队列: %s", filepath)
+        upload_queue.add_part(self.job_id, filepath)
+
+    def close(self):
+        if self.job_id is not None:
+            upload_queue.close_job(self.job_id)
+
+    def abort(self):
+        if self.job_id is not None:
+            upload_queue.abort_job(self.job_id)
+
+def async_upload(filepath, retention=False):
+    session = UploadSession(retention)
+    for f in sorted(glob(filepath + "*")):
+        session.add(f)
+    session.close()
+    return session.job_id
+
+def async_upload_snapshot(snapshot_path, retention=False):
+    job_id = upload_queue.create_job(Path(snapshot_path).name, "snapshot", retention)
+    upload_queue.add_part(job_id, snapshot_path)
+    upload_queue.close_job(job_id)
+    return job_id
+
+def resume_uploads():
+    upload_queue.resume()
+
+def wait_uploads():
+    # 主线程退出后解释器不再接受新的线程池任务，run_once 需在返回前等待上传结束
+    upload_queue.wait()
@@ -0,0 +1,429 @@
+import io
+import os
+import re
+import json
+import time
+import zlib
+import shutil
+import fnmatch
+import hashlib
+import argparse
+import tarfile
+import tempfile
+import threading
+import subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path, PurePosixPath
+from config import cfg, instance_list, use_instance
+from log_api import logger
+from tls_adapter import _http
+from pan_api import get_access_token_http, download_url_http, list_folder_http
+from retention_api import scan_remote, _entry
+from chunk_api import store_dir
+from mcsm_api import mcs_status, STATUS_STOPPED
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# --- 从 123pan 恢复备份 ---
+# 远程文件按 download_block_mib 分段，最多 download_workers 段并行下载（HTTP Range），
+# 单段中断时从已收到的位置继续。
+#   tar+zstd 分卷：各分卷拼接成一个流，边下载边解压，只把选中的文件直接写入目标目录，不落盘暂存；
+#   块存储快照：按快照中记录的块位置只下载选中文件用到的区间；
+#   7z 分卷：7z 需要随机访问，分卷先下载到 backup_dir/restore/.download（可断点续传），再按路径解压。
+# 增量备份会先恢复全量基准，再依次应用之后的增量并删除其中记录的已删除文件。
+COPY_BUFFER = 1024 * 1024
+VOLUME_RE = re.compile(r"\.(\d{3})$")
+
+def _download_conf():
+    conf = cfg["123pan_http"]
+    return max(1, int(conf.get("download_workers", 4))), max(1, int(conf.get("download_block_mib", 8))) * 1048576
+
+class RemoteFile:
+    """云端文件；下载地址按需获取，下载失败时重新获取"""
+    def __init__(self, token, file_id, name, size):
+        self.token = token
+        self.file_id = file_id
+        self.name = name
+        self.size = size
+        self._url = None
+        self._lock = threading.Lock()
+
+    def url(self, refresh=False):
+        with self._lock:
+            if refresh or self._url is None:
+                self._url = download_url_http(self.token, self.file_id)
+            return self._url
+
+def fetch_range(remote, start, end) -> bytes:
+    """下载 [start, end] 闭区间；连接中断时从已收到的位置继续，最多重试 5 次"""
+    buf = bytearray()
+    want = end - start + 1
+    attempt = 0
+    while len(buf) < want:
+        try:
+            r = _http.get(remote.url(refresh=attempt > 0), headers={"Range": f"bytes={start + len(buf)}-{end}"},
+                          stream=True, timeout=(30, 300))
+            if r.status_code not in (200, 206):
+                raise RuntimeError(f"下载返回 {r.status_code}")
+            if r.status_code == 200 and start + len(buf) > 0:
+                raise RuntimeError("下载服务器不支持 Range 请求")
+            for chunk in r.iter_content(COPY_BUFFER):
+                buf += chunk[:want - len(buf)]
+                if len(buf) >= want:
+                    break
+            r.close()
+            if len(buf) < want:
+                raise IOError(f"连接提前结束 ({len(buf)}/{want})")
+        except Exception as e:
+            attempt += 1
+            if attempt > 5:
+                raise
+            logger.warning("下载 %s [%d-%d] 失败 %d/5，从 %d 继续: %s", remote.name, start, end, attempt,
+                           start + len(buf), e)
+            time.sleep(min(30, 2**attempt))
+    return bytes(buf)
+
+def ordered_map(executor, fn, items, window):
+    """并行执行 fn(item)，按 items 的顺序产出结果，最多 window 个任务在途（限制内存占用）"""
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+class ConcatStream(io.RawIOBase):
+    """把多个云端文件按顺序拼接成一个只读流，分段并行下载、按顺序交付"""
+    def __init__(self, remotes, executor, workers, block):
+        blocks = ((r, off, min(off + block, r.size) - 1) for r in remotes for off in range(0, r.size, block))
+        self._results = ordered_map(executor, lambda b: fetch_range(*b), blocks, workers * 2)
+        self._buf = memoryview(b"")
+        self.downloaded = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buf:
+            data = next(self._results, None)
+            if data is None:
+                return 0
+            self._buf = memoryview(data)
+            self.downloaded += len(data)
+        n = min(len(b), len(self._buf))
+        b[:n] = self._buf[:n]
+        self._buf = self._buf[n:]
+        return n
+
+def download_file(remote, dest: Path, executor, block):
+    """
+    并行分段下载到 dest。已完成的分段记录在 dest.part.json 中，
+    中断后再次执行只下载缺少的分段。
+    """
+    if dest.exists() and dest.stat().st_size == remote.size:
+        return
+    part = dest.with_name(dest.name + ".part")
+    progress = dest.with_name(dest.name + ".part.json")
+    done = set()
+    if part.exists() and part.stat().st_size == remote.size:
+        try:
+            done = set(json.loads(progress.read_text(encoding="utf-8")))
+        except (OSError, ValueError):
+            done = set()
+    else:
+        with open(part, "wb") as f:
+            f.truncate(remote.size)
+    if done:
+        logger.info("继续下载 %s，已完成 %d 段", remote.name, len(done))
+    lock = threading.Lock()
+
+    def one(offset):
+        data = fetch_range(remote, offset, min(offset + block, remote.size) - 1)
+        with open(part, "r+b") as f:
+            f.seek(offset)
+            f.write(data)
+        with lock:
+            done.add(offset)
+            tmp = progress.with_name(progress.name + ".tmp")
+            tmp.write_text(json.dumps(sorted(done)), encoding="utf-8")
+            os.replace(tmp, progress)
+
+    futures = [executor.submit(one, off) for off in range(0, remote.size, block) if off not in done]
+    for future in futures:
+        future.result()
+    os.replace(part, dest)
+    if progress.exists():
+        progress.unlink()
+
+# --- 路径选择 ---
+def member_path(name, strip):
+    """归档内路径 -> 相对服务器目录的路径；全量备份的归档多一层服务器目录名"""
+    parts = [p for p in PurePosixPath(name).parts if p not in ("", ".", "/")]
+    if strip:
+        parts = parts[1:]
+    if not parts or ".." in parts:
+        return None
+    return "/".join(parts)
+
+def selected(rel, patterns):
+    if not patterns:
+        return True
+    for p in patterns:
+        p = p.strip("/")
+        if rel == p or rel.startswith(p + "/") or fnmatch.fnmatchcase(rel, p):
+            return True
+    return False
+
+def write_file(dest: Path, src, mtime=None, mode=None):
+    """先写入临时文件再替换，中途失败不会留下半个文件"""
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    tmp = dest.with_name(dest.name + ".restore-tmp")
+    with open(tmp, "wb") as f:
+        if isinstance(src, (bytes, bytearray)):
+            f.write(src)
+        else:
+            shutil.copyfileobj(src, f, COPY_BUFFER)
+    if mode is not None:
+        os.chmod(tmp, mode)
+    os.replace(tmp, dest)
+    if mtime is not None:
+        os.utime(dest, (mtime, mtime))
+
+# --- 各格式的恢复 ---
+def extract_tar_stream(stream, target: Path, patterns, strip):
+    """从 tar+zstd 流中只提取选中的普通文件与目录，返回提取的文件数"""
+    if zstandard is None:
+        raise RuntimeError("恢复 tar+zstd 备份需要安装 zstandard: uv sync --extra zstd")
+    count = 0
+    reader = zstandard.ZstdDecompressor().stream_reader(stream, read_across_frames=True)
+    with tarfile.open(fileobj=reader, mode="r|") as tar:
+        for m in tar:
+            rel = member_path(m.name, strip)
+            if rel is None or not selected(rel, patterns):
+                continue
+            if m.isdir():
+                (target / rel).mkdir(parents=True, exist_ok=True)
+            elif m.isfile():
+                write_file(target / rel, tar.extractfile(m), m.mtime, m.mode)
+                count += 1
+            else:
+                logger.warning("跳过非普通文件: %s", m.name)
+    return count
+
+def _archive_prefix(first_volume):
+    """7z 全量备份归档内的顶层目录名"""
+    out = subprocess.run([cfg["server"]["compress_cmd"], "l", "-ba", "-slt", first_volume],
+                         capture_output=True, text=True, check=True).stdout
+    for line in out.splitlines():
+        if line.startswith("Path = "):
+            return PurePosixPath(line[7:].replace("\\", "/")).parts[0]
+    raise RuntimeError(f"无法读取归档目录: {first_volume}")
+
+def extract_7z(first_volume, target: Path, patterns, strip):
+    """把选中的路径解压到目标目录下的临时目录，再移动到位，返回文件数"""
+    prefix = _archive_prefix(first_volume) if strip else None
+    names = [f"{prefix}/{p.strip('/')}" if prefix else p.strip("/") for p in patterns]
+    staging = Path(tempfile.mkdtemp(prefix=".mcbackup-restore-", dir=target))
+    try:
+        cmd = [cfg["server"]["compress_cmd"], "x", "-y", f"-o{staging}", first_volume] + names
+        logger.info("执行解压: %s", " ".join(cmd))
+        subprocess.check_call(cmd, stdout=subprocess.DEVNULL)
+        root = staging / prefix if prefix else staging
+        count = 0
+        for dirpath, _, filenames in os.walk(root):
+            for name in filenames:
+                src = Path(dirpath) / name
+                rel = src.relative_to(root).as_posix()
+                if not selected(rel, patterns):
+                    continue
+                (target / rel).parent.mkdir(parents=True, exist_ok=True)
+                shutil.move(str(src), str(target / rel))
+                count += 1
+        return count
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+def _volumes(token, entry):
+    files = [f for f in entry["files"] if VOLUME_RE.search(f["name"])]
+    files.sort(key=lambda f: int(VOLUME_RE.search(f["name"]).group(1)))
+    return [RemoteFile(token, f["id"], f["name"], f["size"]) for f in files]
+
+def restore_archive(token, key, entry, target: Path, patterns, executor):
+    """恢复一个 7z 或 tar+zstd 备份中选中的路径，返回 (文件数, 下载字节数)"""
+    workers, block = _download_conf()
+    volumes = _volumes(token, entry)
+    if not volumes:
+        return 0, 0
+    strip = entry["kind"] == "full"
+    if key.endswith(".tar.zst"):
+        stream = ConcatStream(volumes, executor, workers, block)
+        return extract_tar_stream(stream, target, patterns, strip), stream.downloaded
+    download_dir = Path(cfg["server"]["backup_dir"]) / "restore" / ".download" / key
+    download_dir.mkdir(parents=True, exist_ok=True)
+    for v in volumes:
+        download_file(v, download_dir / v.name, executor, block)
+    count = extract_7z(str(download_dir / volumes[0].name), target, patterns, strip)
+    shutil.rmtree(download_dir, ignore_errors=True)
+    return count, sum(v.size for v in volumes)
+
+def fetch_json(token, f):
+    """下载云端的小型 JSON 文件（快照清单、增量清单、校验清单）"""
+    return json.loads(fetch_range(RemoteFile(token, f["id"], f["name"], f["size"]), 0, f["size"] - 1))
+
+def restore_snapshot(token, entry, packs_folder, target: Path, patterns, executor):
+    """按块位置只下载选中文件用到的区间（本地已有的 pack 直接读取），返回 (文件数, 下载字节数)"""
+    workers, _ = _download_conf()
+    snapshot = fetch_json(token, entry["files"][0])
+    locations = snapshot.get("locations")
+    if locations is None:
+        index_path = store_dir() / "index.json"
+        if not index_path.exists():
+            raise RuntimeError("快照中没有块位置信息，本地也没有块索引，无法恢复")
+        locations = json.loads(index_path.read_text(encoding="utf-8"))
+    remote_packs = {}
+    if packs_folder is not None:
+        for item in list_folder_http(token, packs_folder):
+            name, fid, _ = _entry(item)
+            remote_packs[name] = RemoteFile(token, fid, name, int(item.get("size") or 0))
+    local_packs = store_dir() / "packs"
+    downloaded = [0]
+
+    def read_chunk(chunk_id):
+        pack, offset, length, compressed = locations[chunk_id]
+        local = local_packs / pack
+        if local.exists():
+            with open(local, "rb") as f:
+                f.seek(offset)
+                data = f.read(length)
+        elif pack in remote_packs:
+            data = fetch_range(remote_packs[pack], offset, offset + length - 1)
+            downloaded[0] += length
+        else:
+            raise RuntimeError(f"云端缺少 pack: {pack}")
+        data = zlib.decompress(data) if compressed else data
+        if hashlib.sha256(data).hexdigest() != chunk_id:
+            raise RuntimeError(f"块校验失败: {chunk_id}")
+        return data
+
+    strip = snapshot["kind"] == "full"
+    count = 0
+    for entry_file in snapshot["files"]:
+        rel = member_path(entry_file["path"], strip)
+        if rel is None or not selected(rel, patterns):
+            continue
+        dest = target / rel
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        tmp = dest.with_name(dest.name + ".restore-tmp")
+        with open(tmp, "wb") as f:
+            for data in ordered_map(executor, read_chunk, entry_file["chunks"], workers * 2):
+                f.write(data)
+        os.chmod(tmp, entry_file["mode"])
+        os.replace(tmp, dest)
+        os.utime(dest, ns=(entry_file["mtime"], entry_file["mtime"]))
+        count += 1
+    return count, downloaded[0]
+
+def restore_chain(token, sets, key):
+    """增量备份需要先恢复全量基准再依次应用之后的增量，返回 [(备份键, 增量 manifest)]"""
+    chain = []
+    while True:
+        entry = sets.get(key)
+        if entry is None:
+            raise RuntimeError(f"增量链不完整，云端缺少备份 {key}")
+        if entry["kind"] != "incr":
+            chain.append((key, None))
+            return chain[::-1]
+        f = next((f for f in entry["files"] if f["name"].endswith(".manifest.json")), None)
+        if f is None:
+            raise RuntimeError(f"增量备份缺少 manifest: {key}")
+        manifest = fetch_json(token, f)
+        chain.append((key, manifest))
+        key = manifest.get("parent") or manifest.get("base")
+
+def _check_target(target: Path, force):
+    """恢复到服务器目录时要求服务器已停止，避免运行中的服务器覆盖恢复的文件"""
+    server_dir = Path(cfg["server"]["server_dir"]).resolve()
+    resolved = target.resolve()
+    if resolved != server_dir and server_dir not in resolved.parents:
+        return
+    if force:
+        logger.warning("恢复到服务器目录且未检查服务器状态 (--force): %s", target)
+        return
+    try:
+        status = mcs_status()
+    except Exception as e:
+        raise RuntimeError(f"无法确认服务器已停止（{e}），如确认已停止请加 --force")
+    if status != STATUS_STOPPED:
+        raise RuntimeError("服务器仍在运行，请先停止服务器再恢复到服务器目录")
+
+def restore_backup(key, patterns=(), target=None, force=False):
+    """把备份 key（或 latest）中选中的路径恢复到 target，返回恢复的文件数"""
+    token = get_access_token_http()
+    sets, _, packs_folder = scan_remote(token)
+    if not sets:
+        raise RuntimeError("云端没有可恢复的备份")
+    if key == "latest":
+        key = max(sets, key=lambda k: sets[k]["time"])
+    if key not in sets:
+        raise RuntimeError(f"云端没有备份 {key}，请先不带参数执行 restore 查看列表")
+    target = Path(target or Path(cfg["server"]["backup_dir"]) / "restore" / key)
+    _check_target(target, force)
+    target.mkdir(parents=True, exist_ok=True)
+    workers, _ = _download_conf()
+    logger.info("开始恢复 %s -> %s（%s）", key, target, ", ".join(patterns) or "全部文件")
+    started = time.time()
+    files = downloaded = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        if sets[key]["kind"] == "snapshot":
+            files, downloaded = restore_snapshot(token, sets[key], packs_folder, target, patterns, executor)
+        else:
+            for k, manifest in restore_chain(token, sets, key):
+                n, d = restore_archive(token, k, sets[k], target, patterns, executor)
+                files += n
+                downloaded += d
+                for rel in (manifest or {}).get("deleted", []):
+                    if selected(rel, patterns) and (target / rel).is_file():
+                        (target / rel).unlink()
+                logger.info("已应用 %s: %d 个文件", k, n)
+    elapsed = max(time.time() - started, 1e-6)
+    logger.info("恢复完成: %d 个文件，下载 %.1f MiB，%.1f MiB/s，耗时 %.1fs", files, downloaded / 1048576,
+                downloaded / 1048576 / elapsed, elapsed)
+    return files
+
+def print_backups():
+    token = get_access_token_http()
+    sets, _, _ = scan_remote(token)
+    if not sets:
+        print("云端没有可恢复的备份")
+        return
+    for key in sorted(sets, key=lambda k: sets[k]["time"]):
+        entry = sets[key]
+        size = sum(f["size"] for f in entry["files"])
+        print(f"{entry['time']:%Y-%m-%d %H:%M:%S}  {entry['kind']:<8} {key}  "
+              f"{len(entry['files'])} 个文件  {size / 1048576:.1f} MiB")
+
+def restore_main(argv):
+    parser = argparse.ArgumentParser(prog="main.py restore", description="从 123pan 恢复备份；不带参数时列出云端备份")
+    parser.add_argument("backup", nargs="?", help="备份名（见列表）或 latest")
+    parser.add_argument("paths", nargs="*", help="只恢复这些路径（相对服务器目录，如 world_nether、world/region/r.0.0.mca，支持通配符）")
+    parser.add_argument("--target", help="恢复到的目录，默认 backup_dir/restore/<备份名>")
+    parser.add_argument("--instance", help="多实例时指定实例名")
+    parser.add_argument("--force", action="store_true", help="恢复到服务器目录时不检查服务器是否已停止")
+    args = parser.parse_args(argv)
+    if instance_list() and not args.instance:
+        parser.error("已配置多实例，请用 --instance 指定实例")
+    with use_instance(args.instance):
+        if not args.backup:
+            print_backups()
+            return 0
+        try:
+            restore_backup(args.backup, args.paths, args.target, args.force)
+        except Exception as e:
+            logger.error("恢复失败: %s", e)
+            return 1
+    return 0
@@ -0,0 +1,190 @@
+import re
+import datetime
+from pathlib import Path
+from log_api import logger
+from config import cfg
+from state_api import load_state, save_state
+from pan_api import get_access_token_http, list_folder_http, trash_files_http, instance_folder_id
+from chunk_api import store_conf, list_snapshots, delete_snapshot, gc, remote_packs
+
+# --- 备份保留策略：按 keep_days / keep_count 清理本地与云端的旧备份 ---
+# 同一备份的所有分卷与 manifest 共用一个键，例如 mc_world_backup_20250101_030000.7z
+BACKUP_RE = re.compile(r"^(mc_(full|world|incr)_backup_(\d{8}_\d{6})\.(?:7z|tar\.zst))(?:\..+)?$")
+SNAPSHOT_RE = re.compile(r"^mc_(full|world)_snapshot_(\d{8}_\d{6})\.json$")
+DATE_FOLDER_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+def parse_backup_name(name):
+    """返回 (备份键, 类型, 时间)，不是本程序产生的文件返回 None"""
+    m = BACKUP_RE.match(name)
+    if m:
+        return m.group(1), m.group(2), datetime.datetime.strptime(m.group(3), "%Y%m%d_%H%M%S")
+    m = SNAPSHOT_RE.match(name)
+    if m:
+        return name, "snapshot", datetime.datetime.strptime(m.group(2), "%Y%m%d_%H%M%S")
+    return None
+
+def select_expired(backups: dict, now=None) -> set:
+    """
+    backups: 备份键 -> (类型, 时间)。保留最新的 keep_count 个以及 keep_days 天内的全部备份，
+    被保留的增量备份所依赖的全量基准与之前的增量也一并保留。返回应删除的备份键。
+    """
+    conf = cfg.get("backup", {})
+    keep_days = conf.get("keep_days", 7)
+    keep_count = max(1, conf.get("keep_count", 10))
+    now = now or datetime.datetime.now()
+    newest_first = sorted(backups, key=lambda k: backups[k][1], reverse=True)
+    keep = set(newest_first[:keep_count])
+    keep.update(k for k in newest_first if now - backups[k][1] < datetime.timedelta(days=keep_days))
+
+    chrono = newest_first[::-1]
+    for i, key in enumerate(chrono):
+        if backups[key][0] != "incr" or key not in keep:
+            continue
+        for prev in reversed(chrono[:i]):
+            kind = backups[prev][0]
+            if kind == "incr":
+                keep.add(prev)
+            elif kind == "world":
+                keep.add(prev)
+                break
+    return set(backups) - keep
+
+def local_backup_sets():
+    """扫描 backup_dir，按备份键把分卷与附属文件归组"""
+    sets = {}
+    for p in Path(cfg["server"]["backup_dir"]).iterdir():
+        parsed = parse_backup_name(p.name) if p.is_file() else None
+        if parsed:
+            key, kind, when = parsed
+            sets.setdefault(key, {"kind": kind, "time": when, "files": []})["files"].append(p)
+    return sets
+
+def pending_upload_paths() -> set:
+    """上传队列中尚未结束的任务（待传、失败重试、等待校验）的分卷，以及有断点续传记录的文件"""
+    paths = set(load_state("uploads.json", {}, shared=True))
+    for job in load_state("upload_queue.json", {}, shared=True).get("jobs", []):
+        paths.update(str(Path(p["path"]).resolve()) for p in job["parts"])
+    return paths
+
+def prune_local(dry_run=False):
+    sets = local_backup_sets()
+    expired = select_expired({k: (v["kind"], v["time"]) for k, v in sets.items()})
+    busy = pending_upload_paths()
+    for key in sorted(expired):
+        if any(str(p.resolve()) in busy for p in sets[key]["files"]):
+            logger.warning("过期备份仍有未完成的上传，暂不删除本地文件: %s", key)
+            expired.discard(key)
+            continue
+        logger.info("%s本地过期备份: %s (%d 个文件)", "[dry-run] " if dry_run else "", key, len(sets[key]["files"]))
+        if not dry_run:
+            for p in sets[key]["files"]:
+                try:
+                    p.unlink()
+                except OSError as e:
+                    logger.warning("删除本地文件失败 %s: %s", p, e)
+
+    dead_packs = []
+    if not Path(store_conf()["dir"]).exists():
+        return sorted(expired), dead_packs
+    snapshots = {name: ("snapshot", parse_backup_name(name)[2]) for name in list_snapshots()}
+    expired_snapshots = select_expired(snapshots)
+    for name in sorted(expired_snapshots):
+        logger.info("%s过期块存储快照: %s", "[dry-run] " if dry_run else "", name)
+        if not dry_run:
+            delete_snapshot(name)
+    if snapshots:
+        dead_packs = gc(dry_run=dry_run)
+    return sorted(expired), dead_packs
+
+def _entry(f):
+    name = f.get("filename") or f.get("name")
+    fid = f.get("fileId") or f.get("fileID") or f.get("id")
+    try:
+        ftype = int(f.get("type"))
+    except Exception:
+        ftype = None
+    return name, fid, ftype
+
+def scan_remote(token):
+    """
+    列出备份根目录下的日期目录并按备份键归组，返回 (sets, folders, packs_folder)：
+    sets 为 备份键 -> {"kind", "time", "files": [{"folder", "id", "name", "size", "etag"}]}，
+    folders 为 日期目录ID -> {"name", "keys", "other"}。
+    """
+    parent_id = instance_folder_id(token, cfg["123pan_http"].get("parent_folder_id", 0) or 0)
+    sets = {}
+    folders = {}
+    packs_folder = None
+    for f in list_folder_http(token, parent_id):
+        name, fid, ftype = _entry(f)
+        if ftype != 1 or f.get("trashed"):
+            continue
+        if name == "packs":
+            packs_folder = fid
+        if not DATE_FOLDER_RE.match(name or ""):
+            continue
+        members = folders.setdefault(fid, {"name": name, "keys": set(), "other": 0})
+        for item in list_folder_http(token, fid):
+            iname, iid, _ = _entry(item)
+            if item.get("trashed"):
+                continue
+            parsed = parse_backup_name(iname or "")
+            if not parsed:
+                members["other"] += 1
+                continue
+            key, kind, when = parsed
+            members["keys"].add(key)
+            sets.setdefault(key, {"kind": kind, "time": when, "files": []})["files"].append(
+                {"folder": fid, "id": iid, "name": iname, "size": int(item.get("size") or 0), "etag": item.get("etag")})
+    return sets, folders, packs_folder
+
+def prune_remote(token, dead_packs=(), dry_run=False):
+    """
+    列出父目录下的日期目录并按备份键归组：日期目录内全部过期时整个目录移入回收站，
+    否则只删除过期备份的文件。块存储回收掉的 pack 同样从云端 packs 目录删除。
+    """
+    sets, folders, packs_folder = scan_remote(token)
+    expired = select_expired({k: (v["kind"], v["time"]) for k, v in sets.items()})
+    to_trash = []
+    for fid, members in folders.items():
+        if members["keys"] and not members["other"] and members["keys"] <= expired:
+            logger.info("%s云端过期日期目录: %s", "[dry-run] " if dry_run else "", members["name"])
+            to_trash.append(fid)
+            continue
+        for key in members["keys"] & expired:
+            logger.info("%s云端过期备份: %s/%s", "[dry-run] " if dry_run else "", members["name"], key)
+            to_trash.extend(f["id"] for f in sets[key]["files"] if f["folder"] == fid)
+
+    if dead_packs and packs_folder is not None:
+        # 回收之后又有快照重新生成并上传了同名 pack 时，云端的这个 pack 仍在使用（dry-run 不会改动记录）
+        dead = set(dead_packs) if dry_run else set(dead_packs) - set(remote_packs())
+        for item in list_folder_http(token, packs_folder):
+            iname, iid, _ = _entry(item)
+            if iname in dead:
+                to_trash.append(iid)
+
+    if to_trash and not dry_run:
+        trash_files_http(token, to_trash)
+        # 主动删除的备份不再由 verify 核对
+        index = load_state("verify_index.json", {})
+        if expired & set(index):
+            save_state("verify_index.json", {k: v for k, v in index.items() if k not in expired})
+    return to_trash
+
+def apply_retention(dry_run=None):
+    """执行保留策略（本地 + 云端）。dry_run 为 None 时读取 backup.retention_dry_run"""
+    if dry_run is None:
+        dry_run = cfg.get("backup", {}).get("retention_dry_run", False)
+    logger.info("=== 执行备份保留策略%s ===", "（dry-run，不会删除任何文件）" if dry_run else "")
+    try:
+        expired_local, dead_packs = prune_local(dry_run)
+    except Exception as e:
+        logger.exception("本地保留策略执行失败: %s", e)
+        expired_local, dead_packs = [], []
+    try:
+        token = get_access_token_http()
+        trashed = prune_remote(token, dead_packs, dry_run)
+    except Exception as e:
+        logger.exception("云端保留策略执行失败: %s", e)
+        trashed = []
+    logger.info("保留策略完成: 本地过期备份 %d 个，云端待删除 %d 项", len(expired_local), len(trashed))
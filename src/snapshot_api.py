@@ -0,0 +1,89 @@
+import os
+import time
+import shutil
+import errno
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from log_api import logger
+from config import cfg
+from state_api import state_dir
+from metrics_api import timed
+
+# --- 热备份暂存快照：save-off 期间只做快速复制，压缩在 save-on 之后进行 ---
+FICLONE = 0x40049409  # linux/fs.h: _IOW(0x94, 9, int)
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+# 已确认不支持 reflink 的 (源设备, 目标设备)：同一进程里暂存目录可能位于不同文件系统（多实例各自的 snapshot_dir）
+_no_reflink = set()
+
+def _devices(src: Path, dst_dir: Path):
+    return src.stat().st_dev, dst_dir.stat().st_dev
+
+def _reflink(src: Path, dst: Path) -> bool:
+    """尝试 reflink（btrfs/xfs 等写时复制文件系统），不支持时返回 False"""
+    if fcntl is None:
+        return False
+    devices = _devices(src, dst.parent)
+    if devices in _no_reflink:
+        return False
+    with src.open("rb") as s, dst.open("wb") as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+            return True
+        except OSError as e:
+            if e.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS):
+                _no_reflink.add(devices)
+                return False
+            raise
+
+def _copy_one(src: Path, dst: Path):
+    if not _reflink(src, dst):
+        shutil.copyfile(src, dst)
+    # 保留 mtime，增量索引才能与原目录的扫描结果对得上
+    shutil.copystat(src, dst)
+    return src.stat().st_size
+
+def snapshot_root() -> Path:
+    return Path(cfg["server"].get("snapshot_dir") or state_dir() / "snapshot")
+
+@timed("snapshot")
+def take_snapshot(world_folders=None) -> Path:
+    """
+    把世界文件夹复制到暂存目录并返回该目录。优先使用 reflink，
+    否则多线程并行复制。区域文件会被服务器原地改写，不能用硬链接代替复制。
+    """
+    server_dir = Path(cfg["server"]["server_dir"])
+    world_folders = world_folders or cfg["server"].get("world_folders", ["world"])
+    dest_root = snapshot_root()
+    remove_snapshot()
+    dest_root.mkdir(parents=True, exist_ok=True)
+    started = time.time()
+
+    jobs = []
+    for w in world_folders:
+        base = server_dir / w
+        if not base.exists():
+            continue
+        for dirpath, _, filenames in os.walk(base):
+            rel_dir = Path(dirpath).relative_to(server_dir)
+            (dest_root / rel_dir).mkdir(parents=True, exist_ok=True)
+            for name in filenames:
+                src = Path(dirpath) / name
+                if src.is_symlink() or not src.is_file():
+                    continue
+                jobs.append((src, dest_root / rel_dir / name))
+
+    workers = max(1, int(cfg["server"].get("snapshot_workers", 8)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        total = sum(executor.map(lambda job: _copy_one(*job), jobs))
+    elapsed = time.time() - started
+    logger.info("暂存快照完成: %d 个文件, %.1f MiB, 耗时 %.1fs (%s)", len(jobs), total / 1048576, elapsed,
+                "reflink" if fcntl and _devices(server_dir, dest_root) not in _no_reflink else "并行复制")
+    return dest_root
+
+def remove_snapshot():
+    root = snapshot_root()
+    if root.exists():
+        shutil.rmtree(root, ignore_errors=True)
@@ -0,0 +1,41 @@
+import json
+import os
+from pathlib import Path
+from config import cfg
+
+# --- 本地状态文件（位于 backup_dir/.mcbackup 下） ---
+# 多实例时每个实例有自己的状态目录；shared=True 的状态（token、目录索引、上传队列等
+# 进程内共用的资源）始终位于全局 backup_dir 下。
+def state_dir(shared=False) -> Path:
+    server = cfg.base("server") if shared else cfg["server"]
+    d = Path(server["backup_dir"]) / ".mcbackup"
+    d.mkdir(parents=True, exist_ok=True)
+    return d
+
+def load_state(name, default=None, shared=False):
+    """读取状态文件，不存在或损坏时返回 default"""
+    path = state_dir(shared) / name
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+def save_state(name, data, mode=None, shared=False):
+    """原子写入状态文件，避免进程中断留下半个 JSON；mode 指定文件权限（如 0o600）"""
+    path = state_dir(shared) / name
+    tmp = path.with_name(path.name + ".tmp")
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666 if mode is None else mode)
+    if mode is not None:
+        os.chmod(tmp, mode)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def append_state(name, entry, limit=200):
+    """向列表型状态文件追加一条记录，只保留最近 limit 条"""
+    history = load_state(name, [])
+    history.append(entry)
+    save_state(name, history[-limit:])
@@ -0,0 +1,51 @@
+import datetime
+import pytest
+from config import cfg
+from bandwidth_api import profile_limit
+
+PROFILES = [
+    {"start": "22:00", "end": "06:00", "limit_kib": 100},
+    {"start": "08:00", "end": "18:00", "limit_kib": 200},
+    # 与上一条重叠，后面的条目优先
+    {"start": "12:00", "end": "13:00", "limit_kib": 300},
+    # 与跨午夜的第一条重叠
+    {"start": "05:00", "end": "07:00", "limit_kib": 400},
+]
+
+@pytest.fixture
+def profiles(monkeypatch):
+    monkeypatch.setitem(cfg, "bandwidth", {"limit_kib": 50, "profiles": PROFILES})
+
+def at(hhmm):
+    hh, mm = map(int, hhmm.split(":"))
+    return datetime.datetime(2025, 1, 5, hh, mm)
+
+@pytest.mark.parametrize("now,kib", [
+    ("21:59", 50),
+    ("22:00", 100),
+    ("23:59", 100),
+    ("00:00", 100),
+    ("04:59", 100),
+    ("05:00", 400),
+    ("06:00", 400),
+    ("07:00", 50),
+    ("08:00", 200),
+    ("11:59", 200),
+    ("12:00", 300),
+    ("12:59", 300),
+    ("13:00", 200),
+    ("18:00", 50),
+])
+def test_profile_limit(profiles, now, kib):
+    assert profile_limit(at(now)) == kib * 1024
+
+def test_profile_limit_without_profiles(monkeypatch):
+    monkeypatch.setitem(cfg, "bandwidth", {})
+    assert profile_limit(at("12:00")) == 0
+
+def test_later_profile_wins_even_when_unlimited(monkeypatch):
+    monkeypatch.setitem(cfg, "bandwidth", {"limit_kib": 50, "profiles": [
+        {"start": "00:00", "end": "23:59", "limit_kib": 100},
+        {"start": "22:00", "end": "02:00", "limit_kib": 0}]})
+    assert profile_limit(at("01:00")) == 0
+    assert profile_limit(at("03:00")) == 100 * 1024
@@ -0,0 +1,57 @@
+import os
+import json
+import pytest
+import pan_api
+import retention_api
+from config import cfg
+from chunk_api import create_snapshot, delete_snapshot, gc, remote_packs, mark_remote_pack
+from retention_api import prune_remote
+
+@pytest.fixture
+def backup_dir(monkeypatch, tmp_path):
+    monkeypatch.setitem(cfg["server"], "backup_dir", str(tmp_path))
+    return tmp_path
+
+@pytest.fixture
+def world(tmp_path):
+    root = tmp_path / "server"
+    (root / "world" / "region").mkdir(parents=True)
+    (root / "world" / "region" / "r.0.0.mca").write_bytes(b"region" * 5000)
+    return root
+
+def packs_of(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)["packs"]
+
+def test_gc_forgets_remote_packs_so_same_content_is_uploaded_again(backup_dir, world, monkeypatch):
+    first = create_snapshot("world", world, ["world"])
+    packs = packs_of(first)
+    for pack in packs:
+        mark_remote_pack(pack)
+
+    delete_snapshot(os.path.basename(first))
+    assert gc() == packs
+    assert not set(packs) & set(remote_packs())
+
+    # 内容相同的新快照生成同名 pack，云端那份已随回收进入回收站，必须重新上传
+    second = create_snapshot("world", world, ["world"])
+    assert packs_of(second) == packs
+    uploaded = []
+    monkeypatch.setattr(pan_api, "_prepare_upload_target", lambda date_str=None: ("token", 1, 2))
+    monkeypatch.setattr(pan_api, "get_or_create_date_folder", lambda token, parent, name: 3)
+    monkeypatch.setattr(pan_api, "_upload_part", lambda token, folder, path, keep_local=False: uploaded.append((folder, path)) or True)
+    assert pan_api.upload_chunk_snapshot(second)
+    assert [os.path.basename(p) for folder, p in uploaded if folder == 3] == packs
+    assert set(packs) <= set(remote_packs())
+
+def test_prune_remote_keeps_pack_reuploaded_after_gc(backup_dir, world, monkeypatch):
+    packs = packs_of(create_snapshot("world", world, ["world"]))
+    # 本地回收时该 pack 已失效，但在云端清理之前又被新快照重新上传
+    mark_remote_pack(packs[0])
+    items = [{"fileId": 7, "filename": packs[0], "type": 0}, {"fileId": 8, "filename": "pack-dead.pack", "type": 0}]
+    monkeypatch.setattr(retention_api, "scan_remote", lambda token: ({}, {}, 5))
+    monkeypatch.setattr(retention_api, "list_folder_http", lambda token, folder: items)
+    trashed = []
+    monkeypatch.setattr(retention_api, "trash_files_http", lambda token, ids: trashed.extend(ids))
+    assert prune_remote("token", [packs[0], "pack-dead.pack"]) == [8]
+    assert trashed == [8]
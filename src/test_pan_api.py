@@ -0,0 +1,83 @@
+import os
+import hashlib
+import pytest
+from config import cfg
+from state_api import load_state
+from pan_api import digest_file, SliceBody, STREAM_BUFFER
+
+@pytest.fixture
+def backup_dir(monkeypatch, tmp_path):
+    monkeypatch.setitem(cfg["server"], "backup_dir", str(tmp_path))
+    return tmp_path
+
+def md5(data):
+    return hashlib.md5(data).hexdigest()
+
+def slice_md5s(data, size):
+    return [md5(data[i:i + size]) for i in range(0, len(data), size)]
+
+def test_digest_matches_whole_file_and_slices(backup_dir):
+    data = os.urandom(10_000)
+    path = backup_dir / "a.7z.001"
+    path.write_bytes(data)
+    entry = digest_file(path, 4096)
+    assert entry["etag"] == md5(data)
+    assert entry["slices"]["4096"] == slice_md5s(data, 4096)
+    assert entry["size"] == len(data)
+
+def test_digest_cache_hit_does_not_reread(backup_dir):
+    path = backup_dir / "a.7z.001"
+    path.write_bytes(b"a" * 5000)
+    first = digest_file(path, 1024)
+    st = path.stat()
+    # 同样大小、同样 mtime 的不同内容：命中缓存时不会重新读取，返回的仍是旧摘要
+    path.write_bytes(b"b" * 5000)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert digest_file(path, 1024) == first
+    assert str(path.resolve()) in load_state("digests.json", shared=True)["files"]
+
+def test_digest_cache_invalidated_by_mtime(backup_dir):
+    path = backup_dir / "a.7z.001"
+    path.write_bytes(b"a" * 5000)
+    digest_file(path, 1024)
+    st = path.stat()
+    path.write_bytes(b"b" * 5000)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+    entry = digest_file(path, 1024)
+    assert entry["etag"] == md5(b"b" * 5000)
+    assert entry["slices"] == {"1024": slice_md5s(b"b" * 5000, 1024)}
+
+def test_digest_realigns_when_slice_size_changes(backup_dir):
+    data = os.urandom(9_000)
+    path = backup_dir / "a.7z.001"
+    path.write_bytes(data)
+    digest_file(path, 4096)
+    entry = digest_file(path, 2000)
+    assert entry["etag"] == md5(data)
+    assert entry["slices"]["4096"] == slice_md5s(data, 4096)
+    assert entry["slices"]["2000"] == slice_md5s(data, 2000)
+
+@pytest.mark.parametrize("offset,length", [(0, 10), (5, STREAM_BUFFER + 17), (STREAM_BUFFER, 0)])
+def test_slice_body_length_matches_bytes_yielded(tmp_path, offset, length):
+    data = os.urandom(STREAM_BUFFER * 2 + 100)
+    path = tmp_path / "a.7z.001"
+    path.write_bytes(data)
+    body = SliceBody(path, offset, length, {"preuploadID": "p", "sliceNo": "1", "sliceMD5": "m"})
+    sent = b"".join(body)
+    assert len(sent) == len(body)
+    # 可重复迭代（连接层重试时从头发送）
+    assert b"".join(body) == sent
+    boundary = body.content_type.split("boundary=")[1].encode()
+    parts = sent.split(b"--" + boundary)
+    assert parts[-1] == b"--\r\n"
+    head, payload = parts[-2].split(b"\r\n\r\n", 1)
+    assert b'name="slice"' in head
+    assert payload[:-2] == data[offset:offset + length]
+    assert b'name="sliceNo"\r\n\r\n1\r\n' in sent
+
+def test_slice_body_raises_when_file_truncated(tmp_path):
+    path = tmp_path / "a.7z.001"
+    path.write_bytes(b"x" * 100)
+    body = SliceBody(path, 50, 100, {})
+    with pytest.raises(IOError):
+        b"".join(body)
@@ -0,0 +1,112 @@
+import json
+import datetime
+import pytest
+import queue_api
+import verify_api
+from config import cfg
+from state_api import load_state, save_state
+from queue_api import backup_key, upload_queue, UploadQueue, UploadSession, async_upload, MAX_ATTEMPTS
+from change_api import BackupPlan
+
+KEY = "mc_incr_backup_20250105_030000.7z"
+
+@pytest.fixture
+def backup_dir(monkeypatch, tmp_path):
+    monkeypatch.setitem(cfg["server"], "backup_dir", str(tmp_path))
+    return tmp_path
+
+@pytest.fixture
+def created(monkeypatch):
+    names = []
+    monkeypatch.setattr(upload_queue, "create_job", lambda name, **kwargs: names.append(name) or "job")
+    monkeypatch.setattr(upload_queue, "add_part", lambda job_id, path: None)
+    return names
+
+def test_backup_key_strips_volume_and_sidecar_suffixes():
+    assert backup_key(KEY + ".001") == KEY
+    assert backup_key(KEY + ".manifest.json") == KEY
+    assert backup_key("mc_world_backup_20250105_030000.tar.zst.002") == "mc_world_backup_20250105_030000.tar.zst"
+    assert backup_key("other.7z.001") == "other.7z"
+
+def test_session_names_job_after_backup_key(created, tmp_path):
+    session = UploadSession()
+    session.add(str(tmp_path / (KEY + ".002")))
+    session.add(str(tmp_path / (KEY + ".manifest.json")))
+    assert created == [KEY]
+
+def test_deletion_only_incremental_is_verified_under_backup_key(created, backup_dir, monkeypatch):
+    # 只有删除的增量备份没有分卷，唯一的文件是 .manifest.json
+    manifest = backup_dir / (KEY + ".manifest.json")
+    manifest.write_text(json.dumps({"type": "incremental", "base": "mc_world_backup_20250101_030000.7z",
+                                    "parent": "mc_world_backup_20250101_030000.7z", "changed": [],
+                                    "deleted": ["world/region/r.0.0.mca"]}), encoding="utf-8")
+    UploadSession().add(str(manifest))
+    assert created == [KEY]
+
+    assert verify_api.test_archive(KEY, [str(manifest)])
+    draft = backup_dir / verify_api.manifest_name(KEY)
+    assert draft.exists()
+    size = manifest.stat().st_size
+    etag = verify_api.digest_file(manifest)["etag"]
+    verify_api.remember(KEY, {"parts": [{"name": manifest.name, "size": size, "etag": etag}],
+                              "parent": "mc_world_backup_20250101_030000.7z"})
+    assert list(load_state("verify_index.json")) == [KEY]
+
+    # 云端按 retention_api.scan_remote 的方式归组：清单与校验清单同属一个备份键
+    remote = {
+        KEY: {"kind": "incr", "time": datetime.datetime(2025, 1, 5, 3), "files": [
+            {"folder": 1, "id": 11, "name": manifest.name, "size": size, "etag": etag},
+            {"folder": 1, "id": 12, "name": draft.name, "size": 1, "etag": "x"}]},
+        "mc_world_backup_20250101_030000.7z": {"kind": "world", "time": datetime.datetime(2025, 1, 1, 3), "files": []}
+    }
+    monkeypatch.setattr(verify_api, "get_access_token_http", lambda: "token")
+    monkeypatch.setattr(verify_api, "scan_remote", lambda token: (remote, {}, None))
+    assert verify_api.verify_backups() == 0
+    report = load_state("verify_report.json")
+    assert report["checked"] == 1
+    assert KEY not in report["unverified"]
+
+def test_verify_index_keyed_by_manifest_name_is_migrated(backup_dir, monkeypatch):
+    save_state("verify_index.json", {KEY + ".manifest.json": {"parts": {}, "parent": None, "base": None}})
+    remote = {KEY: {"kind": "incr", "time": datetime.datetime(2025, 1, 5, 3), "files": []}}
+    monkeypatch.setattr(verify_api, "get_access_token_http", lambda: "token")
+    monkeypatch.setattr(verify_api, "scan_remote", lambda token: (remote, {}, None))
+    assert verify_api.verify_backups() == 0
+    assert list(load_state("verify_index.json")) == [KEY]
+
+@pytest.fixture
+def staged(backup_dir, monkeypatch):
+    """一个独立的上传队列，以及暂存在运行 run1 名下的变化检测清单"""
+    queue = UploadQueue()
+    monkeypatch.setattr(queue_api, "upload_queue", queue)
+    monkeypatch.setattr(queue_api, "current_run_id", lambda: "run1")
+    plan = BackupPlan("hot")
+    plan.scope, plan.manifest = "world", {"world/region/r.0.0.mca": [1, 2, None]}
+    plan.stage("run1")
+    volume = backup_dir / (KEY + ".001")
+    volume.write_bytes(b"x")
+    return queue, plan, volume
+
+def test_change_manifest_saved_after_upload_succeeds(staged, monkeypatch):
+    queue, plan, volume = staged
+    results = [False, True]
+    monkeypatch.setattr(queue_api, "upload_to_date_folder", lambda path, date, keep_local=False: results.pop(0))
+    async_upload(str(volume))
+    queue.wait()
+    # 入队不等于上传成功
+    assert load_state("change_manifest.json") is None
+    queue.resume()
+    queue.wait()
+    assert load_state("change_manifest.json") == {"world": plan.manifest}
+    assert load_state("change_pending.json") == {}
+
+def test_change_manifest_dropped_when_upload_gives_up(staged, monkeypatch):
+    queue, plan, volume = staged
+    monkeypatch.setattr(queue_api, "upload_to_date_folder", lambda path, date, keep_local=False: False)
+    async_upload(str(volume))
+    for _ in range(MAX_ATTEMPTS):
+        queue.wait()
+        queue.resume()
+    queue.wait()
+    assert load_state("change_manifest.json") is None
+    assert load_state("change_pending.json") == {}
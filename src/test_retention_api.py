@@ -0,0 +1,113 @@
+import datetime
+import pytest
+from config import cfg
+from state_api import save_state
+from retention_api import parse_backup_name, select_expired, prune_local
+
+NOW = datetime.datetime(2025, 1, 20, 12, 0, 0)
+
+@pytest.fixture
+def keep(monkeypatch):
+    def set_keep(days, count):
+        monkeypatch.setitem(cfg["backup"], "keep_days", days)
+        monkeypatch.setitem(cfg["backup"], "keep_count", count)
+    return set_keep
+
+@pytest.fixture
+def backup_dir(monkeypatch, tmp_path):
+    monkeypatch.setitem(cfg["server"], "backup_dir", str(tmp_path))
+    return tmp_path
+
+def name(kind, day, hour=3):
+    return f"mc_{kind}_backup_202501{day:02d}_{hour:02d}0000.7z"
+
+def backups(*entries):
+    """(类型, 日) -> 备份键: (类型, 时间)"""
+    result = {}
+    for kind, day in entries:
+        key, parsed_kind, when = parse_backup_name(name(kind, day))
+        result[key] = (parsed_kind, when)
+    return result
+
+def test_parse_backup_name_groups_volumes_and_manifests():
+    key = name("incr", 5)
+    for suffix in ("", ".001", ".012", ".manifest.json", ".verify.json"):
+        assert parse_backup_name(key + suffix)[:2] == (key, "incr")
+    assert parse_backup_name("mc_world_backup_20250105_030000.tar.zst.003")[0] == "mc_world_backup_20250105_030000.tar.zst"
+    assert parse_backup_name("notes.txt") is None
+
+def test_keep_count_keeps_newest(keep):
+    keep(0, 2)
+    sets = backups(("world", 1), ("world", 2), ("world", 3), ("world", 4))
+    assert select_expired(sets, NOW) == {name("world", 1), name("world", 2)}
+
+def test_keep_days_keeps_recent_beyond_count(keep):
+    keep(7, 1)
+    sets = backups(("world", 5), ("world", 14), ("world", 15), ("world", 19))
+    assert select_expired(sets, NOW) == {name("world", 5)}
+
+def test_keep_count_is_at_least_one(keep):
+    keep(0, 0)
+    sets = backups(("world", 1), ("world", 2))
+    assert select_expired(sets, NOW) == {name("world", 1)}
+
+def test_retained_incremental_keeps_its_chain(keep):
+    keep(0, 1)
+    sets = backups(("world", 1), ("world", 2), ("incr", 3), ("incr", 4), ("incr", 5))
+    # 最新的增量依赖 5 日之前的增量直到最近的全量基准（2 日），更早的基准可以删除
+    assert select_expired(sets, NOW) == {name("world", 1)}
+
+def test_new_base_releases_old_chain(keep):
+    keep(0, 2)
+    sets = backups(("world", 1), ("incr", 2), ("incr", 3), ("world", 4), ("incr", 5))
+    assert select_expired(sets, NOW) == {name("world", 1), name("incr", 2), name("incr", 3)}
+
+def test_expired_incremental_does_not_pin_base(keep):
+    keep(0, 1)
+    sets = backups(("world", 1), ("incr", 2), ("world", 3))
+    assert select_expired(sets, NOW) == {name("world", 1), name("incr", 2)}
+
+def _write_set(directory, key, parts=(".001", ".002")):
+    paths = []
+    for suffix in parts:
+        p = directory / (key + suffix)
+        p.write_bytes(b"x")
+        paths.append(p)
+    return paths
+
+def test_prune_local_deletes_expired_sets(keep, backup_dir):
+    keep(0, 1)
+    old = _write_set(backup_dir, name("world", 1))
+    new = _write_set(backup_dir, name("world", 2))
+    expired, _ = prune_local()
+    assert expired == [name("world", 1)]
+    assert not any(p.exists() for p in old)
+    assert all(p.exists() for p in new)
+
+def test_prune_local_dry_run_keeps_files(keep, backup_dir):
+    keep(0, 1)
+    old = _write_set(backup_dir, name("world", 1))
+    _write_set(backup_dir, name("world", 2))
+    assert prune_local(dry_run=True)[0] == [name("world", 1)]
+    assert all(p.exists() for p in old)
+
+def test_prune_local_skips_sets_still_in_upload_queue(keep, backup_dir):
+    keep(0, 1)
+    queued = _write_set(backup_dir, name("world", 1))
+    failed = _write_set(backup_dir, name("world", 2))
+    _write_set(backup_dir, name("world", 3))
+    save_state("upload_queue.json", {"jobs": [
+        {"name": name("world", 1), "parts": [{"path": str(queued[0]), "state": "done"},
+                                             {"path": str(queued[1]), "state": "pending"}]},
+        {"name": name("world", 2), "parts": [{"path": str(p), "state": "failed"} for p in failed]}
+    ]}, shared=True)
+    assert prune_local()[0] == []
+    assert all(p.exists() for p in queued + failed)
+
+def test_prune_local_skips_sets_with_unfinished_resumable_upload(keep, backup_dir):
+    keep(0, 1)
+    old = _write_set(backup_dir, name("world", 1))
+    _write_set(backup_dir, name("world", 2))
+    save_state("uploads.json", {str(old[1].resolve()): {"preuploadID": "p", "done": []}}, shared=True)
+    assert prune_local()[0] == []
+    assert all(p.exists() for p in old)
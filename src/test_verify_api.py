@@ -0,0 +1,129 @@
+import io
+import json
+import datetime
+import subprocess
+import tarfile
+import pytest
+import verify_api
+from config import cfg
+
+@pytest.fixture
+def backup_dir(monkeypatch, tmp_path):
+    monkeypatch.setitem(cfg["server"], "backup_dir", str(tmp_path))
+    return tmp_path
+
+LISTING = """
+7-Zip [64] 16.02 : Copyright (c) 1999-2016 Igor Pavlov : 2016-05-21
+
+Scanning the drive for archives:
+1 file, 1048576 bytes (1024 KiB)
+
+Listing archive: mc_world_backup_20250105_030000.7z.001
+
+--
+Path = mc_world_backup_20250105_030000.7z.001
+Type = Split
+Physical Size = 1048576
+Volumes = 2
+Total Physical Size = 1500000
+----
+Path = mc_world_backup_20250105_030000.7z
+Size = 1500000
+--
+Path = mc_world_backup_20250105_030000.7z
+Type = 7z
+Physical Size = 1500000
+Headers Size = 210
+Method = LZMA2:24
+Solid = +
+Blocks = 1
+
+----------
+Path = world
+Folder = +
+Size = 0
+Packed Size = 0
+Modified = 2025-01-05 02:59:00
+Attributes = D drwxr-xr-x
+CRC = 
+Encrypted = -
+Method = 
+Block = 
+
+Path = world/level.dat
+Folder = -
+Size = 1234
+Packed Size = 1499790
+Modified = 2025-01-05 02:58:30.1234567
+Attributes = A -rw-r--r--
+CRC = 1A2B3C4D
+Encrypted = -
+Method = LZMA2:24
+Block = 0
+
+Path = world/region/r.0.0.mca
+Folder = -
+Size = 0
+Packed Size = 0
+Modified = 2025-01-05 02:58:31
+Attributes = A -rw-r--r--
+CRC = 
+Encrypted = -
+Method = 
+Block = 
+
+"""
+
+def fake_7z(monkeypatch, stdout, returncode=0):
+    calls = []
+    def run(args, **kwargs):
+        calls.append(args)
+        return subprocess.CompletedProcess(args, returncode, stdout.replace("\n", "\r\n"), "")
+    monkeypatch.setattr(verify_api.subprocess, "run", run)
+    return calls
+
+def test_7z_header_listing_recorded_by_default(backup_dir, monkeypatch):
+    key = "mc_world_backup_20250105_030000.7z"
+    volumes = [backup_dir / (key + ".001"), backup_dir / (key + ".002")]
+    for v in volumes:
+        v.write_bytes(b"volume")
+    calls = fake_7z(monkeypatch, LISTING)
+    assert verify_api.test_archive(key, [str(v) for v in reversed(volumes)])
+    # 只列出归档头，不做需要重读全部分卷的 7z t
+    assert calls == [["7z", "l", "-slt", "-y", str(volumes[0])]]
+    draft = json.loads((backup_dir / verify_api.manifest_name(key)).read_text(encoding="utf-8"))
+    assert draft["test"]["ok"] is True
+    level = int(datetime.datetime(2025, 1, 5, 2, 58, 30).timestamp())
+    region = int(datetime.datetime(2025, 1, 5, 2, 58, 31).timestamp())
+    assert draft["files"] == [["world/level.dat", 1234, level, "1A2B3C4D"],
+                              ["world/region/r.0.0.mca", 0, region, None]]
+
+@pytest.mark.parametrize("stdout,returncode", [("ERROR: Unexpected end of archive", 2), ("no separator", 0)])
+def test_7z_listing_failure_fails_test(backup_dir, monkeypatch, stdout, returncode):
+    key = "mc_world_backup_20250105_030000.7z"
+    volume = backup_dir / (key + ".001")
+    volume.write_bytes(b"not an archive")
+    fake_7z(monkeypatch, stdout, returncode)
+    assert not verify_api.test_archive(key, [str(volume)])
+    assert not (backup_dir / verify_api.manifest_name(key)).exists()
+
+def test_zstd_volumes_are_tested_in_process(backup_dir):
+    zstandard = pytest.importorskip("zstandard")
+    key = "mc_world_backup_20250105_030000.tar.zst"
+    raw = io.BytesIO()
+    with tarfile.open(fileobj=raw, mode="w") as tar:
+        data = b"region" * 1000
+        info = tarfile.TarInfo("world/region/r.0.0.mca")
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+    packed = zstandard.ZstdCompressor().compress(raw.getvalue())
+    half = len(packed) // 2
+    volumes = [backup_dir / (key + ".001"), backup_dir / (key + ".002")]
+    volumes[0].write_bytes(packed[:half])
+    volumes[1].write_bytes(packed[half:])
+    assert verify_api.test_archive(key, [str(v) for v in reversed(volumes)])
+    draft = json.loads((backup_dir / verify_api.manifest_name(key)).read_text(encoding="utf-8"))
+    assert [f[:2] for f in draft["files"]] == [["world/region/r.0.0.mca", 6000]]
+
+    volumes[1].write_bytes(packed[half:-8])
+    assert not verify_api.test_archive(key, [str(v) for v in volumes])
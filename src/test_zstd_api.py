@@ -0,0 +1,40 @@
+import io
+import os
+import pytest
+from zstd_api import ZstdStreamWriter, RAW_BLOCK
+
+zstandard = pytest.importorskip("zstandard")
+
+def decompress(data):
+    reader = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data), read_across_frames=True)
+    return reader.read()
+
+def roundtrip(writes):
+    out = io.BytesIO()
+    writer = ZstdStreamWriter(out, level=3, threads=1)
+    for data, store in writes:
+        writer.write(data, store=store)
+    writer.close()
+    return decompress(out.getvalue())
+
+@pytest.mark.parametrize("writes", [
+    [(b"", True)],
+    [(b"", True), (b"abc", True), (b"", True)],
+    [(os.urandom(RAW_BLOCK), True)],
+    [(os.urandom(RAW_BLOCK * 3), True)],
+    [(os.urandom(RAW_BLOCK - 1), True), (os.urandom(1), True), (os.urandom(RAW_BLOCK + 5), True)],
+    [(b"level" * 1000, False), (os.urandom(RAW_BLOCK * 2), True), (b"", False), (b"tar" * 500, False),
+     (os.urandom(100), True), (os.urandom(RAW_BLOCK * 2 + 7), True), (b"tail" * 10, False)],
+], ids=["empty", "empty-writes", "one-block", "block-multiple", "straddle", "mixed"])
+def test_stream_roundtrips_through_zstd_decompressor(writes):
+    assert roundtrip(writes) == b"".join(data for data, _ in writes)
+
+def test_raw_pending_is_copied_from_reused_buffer():
+    buf = bytearray(os.urandom(RAW_BLOCK + 10))
+    expected = bytes(buf)
+    out = io.BytesIO()
+    writer = ZstdStreamWriter(out, level=3, threads=1)
+    writer.write(memoryview(buf), store=True)
+    buf[:] = bytes(len(buf))
+    writer.close()
+    assert decompress(out.getvalue()) == expected
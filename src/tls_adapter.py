@@ -2,26 +2,32 @@ import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 import ssl
+from config import cfg
 
 # --- TLS 强化 Session ---
+def make_ssl_context():
+    """TLS1.2+ 上下文，requests 与 aiohttp 客户端共用"""
+    ctx = ssl.create_default_context()
+    try:
+        ctx.set_ciphers("DEFAULT:@SECLEVEL=1")
+    except Exception:
+        pass
+    try:
+        ctx.minimum_version = ssl.TLSVersion.TLSv1_2
+    except Exception:
+        pass
+    return ctx
+
 class TLS12Adapter(HTTPAdapter):
     def __init__(self, *args, **kwargs):
-        self.ssl_context = ssl.create_default_context()
-        try:
-            self.ssl_context.set_ciphers("DEFAULT:@SECLEVEL=1")
-        except Exception:
-            pass
-        try:
-            self.ssl_context.minimum_version = ssl.TLSVersion.TLSv1_2
-        except Exception:
-            pass
+        self.ssl_context = make_ssl_context()
         super().__init__(*args, **kwargs)
 
     def init_poolmanager(self, *args, **kwargs):
         kwargs["ssl_context"] = self.ssl_context
         return super().init_poolmanager(*args, **kwargs)
 
-def make_robust_session(total_retries=5, backoff_factor=1.0):
+def make_robust_session(total_retries=5, backoff_factor=1.0, pool_maxsize=32):
     session = requests.Session()
     retry = Retry(
         total=total_retries,
@@ -33,10 +39,12 @@ def make_robust_session(total_retries=5, backoff_factor=1.0):
         raise_on_status=False,
         respect_retry_after_header=True
     )
-    adapter = TLS12Adapter(max_retries=retry)
+    # 连接池需容纳并发分片上传的所有连接
+    adapter = TLS12Adapter(max_retries=retry, pool_maxsize=pool_maxsize)
     session.mount("https://", adapter)
-    session.mount("http://", HTTPAdapter(max_retries=retry))
+    session.mount("http://", HTTPAdapter(max_retries=retry, pool_maxsize=pool_maxsize))
     session.headers.update({"User-Agent": "Mozilla/5.0 (X11; Linux x86_64; rv:140.0) Gecko/20100101 Firefox/140.0"})
     return session
 
-_http = make_robust_session()
\ No newline at end of file
+# 连接池大小与 aiohttp 客户端共用 123pan_http.pool_size（全局配置，进程内只有一个 Session）
+_http = make_robust_session(pool_maxsize=max(1, int(cfg.base("123pan_http", {}).get("pool_size", 32))))
\ No newline at end of file
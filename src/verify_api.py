@@ -0,0 +1,281 @@
+import io
+import re
+import json
+import time
+import datetime
+import tarfile
+import subprocess
+from pathlib import Path
+from config import cfg
+from log_api import logger
+from state_api import load_state, save_state
+from metrics_api import write_textfile
+from pan_api import (get_access_token_http, list_folder_http, file_detail_http, digest_file,
+                     upload_to_date_folder, _prepare_upload_target)
+from retention_api import scan_remote, parse_backup_name
+from restore_api import fetch_json
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# --- 备份校验 ---
+# 1. 本地测试：备份的全部分卷生成后在后台检查归档，与上传同时进行，得到归档内的文件列表。
+#    tar+zstd 在进程内流式解压并遍历成员；7z 的多卷归档只能整体测试（.001 的签名头最后才回写），
+#    `7z t` 要在压缩结束后把全部分卷重新读一遍，因此只用 `7z l -slt` 读取归档头，记录文件列表与各文件的 CRC；
+# 2. 云端核对：全部分卷上传完成后，用目录列表 / 文件详情接口比对各分卷的大小与 etag；
+# 3. 两步都通过后把 <备份名>.verify.json（各分卷的 etag、分片 MD5、文件列表）上传到备份旁边，
+#    storage 为 cloud 时这时才删除本地分卷。
+# verify 命令只调用元数据接口，按校验清单核对云端的历史备份。
+VOLUME_RE = re.compile(r"\.(\d{3})$")
+READ_BUFFER = 1024 * 1024
+
+def verify_enabled():
+    return cfg.get("backup", {}).get("verify", True)
+
+def manifest_name(key):
+    return f"{key}.verify.json"
+
+class LocalConcat(io.RawIOBase):
+    """按顺序拼接本地分卷的只读流"""
+    def __init__(self, paths):
+        self._paths = list(paths)
+        self._f = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while True:
+            if self._f is None:
+                if not self._paths:
+                    return 0
+                self._f = open(self._paths.pop(0), "rb")
+            n = self._f.readinto(b)
+            if n:
+                return n
+            self._f.close()
+            self._f = None
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+        super().close()
+
+def _test_zstd(volumes):
+    if zstandard is None:
+        raise RuntimeError("校验 tar+zstd 备份需要安装 zstandard: uv sync --extra zstd")
+    members = []
+    with LocalConcat(volumes) as raw:
+        reader = zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True)
+        with tarfile.open(fileobj=reader, mode="r|") as tar:
+            for m in tar:
+                if not m.isfile():
+                    continue
+                f = tar.extractfile(m)
+                left = m.size
+                while left > 0:
+                    n = len(f.read(min(READ_BUFFER, left)))
+                    if not n:
+                        raise IOError(f"归档成员被截断: {m.name}")
+                    left -= n
+                members.append([m.name, m.size, int(m.mtime)])
+    return members
+
+def _parse_7z_listing(text):
+    """解析 `7z l -slt` 的输出，返回文件的 [路径, 大小, mtime, CRC]；目录不计入"""
+    # 分隔线之前是归档（及分卷容器）本身的属性
+    _, sep, body = text.partition("\n----------\n")
+    if not sep:
+        raise RuntimeError("无法解析 7z 文件列表")
+    members = []
+    for block in body.split("\n\n"):
+        props = dict(line.split(" = ", 1) for line in block.splitlines() if " = " in line)
+        if "Path" not in props or props.get("Folder") == "+" or props.get("Attributes", "").startswith("D"):
+            continue
+        mtime = props.get("Modified")
+        if mtime:
+            mtime = int(datetime.datetime.strptime(mtime[:19], "%Y-%m-%d %H:%M:%S").timestamp())
+        members.append([props["Path"], int(props.get("Size") or 0), mtime or None, props.get("CRC") or None])
+    return members
+
+def _list_7z(first_volume):
+    """只读取归档头（位于最后一个分卷），不解压数据"""
+    proc = subprocess.run([cfg["server"]["compress_cmd"], "l", "-slt", "-y", first_volume],
+                          capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f"7z 列出文件失败 (退出码 {proc.returncode}): {proc.stdout[-500:]}{proc.stderr[-500:]}")
+    return _parse_7z_listing(proc.stdout.replace("\r\n", "\n"))
+
+def _draft_path(key, paths):
+    return Path(paths[0]).parent / manifest_name(key)
+
+def test_archive(key, paths):
+    """
+    测试归档的全部分卷（tar+zstd 流式解压，7z 读取归档头），结果与归档内的文件列表写入本地校验清单草稿，
+    返回是否通过。
+    """
+    volumes = sorted((p for p in paths if VOLUME_RE.search(p)), key=lambda p: int(VOLUME_RE.search(p).group(1)))
+    started = time.time()
+    tool = "zstd" if key.endswith(".tar.zst") else "7z"
+    members = []
+    error = None
+    try:
+        if tool == "zstd" and volumes:
+            members = _test_zstd(volumes)
+        elif volumes:
+            members = _list_7z(volumes[0])
+        # 没有变化文件的增量备份只有 .manifest.json，没有可测试的分卷
+    except Exception as e:
+        error = str(e)
+    seconds = round(time.time() - started, 2)
+    if error:
+        logger.error("归档测试失败: %s: %s", key, error)
+        return False
+    logger.info("归档测试通过: %s，%d 个文件，耗时 %.1fs", key, len(members), seconds)
+    draft = {"name": key, "test": {"ok": True, "tool": tool, "seconds": seconds},
+             "files": members}
+    _draft_path(key, paths).write_text(json.dumps(draft, ensure_ascii=False), encoding="utf-8")
+    return True
+
+def _remote_items(token, folder_id):
+    return {(item.get("filename") or item.get("name")): item for item in list_folder_http(token, folder_id)}
+
+def _remote_etag(token, item):
+    etag = item.get("etag")
+    if not etag:
+        file_id = item.get("fileId") or item.get("fileID") or item.get("id")
+        etag = (file_detail_http(token, file_id) or {}).get("etag")
+    return (etag or "").lower()
+
+def check_uploaded(key, kind, paths, date):
+    """
+    用元数据接口核对已上传的分卷（大小与 etag），通过后上传校验清单，返回是否通过。
+    """
+    token, _, folder_id = _prepare_upload_target(date)
+    if token is None:
+        logger.error("无法连接 123pan，跳过云端核对: %s", key)
+        return False
+    remote = _remote_items(token, folder_id)
+    parts = []
+    problems = []
+    for p in sorted(paths):
+        path = Path(p)
+        digest = digest_file(path)
+        slice_size = load_state("digests.json", {}, shared=True).get("slice_size")
+        slices = digest_file(path, slice_size)["slices"][str(slice_size)] if slice_size else []
+        item = remote.get(path.name)
+        entry = {"name": path.name, "size": digest["size"], "etag": digest["etag"],
+                 "slice_size": slice_size, "slice_md5": slices}
+        if item is None:
+            problems.append(f"云端缺少 {path.name}")
+        else:
+            entry["file_id"] = item.get("fileId") or item.get("fileID")
+            if int(item.get("size") or 0) != digest["size"]:
+                problems.append(f"{path.name} 大小不一致 (本地 {digest['size']}，云端 {item.get('size')})")
+            elif _remote_etag(token, item) != digest["etag"].lower():
+                problems.append(f"{path.name} etag 不一致")
+        parts.append(entry)
+    if problems:
+        for msg in problems:
+            logger.error("云端核对失败: %s: %s", key, msg)
+        return False
+
+    local = _draft_path(key, paths)
+    manifest = json.loads(local.read_text(encoding="utf-8"))
+    manifest.update({"kind": kind, "created": int(time.time()), "parts": parts})
+    incr = next((p for p in paths if p.endswith(".manifest.json")), None)
+    if incr and Path(incr).exists():
+        incr_manifest = json.loads(Path(incr).read_text(encoding="utf-8"))
+        manifest["base"] = incr_manifest.get("base")
+        manifest["parent"] = incr_manifest.get("parent")
+    local.write_text(json.dumps(manifest, ensure_ascii=False), encoding="utf-8")
+    remember(key, manifest)
+    if not upload_to_date_folder(str(local), date):
+        logger.error("校验清单上传失败: %s", local)
+        return False
+    logger.info("云端核对通过: %s，%d 个文件的大小与 etag 一致", key, len(parts))
+    if cfg.get("backup", {}).get("storage", "both") == "cloud":
+        for p in paths:
+            try:
+                Path(p).unlink()
+                logger.info("删除本地备份，仅保留云端: %s", p)
+            except OSError as e:
+                logger.warning("本地删除失败: %s", e)
+    return True
+
+def remember(key, manifest):
+    """本地保留一份精简的校验记录，verify 命令优先使用，无需下载校验清单"""
+    index = load_state("verify_index.json", {})
+    index[key] = {"parts": {p["name"]: [p["size"], p["etag"]] for p in manifest["parts"]},
+                  "parent": manifest.get("parent"), "base": manifest.get("base")}
+    save_state("verify_index.json", index)
+
+def _load_record(token, key, files, index):
+    record = index.get(key)
+    if record is not None:
+        return record
+    f = next((f for f in files if f["name"] == manifest_name(key)), None)
+    if f is None:
+        return None
+    # 本地没有记录（如换了机器）时下载云端的校验清单，不涉及备份本身
+    manifest = fetch_json(token, f)
+    index[key] = record = {"parts": {p["name"]: [p["size"], p["etag"]] for p in manifest["parts"]},
+                           "parent": manifest.get("parent"), "base": manifest.get("base")}
+    return record
+
+def verify_backups():
+    """
+    按校验记录核对云端全部备份的分卷是否齐全、大小与 etag 是否一致，以及增量链是否完整，
+    结果写入 .mcbackup/verify_report.json，返回有问题的备份数。
+    """
+    started = time.time()
+    token = get_access_token_http()
+    sets, _, _ = scan_remote(token)
+    index = {}
+    for key, record in load_state("verify_index.json", {}).items():
+        # 旧版本把只有删除的增量备份记在 <备份键>.manifest.json 下
+        parsed = parse_backup_name(key)
+        index[parsed[0] if parsed else key] = record
+    failed = {}
+    unverified = []
+    checked = 0
+    for key in sorted(sets, key=lambda k: sets[k]["time"]):
+        entry = sets[key]
+        if entry["kind"] == "snapshot":
+            continue
+        files = {f["name"]: f for f in entry["files"]}
+        record = _load_record(token, key, entry["files"], index)
+        if record is None:
+            unverified.append(key)
+            continue
+        checked += 1
+        problems = []
+        for name, (size, etag) in record["parts"].items():
+            f = files.get(name)
+            if f is None:
+                problems.append(f"缺少 {name}")
+            elif f["size"] != size:
+                problems.append(f"{name} 大小不一致")
+            elif _remote_etag(token, f) != (etag or "").lower():
+                problems.append(f"{name} etag 不一致")
+        link = record.get("parent") or record.get("base")
+        if entry["kind"] == "incr" and link and link not in sets:
+            problems.append(f"增量链断裂，缺少 {link}")
+        if problems:
+            failed[key] = problems
+            logger.error("备份校验失败: %s: %s", key, "；".join(problems))
+    for key in sorted(set(index) - set(sets)):
+        # 保留策略删除备份时会同时移除记录，仍有记录说明备份在云端丢失
+        failed[key] = ["云端缺少整个备份"]
+        logger.error("备份校验失败: %s: 云端缺少整个备份", key)
+    save_state("verify_index.json", index)
+    report = {"time": int(started), "seconds": round(time.time() - started, 1), "checked": checked,
+              "failed": failed, "unverified": unverified}
+    save_state("verify_report.json", report)
+    write_textfile()
+    logger.info("备份校验完成: 核对 %d 个，失败 %d 个，无校验清单 %d 个，耗时 %.1fs", checked, len(failed),
+                len(unverified), report["seconds"])
+    return len(failed)
@@ -0,0 +1,221 @@
+import os
+import time
+import struct
+import tarfile
+from pathlib import Path
+from log_api import logger
+from config import cfg
+from metrics_api import add
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# --- 进程内 tar + zstd 压缩引擎 ---
+READ_BUFFER = 1024 * 1024
+RAW_BLOCK = 128 * 1024
+# 只含 raw block 的 zstd 帧头：魔数 + FHD(0) + 窗口描述符(2^(10+7) = 128 KiB)
+RAW_FRAME_HEADER = struct.pack("<IBB", 0xFD2FB528, 0x00, 7 << 3)
+DEFAULT_STORE_EXTENSIONS = [
+    ".jar", ".zip", ".png", ".jpg", ".jpeg", ".gif", ".webp", ".ogg", ".mp3",
+    ".gz", ".xz", ".bz2", ".zst", ".7z", ".rar"
+]
+
+def parse_size(text) -> int:
+    """解析 7z 风格的分卷大小，如 8g、512m"""
+    text = str(text).strip().lower()
+    units = {"b": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+class VolumeWriter:
+    """把字节流切成 dest.001、dest.002 ... 分卷，每个分卷关闭后立即回调 on_volume"""
+    def __init__(self, dest: Path, volume_size: int, on_volume=None):
+        self.dest = dest
+        self.volume_size = volume_size
+        self.on_volume = on_volume
+        self.written = 0
+        self._no = 0
+        self._f = None
+        self._left = 0
+
+    def _next(self):
+        self._finish_current()
+        self._no += 1
+        self._path = f"{self.dest}.{self._no:03d}"
+        self._f = open(self._path, "wb")
+        self._left = self.volume_size
+
+    def _finish_current(self):
+        if self._f is None:
+            return
+        self._f.close()
+        self._f = None
+        if self.on_volume:
+            self.on_volume(self._path)
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            if self._f is None or self._left == 0:
+                self._next()
+            n = min(self._left, len(view))
+            self._f.write(view[:n])
+            self._left -= n
+            self.written += n
+            view = view[n:]
+
+    def close(self):
+        if self._f is None and self._no == 0:
+            self._next()
+        self._finish_current()
+
+class ZstdStreamWriter:
+    """
+    输出由多个 zstd 帧拼接成的流：可压缩数据进入多线程压缩帧，
+    不可压缩数据直接写成 raw block 帧，不消耗任何压缩 CPU。
+    任何 zstd 解码器（zstd -d、tar --zstd）都能解开拼接的帧。
+    """
+    def __init__(self, out, level, threads):
+        self.out = out
+        self.cctx = zstandard.ZstdCompressor(level=level, threads=threads, write_checksum=True)
+        self._cobj = None
+        self._raw_pending = b""
+        self._raw_open = False
+
+    def write(self, data, store=False):
+        if store:
+            self._end_compressed()
+            self._write_raw(data)
+        else:
+            self._end_raw()
+            if self._cobj is None:
+                self._cobj = self.cctx.compressobj()
+            out = self._cobj.compress(data)
+            if out:
+                self.out.write(out)
+
+    def _write_raw(self, data):
+        if not self._raw_open:
+            self.out.write(RAW_FRAME_HEADER)
+            self._raw_open = True
+        # 保留最后一个块（至多 RAW_BLOCK 字节），以便在帧结束时打上 Last_Block 标记
+        view = memoryview(data)
+        pos = 0
+        if self._raw_pending:
+            need = RAW_BLOCK - len(self._raw_pending)
+            if len(view) <= need:
+                self._raw_pending += bytes(view)
+                return
+            self._raw_block(self._raw_pending + bytes(view[:need]), last=False)
+            pos = need
+        while len(view) - pos > RAW_BLOCK:
+            self._raw_block(view[pos:pos + RAW_BLOCK], last=False)
+            pos += RAW_BLOCK
+        # data 可能是调用方复用的缓冲区，剩余部分必须复制
+        self._raw_pending = bytes(view[pos:])
+
+    def _raw_block(self, block, last):
+        header = (len(block) << 3) | (1 if last else 0)
+        self.out.write(struct.pack("<I", header)[:3])
+        self.out.write(block)
+
+    def _end_raw(self):
+        if self._raw_open:
+            self._raw_block(self._raw_pending, last=True)
+            self._raw_pending = b""
+            self._raw_open = False
+
+    def _end_compressed(self):
+        if self._cobj is not None:
+            self.out.write(self._cobj.flush(zstandard.COMPRESSOBJ_FLUSH_FINISH))
+            self._cobj = None
+
+    def close(self):
+        self._end_raw()
+        self._end_compressed()
+
+def _iter_entries(root: Path, inputs):
+    for rel in inputs:
+        p = root / rel
+        if p.is_dir() and not p.is_symlink():
+            for dirpath, dirnames, filenames in os.walk(p):
+                dirnames.sort()
+                yield Path(dirpath)
+                for name in sorted(filenames):
+                    yield Path(dirpath) / name
+        elif p.exists():
+            yield p
+
+def compress_tar_zstd(dest: Path, root: Path, inputs, on_volume=None):
+    """
+    把 root 下的 inputs（相对路径）打成 tar 并流式压缩为 dest.001、dest.002 ...
+    store_extensions 中的文件原样存储，其余文件按 zstd_level 多线程压缩。
+    """
+    if zstandard is None:
+        raise RuntimeError("compress_engine 为 zstd 时需要安装 zstandard: uv sync --extra zstd")
+    server = cfg["server"]
+    threads = int(server.get("compress_threads", 0)) or os.cpu_count() or 1
+    level = int(server.get("zstd_level", 3))
+    store_ext = {e.lower() for e in server.get("store_extensions", DEFAULT_STORE_EXTENSIONS)}
+    volumes = VolumeWriter(dest, parse_size(server.get("volume_size", "8g")), on_volume)
+    writer = ZstdStreamWriter(volumes, level, threads)
+    logger.info("执行 tar+zstd 压缩: %s (level=%d, threads=%d)", dest, level, threads)
+
+    started = last_report = time.time()
+    bytes_in = stored = 0
+    buf = bytearray(READ_BUFFER)
+    for p in _iter_entries(root, inputs):
+        arcname = p.relative_to(root).as_posix()
+        st = p.lstat()
+        info = tarfile.TarInfo(arcname)
+        info.mtime = int(st.st_mtime)
+        info.mode = st.st_mode & 0o7777
+        if p.is_symlink():
+            info.type = tarfile.SYMTYPE
+            info.linkname = os.readlink(p)
+        elif p.is_dir():
+            info.type = tarfile.DIRTYPE
+        elif p.is_file():
+            info.size = st.st_size
+        else:
+            continue
+        writer.write(info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape"))
+        if info.type != tarfile.REGTYPE:
+            continue
+
+        store = p.suffix.lower() in store_ext
+        left = info.size
+        with p.open("rb") as f:
+            while left > 0:
+                n = f.readinto(buf)
+                if not n:
+                    logger.warning("文件在压缩过程中变短，以 0 填充: %s", p)
+                    n = min(left, READ_BUFFER)
+                    buf[:n] = bytes(n)
+                n = min(n, left)
+                writer.write(memoryview(buf)[:n], store=store)
+                left -= n
+                bytes_in += n
+                if store:
+                    stored += n
+                if time.time() - last_report >= 30:
+                    last_report = time.time()
+                    logger.info("压缩进度: 已读取 %.1f MiB, %.1f MiB/s", bytes_in / 1048576,
+                                bytes_in / 1048576 / (last_report - started))
+        pad = -info.size % tarfile.BLOCKSIZE
+        if pad:
+            writer.write(bytes(pad), store=store)
+    writer.write(bytes(tarfile.BLOCKSIZE * 2))
+    writer.close()
+    volumes.close()
+
+    elapsed = max(time.time() - started, 1e-6)
+    logger.info("tar+zstd 压缩完成: 读取 %.1f MiB（原样存储 %.1f MiB），输出 %.1f MiB，压缩比 %.2f，%.1f MiB/s，耗时 %.1fs",
+                bytes_in / 1048576, stored / 1048576, volumes.written / 1048576,
+                volumes.written / bytes_in if bytes_in else 0, bytes_in / 1048576 / elapsed, elapsed)
+    add("bytes_in", bytes_in)
+    add("bytes_out", volumes.written)
+    return volumes.written